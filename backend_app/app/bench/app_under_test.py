@@ -0,0 +1,29 @@
+# 計測対象のアプリ（main.app）にイベントループ遅延の計測だけを足したもの
+# 環境変数は bench.common.app_env() でスタンドインに向けてから起動する
+#   uvicorn bench.app_under_test:app --port 18001
+from __future__ import annotations
+import os
+
+from bench.common import LoopLagMonitor
+from main import app
+
+# 遅延計測のサンプリング間隔（秒）
+LAG_INTERVAL_SEC = float(os.getenv("BENCH_LAG_INTERVAL_SEC", "0.01"))
+
+lag_monitor = LoopLagMonitor(interval=LAG_INTERVAL_SEC)
+
+
+@app.on_event("startup")
+async def start_lag_monitor():
+    lag_monitor.start()
+
+
+@app.on_event("shutdown")
+async def stop_lag_monitor():
+    lag_monitor.stop()
+
+
+# 前回呼び出し以降の遅延を集計して返す（呼ぶたびにリセット）
+@app.post("/__bench/loop_lag")
+async def take_loop_lag():
+    return lag_monitor.take()
@@ -0,0 +1,317 @@
+# RAG チャット（POST /api/v1/chatbot）のエンドツーエンド・ベンチマーク
+# PostgREST / OpenAI はローカルのスタンドインに置き換えるので、オフラインで実行できる
+#
+#   cd backend_app/app
+#   python -m bench.chat_bench --concurrency 1,8,32 --ttft-ms 300 --token-ms 20 --tokens 200
+#
+# 出力: 同時実行数ごとの TTFT / tokens/sec / 全体レイテンシ / RPS / イベントループ遅延、
+#       および SSE の debug ステージ間の所要時間
+from __future__ import annotations
+import argparse, asyncio, json, time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+
+from bench.common import (
+    ServerProcess,
+    app_env,
+    fmt_ms,
+    free_port,
+    print_table,
+    summarize,
+)
+
+# 1 リクエスト中に観測するステージの順序（debug の stage 名 + 最初のチャンク）
+STAGES = [
+    "start",
+    "client_init",
+    "resolve_thread_project",
+    "embed_text_ok",
+    "vector_search",
+    "context_ready",
+    "llm_begin",
+    "first_token",
+    "draft_saved",
+    "llm_done",
+    "final_saved",
+    "end",
+]
+
+
+@dataclass
+class Sample:
+    ok: bool = False
+    status: Optional[int] = None
+    error: Optional[str] = None
+    ttft: Optional[float] = None
+    total: Optional[float] = None
+    tokens: int = 0
+    tokens_per_sec: Optional[float] = None
+    route: Optional[Dict] = None
+    stages: Dict[str, float] = field(default_factory=dict)  # ステージ名 → 開始からの秒数
+
+
+# SSE を読み、ステージの到着時刻とトークン数を記録する
+async def _one_chat(
+    client: httpx.AsyncClient, url: str, user: str, thread_id: str, question: str, timeout: float
+) -> Sample:
+    s = Sample()
+    body = {"threadId": thread_id, "messages": [{"role": "user", "content": question}]}
+    headers = {"Authorization": f"Bearer {user}", "Accept": "text/event-stream"}
+    t0 = time.perf_counter()
+    first_chunk = last_chunk = None
+    try:
+        async with client.stream(
+            "POST", url + "/api/v1/chatbot", json=body, headers=headers, timeout=timeout
+        ) as r:
+            s.status = r.status_code
+            if r.status_code != 200:
+                s.error = f"http_{r.status_code}"
+                await r.aread()
+                return s
+            async for line in r.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                try:
+                    ev = json.loads(line[6:])
+                except ValueError:
+                    continue
+                now = time.perf_counter() - t0
+                kind = ev.get("type")
+                if kind == "chunk":
+                    s.tokens += 1
+                    last_chunk = now
+                    if first_chunk is None:
+                        first_chunk = now
+                        s.stages.setdefault("first_token", now)
+                elif kind == "debug":
+                    s.stages.setdefault(ev.get("stage", "?"), now)
+                    if ev.get("stage") == "llm_done":
+                        s.route = ev.get("route")
+                elif kind == "start":
+                    s.stages.setdefault("start", now)
+                elif kind == "error":
+                    s.error = s.error or f"{ev.get('where')}: {ev.get('message')}"
+                elif kind == "end":
+                    s.ok = s.error is None and s.tokens > 0
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        s.error = f"{type(e).__name__}: {e}"
+    s.total = time.perf_counter() - t0
+    s.ttft = first_chunk
+    if first_chunk is not None and last_chunk is not None and s.tokens > 1 and last_chunk > first_chunk:
+        s.tokens_per_sec = (s.tokens - 1) / (last_chunk - first_chunk)
+    return s
+
+
+async def run_level(
+    app_url: str,
+    concurrency: int,
+    n_requests: int,
+    *,
+    question: str,
+    same_question: bool,
+    threads: int,
+    timeout: float,
+) -> tuple[List[Sample], float]:
+    """同時実行数 concurrency のクローズドループで n_requests 件を流す"""
+    samples: List[Sample] = []
+    counter = iter(range(n_requests))
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits) as client:
+
+        async def worker(w: int):
+            for i in counter:
+                q = question if same_question else f"{question} (#{i})"
+                samples.append(
+                    await _one_chat(
+                        client, app_url, f"bench-user-{w}", f"thread-{w % threads}", q, timeout
+                    )
+                )
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+    return samples, elapsed
+
+
+def _stage_durations(samples: List[Sample]) -> Dict[str, List[float]]:
+    """隣り合うステージの差分（観測できたステージ同士）"""
+    out: Dict[str, List[float]] = {}
+    for s in samples:
+        prev_name, prev_t = "request", 0.0
+        for name in STAGES:
+            t = s.stages.get(name)
+            if t is None:
+                continue
+            out.setdefault(f"{prev_name} → {name}", []).append(t - prev_t)
+            prev_name, prev_t = name, t
+    return out
+
+
+def report_level(concurrency: int, samples: List[Sample], elapsed: float, lag: Dict) -> Dict:
+    ok = [s for s in samples if s.ok]
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if not s.ok:
+            key = (s.error or "no_end").split("\n")[0][:80]
+            errors[key] = errors.get(key, 0) + 1
+    total_tokens = sum(s.tokens for s in samples)
+    result = {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": errors,
+        "elapsed_sec": elapsed,
+        "rps": len(samples) / elapsed if elapsed else None,
+        "aggregate_tokens_per_sec": total_tokens / elapsed if elapsed else None,
+        "ttft": summarize(s.ttft for s in ok if s.ttft is not None),
+        "total": summarize(s.total for s in ok if s.total is not None),
+        "tokens_per_sec": summarize(s.tokens_per_sec for s in ok if s.tokens_per_sec),
+        "stages": {k: summarize(v) for k, v in _stage_durations(ok).items()},
+        "routes": {},
+        "loop_lag": lag,
+    }
+    for s in ok:
+        tier = (s.route or {}).get("used") or "?"
+        result["routes"][tier] = result["routes"].get(tier, 0) + 1
+    return result
+
+
+def print_summary(results: List[Dict]):
+    print()
+    print_table(
+        ["conc", "reqs", "err", "rps", "ttft p50", "ttft p95", "ttft p99", "total p50",
+         "total p95", "tok/s p50", "agg tok/s", "lag p99", "lag max"],
+        [
+            [
+                str(r["concurrency"]),
+                str(r["requests"]),
+                str(r["requests"] - r["ok"]),
+                f"{r['rps']:.2f}" if r["rps"] else "-",
+                fmt_ms(r["ttft"]["p50"]),
+                fmt_ms(r["ttft"]["p95"]),
+                fmt_ms(r["ttft"]["p99"]),
+                fmt_ms(r["total"]["p50"]),
+                fmt_ms(r["total"]["p95"]),
+                f"{r['tokens_per_sec']['p50']:.1f}" if r["tokens_per_sec"]["p50"] else "-",
+                f"{r['aggregate_tokens_per_sec']:.1f}" if r["aggregate_tokens_per_sec"] else "-",
+                fmt_ms(r["loop_lag"].get("p99")),
+                fmt_ms(r["loop_lag"].get("max")),
+            ]
+            for r in results
+        ],
+    )
+    print("(時間はすべて ms)")
+    for r in results:
+        print(f"\n== stages @ concurrency={r['concurrency']}  routes={r['routes']}")
+        print_table(
+            ["stage", "n", "p50", "p95", "max"],
+            [
+                [name, str(st["n"]), fmt_ms(st["p50"]), fmt_ms(st["p95"]), fmt_ms(st["max"])]
+                for name, st in r["stages"].items()
+            ],
+        )
+        for err, n in r["errors"].items():
+            print(f"  error x{n}: {err}")
+
+
+def _parse_args(argv=None):
+    p = argparse.ArgumentParser(description="RAG chat end-to-end benchmark (offline)")
+    p.add_argument("--concurrency", default="1,4,16", help="カンマ区切りの同時実行数")
+    p.add_argument("--requests", type=int, default=0, help="各レベルの件数（0 なら max(20, 4×同時実行数)）")
+    p.add_argument("--warmup", type=int, default=2, help="計測前に流す件数")
+    p.add_argument("--question", default="この研究の手法と結果を教えて")
+    p.add_argument("--same-question", action="store_true", help="毎回同じ質問（検索キャッシュが効く経路）")
+    p.add_argument("--timeout", type=float, default=120.0)
+    # スタンドインの遅延
+    p.add_argument("--ttft-ms", type=float, default=300)
+    p.add_argument("--token-ms", type=float, default=20)
+    p.add_argument("--tokens", type=int, default=200)
+    p.add_argument("--embed-ms", type=float, default=50)
+    p.add_argument("--db-ms", type=float, default=5)
+    p.add_argument("--match-ms", type=float, default=20)
+    p.add_argument("--hits", type=int, default=5)
+    p.add_argument("--hit-chars", type=int, default=800)
+    p.add_argument("--jitter", type=float, default=0.2)
+    p.add_argument("--model-ttft-factors", default="", help='例: "gpt-5-nano:0.5,gpt-5:2"')
+    # 既に起動しているサーバを使う場合
+    p.add_argument("--app-url", default="", help="計測対象（bench.app_under_test）の URL")
+    p.add_argument("--stand-in-url", default="", help="スタンドイン（bench.stand_in）の URL")
+    p.add_argument("--json", default="", help="結果を JSON で書き出すパス")
+    return p.parse_args(argv)
+
+
+async def _main(args) -> List[Dict]:
+    levels = [int(x) for x in args.concurrency.split(",") if x.strip()]
+    threads = max(levels + [1])
+    servers: List[ServerProcess] = []
+    try:
+        stand_in_url = args.stand_in_url
+        if not stand_in_url:
+            stand_in = ServerProcess(
+                "bench.stand_in:app",
+                free_port(),
+                {
+                    "BENCH_TTFT_MS": str(args.ttft_ms),
+                    "BENCH_TOKEN_MS": str(args.token_ms),
+                    "BENCH_TOKENS": str(args.tokens),
+                    "BENCH_EMBED_MS": str(args.embed_ms),
+                    "BENCH_DB_MS": str(args.db_ms),
+                    "BENCH_RPC_MATCH_MS": str(args.match_ms),
+                    "BENCH_HITS": str(args.hits),
+                    "BENCH_HIT_CHARS": str(args.hit_chars),
+                    "BENCH_JITTER": str(args.jitter),
+                    "BENCH_MODEL_TTFT_FACTORS": args.model_ttft_factors,
+                    "BENCH_THREADS": str(threads),
+                },
+            )
+            servers.append(stand_in.start())
+            stand_in_url = stand_in.url
+        app_url = args.app_url
+        if not app_url:
+            app = ServerProcess("bench.app_under_test:app", free_port(), app_env(stand_in_url))
+            servers.append(app.start())
+            app_url = app.url
+
+        if args.warmup:
+            await run_level(app_url, 1, args.warmup, question=args.question,
+                            same_question=args.same_question, threads=threads, timeout=args.timeout)
+
+        results = []
+        async with httpx.AsyncClient() as ctl:
+            for c in levels:
+                n = args.requests or max(20, 4 * c)
+                await ctl.post(stand_in_url + "/__bench/reset")
+                await ctl.post(app_url + "/__bench/loop_lag")  # ← 前レベルの分を捨てる
+                print(f"[bench] concurrency={c} requests={n} ...", flush=True)
+                samples, elapsed = await run_level(
+                    app_url, c, n, question=args.question, same_question=args.same_question,
+                    threads=threads, timeout=args.timeout,
+                )
+                lag = (await ctl.post(app_url + "/__bench/loop_lag")).json()
+                results.append(report_level(c, samples, elapsed, lag))
+            tiers = (await ctl.get(app_url + "/api/v1/chatbot/models",
+                                   headers={"Authorization": "Bearer bench"})).json()
+        print_summary(results)
+        print("\n== model tiers")
+        for t in tiers:
+            print(f"  {t['tier']:<6} {t['model']:<16} ttft_ewma={fmt_ms(t['ttft_ewma'])}ms "
+                  f"error_rate={t['error_rate']} calls={t['calls']}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"args": vars(args), "results": results, "tiers": tiers}, f,
+                          ensure_ascii=False, indent=2)
+        return results
+    finally:
+        for s in reversed(servers):
+            s.stop()
+
+
+def main(argv=None):
+    asyncio.run(_main(_parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+from __future__ import annotations
+import asyncio, os, socket, subprocess, sys, time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+import httpx
+
+# bench/ の親（backend_app/app）。フラット import のためここを cwd にして起動する
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ==================================================
+## 集計
+# ==================================================
+def percentile(values: Iterable[float], q: float) -> Optional[float]:
+    """線形補間のパーセンタイル（q は 0〜100）。空なら None"""
+    xs = sorted(values)
+    if not xs:
+        return None
+    k = (len(xs) - 1) * q / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (k - lo)
+
+
+def summarize(values: Iterable[float]) -> Dict[str, Optional[float]]:
+    xs = list(values)
+    return {
+        "n": len(xs),
+        "p50": percentile(xs, 50),
+        "p95": percentile(xs, 95),
+        "p99": percentile(xs, 99),
+        "max": max(xs) if xs else None,
+    }
+
+
+def fmt_ms(sec: Optional[float]) -> str:
+    return "-" if sec is None else f"{sec * 1000:.1f}"
+
+
+# ==================================================
+## イベントループ遅延の計測
+# ==================================================
+class LoopLagMonitor:
+    """
+    一定間隔で sleep し、予定より遅れて起床した時間をイベントループの遅延として記録する。
+    同期 I/O や重い CPU 処理でループが塞がれていると値が大きくなる。
+    """
+
+    def __init__(self, interval: float = 0.01, keep: int = 100_000):
+        self.interval = interval
+        self.samples: Deque[float] = deque(maxlen=keep)
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - t0 - self.interval))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # 集計して返し、サンプルをリセットする
+    def take(self) -> Dict[str, Optional[float]]:
+        stats = summarize(self.samples)
+        self.samples.clear()
+        return stats
+
+
+# ==================================================
+## スタンドイン / 計測対象サーバの起動
+# ==================================================
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """uvicorn を子プロセスで起動する（ベンチ側と GIL / イベントループを共有しない）"""
+
+    def __init__(self, target: str, port: int, env: Dict[str, str], *, quiet: bool = True):
+        self.target = target
+        self.port = port
+        self.env = {**os.environ, **env}
+        self.quiet = quiet
+        self.proc: Optional[subprocess.Popen] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, health_path: str = "/health", timeout: float = 30.0):
+        cmd = [
+            sys.executable, "-m", "uvicorn", self.target,
+            "--host", "127.0.0.1", "--port", str(self.port),
+            "--log-level", "warning", "--no-access-log",
+        ]
+        out = subprocess.DEVNULL if self.quiet else None
+        self.proc = subprocess.Popen(cmd, cwd=APP_DIR, env=self.env, stdout=out, stderr=None)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"{self.target} exited with {self.proc.returncode}")
+            try:
+                if httpx.get(self.url + health_path, timeout=1.0).status_code == 200:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"{self.target} did not become ready on :{self.port}")
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+
+def app_env(stand_in_url: str) -> Dict[str, str]:
+    """計測対象アプリをスタンドインに向ける環境変数（外部には一切出ない）"""
+    return {
+        "SUPABASE_URL": stand_in_url,
+        "SUPABASE_AUTH_URL": stand_in_url + "/auth/v1",
+        # supabase-py はキーが JWT 形式かだけを検査する
+        "SUPABASE_ANON_KEY": "bench.anon.key",
+        "SUPABASE_SERVICE_ROLE_KEY": "bench.service.key",
+        "OPENAI_API_KEY": "bench-openai",
+        "OPENAI_BASE_URL": stand_in_url + "/v1",
+        "DEBUG_SSE_TRACE": "0",
+        # tiktoken のエンコーディングを取りに外へ出ない
+        "CHUNK_TOKENIZER": "estimate",
+        # 計測中に Postgres 中継へ繋ぎに行かない
+        "STREAM_PUBSUB_DSN": "",
+        "DATABASE_URL": "",
+    }
+
+
+def print_table(headers: List[str], rows: List[List[str]]):
+    widths = [max(len(h), *(len(r[i]) for r in rows)) if rows else len(h) for i, h in enumerate(headers)]
+    line = "  ".join(h.rjust(w) for h, w in zip(headers, widths))
+    print(line)
+    print("-" * len(line))
+    for r in rows:
+        print("  ".join(c.rjust(w) for c, w in zip(r, widths)))
@@ -0,0 +1,247 @@
+# 埋め込みの次元数・保存精度ごとの 再現率 / メモリ / 検索時間 の比較
+# 基準は 1536 次元 float32 の全探索の上位 k 件。各構成（次元 × 精度）で同じ問い合わせを引き、
+# どれだけ同じ上位 k 件が返るか（recall@k）と、1 ベクトルあたりのバイト数・検索時間を並べる
+#
+#   cd backend_app/app
+#   python -m bench.embedding_bench                                  # 合成ベクトル（オフライン）・numpy の全探索
+#   python -m bench.embedding_bench --source openai --texts corpus.txt   # 実際の埋め込み（OPENAI_API_KEY が要る）
+#   python -m bench.embedding_bench --dsn postgresql://...           # pgvector の HNSW 索引で計測（一時テーブル）
+#
+# 次元を減らした構成は、先頭 d 次元を切り出して正規化したもの（text-embedding-3-* の dimensions 指定と同じ）。
+# int8 はスカラー量子化（次元ごとの最大絶対値で ±127 に丸める）の参考値。pgvector に int8 の型は無いので --dsn では計らない
+# 合成ベクトルは、先頭の次元ほど分散が大きい（Matryoshka 表現に近い）クラスタ構造を持たせて作る。
+# 値の絶対値より、構成どうしの相対的な差を見ること
+from __future__ import annotations
+import argparse, asyncio, json, random, time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from bench.common import print_table
+
+FULL_DIMS = 1536
+# pgvector の 1 値あたりのバイト数と、値ごとのヘッダ（vector / halfvec は 8 バイト）
+STORAGE_BYTES = {"float32": 4, "halfvec": 2, "int8": 1}
+PG_TYPE = {"float32": "vector", "halfvec": "halfvec"}
+
+
+# ==================================================
+## 入力ベクトル
+# ==================================================
+def _normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=1, keepdims=True).clip(min=1e-12)
+
+
+def synthetic(n: int, n_queries: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """クラスタ中心 + ノイズ。次元 i の分散を 1/sqrt(i+1) で減衰させ、問い合わせはコーパスの点を揺らしたもの"""
+    rng = np.random.default_rng(seed)
+    scale = (1.0 / np.sqrt(np.arange(1, FULL_DIMS + 1))).astype(np.float32)
+    n_clusters = max(8, n // 50)
+    centers = rng.standard_normal((n_clusters, FULL_DIMS), dtype=np.float32)
+    labels = rng.integers(0, n_clusters, n)
+    corpus = centers[labels] + 0.8 * rng.standard_normal((n, FULL_DIMS), dtype=np.float32)
+    corpus = _normalize(corpus * scale)
+    picks = rng.integers(0, n, n_queries)
+    queries = corpus[picks] + 0.6 * _normalize(rng.standard_normal((n_queries, FULL_DIMS), dtype=np.float32) * scale)
+    return corpus.astype(np.float32), _normalize(queries).astype(np.float32)
+
+
+def from_openai(path: str, n_queries: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """テキストをチャンク分割して 1536 次元で埋め込む。問い合わせは各チャンクの先頭の文"""
+    from services.openai_client import embed_texts
+    from workers.text_splitter import TokenTextSplitter, sentences
+
+    with open(path, encoding="utf-8") as f:
+        chunks = TokenTextSplitter().split_text(f.read())
+    rng = random.Random(seed)
+    picks = rng.sample(range(len(chunks)), min(n_queries, len(chunks)))
+    questions = [(sentences(chunks[i]) or [chunks[i]])[0] for i in picks]
+    print(f"[embedding_bench] embedding {len(chunks)} chunks + {len(questions)} queries ...", flush=True)
+    vecs = asyncio.run(embed_texts(chunks + questions))
+    arr = _normalize(np.asarray(vecs, dtype=np.float32))
+    return arr[: len(chunks)], arr[len(chunks) :]
+
+
+# ==================================================
+## 構成ごとの変換と探索
+# ==================================================
+def reduce_dims(x: np.ndarray, dims: int) -> np.ndarray:
+    return _normalize(x[:, :dims]) if dims < x.shape[1] else x
+
+
+def quantize(corpus: np.ndarray, queries: np.ndarray, storage: str) -> Tuple[np.ndarray, np.ndarray]:
+    """保存精度に丸めた値（計算は float32 に戻して行う）。問い合わせは float32 のまま"""
+    if storage == "halfvec":
+        return corpus.astype(np.float16).astype(np.float32), queries
+    if storage == "int8":
+        scale = np.abs(corpus).max(axis=0).clip(min=1e-12) / 127.0
+        q = np.clip(np.rint(corpus / scale), -127, 127).astype(np.int8)
+        return q.astype(np.float32) * scale, queries
+    return corpus, queries
+
+
+def topk(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ corpus.T
+    idx = np.argpartition(-scores, k, axis=1)[:, :k]
+    order = np.take_along_axis(scores, idx, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def _bytes_per_vector(dims: int, storage: str) -> int:
+    return dims * STORAGE_BYTES[storage] + 8
+
+
+def run_numpy(corpus, queries, dims_list, storages, k, truth) -> List[Dict]:
+    results = []
+    for dims in dims_list:
+        c_d, q_d = reduce_dims(corpus, dims), reduce_dims(queries, dims)
+        for storage in storages:
+            c_s, q_s = quantize(c_d, q_d, storage)
+            topk(c_s, q_s[:4], k)  # BLAS の初期化を計測に含めない
+            t0 = time.perf_counter()
+            found = topk(c_s, q_s, k)
+            per_query = (time.perf_counter() - t0) / len(q_s)
+            results.append({
+                "dims": dims,
+                "storage": storage,
+                "recall": recall(found, truth),
+                "bytes_per_vec": _bytes_per_vector(dims, storage),
+                "data_mb": _bytes_per_vector(dims, storage) * len(c_s) / 1e6,
+                "query_ms": per_query * 1000,
+                "mode": "numpy",
+            })
+            print(f"[embedding_bench] {dims} {storage} recall@{k}={results[-1]['recall']:.3f}", flush=True)
+    return results
+
+
+# ==================================================
+## pgvector（HNSW）での計測
+# ==================================================
+def _literal(v: np.ndarray) -> str:
+    return "[" + ",".join(f"{x:.6g}" for x in v.tolist()) + "]"
+
+
+async def _pg_case(conn, corpus, queries, dims, storage, k, truth) -> Dict:
+    typ = f"{PG_TYPE[storage]}({dims})"
+    await conn.execute("drop table if exists bench_embed")
+    await conn.execute(f"create temp table bench_embed (id int primary key, embedding {typ} not null)")
+    await conn.executemany(
+        f"insert into bench_embed values ($1, $2::text::{typ})",
+        [(i, _literal(v)) for i, v in enumerate(corpus)],
+    )
+    t0 = time.perf_counter()
+    await conn.execute(f"create index on bench_embed using hnsw (embedding {PG_TYPE[storage]}_cosine_ops)")
+    build = time.perf_counter() - t0
+    table_b = await conn.fetchval("select pg_table_size('bench_embed')")
+    index_b = await conn.fetchval("select pg_indexes_size('bench_embed')")
+    await conn.execute(f"set hnsw.ef_search = {max(40, k * 4)}")
+    found, times = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        rows = await conn.fetch(
+            f"select id from bench_embed order by embedding <=> $1::text::{typ} limit {k}", _literal(q)
+        )
+        times.append(time.perf_counter() - t0)
+        found.append([r["id"] for r in rows] + [-1] * (k - len(rows)))
+    return {
+        "dims": dims,
+        "storage": storage,
+        "recall": recall(np.asarray(found), truth),
+        "bytes_per_vec": _bytes_per_vector(dims, storage),
+        "data_mb": table_b / 1e6,
+        "index_mb": index_b / 1e6,
+        "build_sec": build,
+        "query_ms": float(np.median(times)) * 1000,
+        "mode": "pgvector",
+    }
+
+
+async def run_pg(dsn, corpus, queries, dims_list, storages, k, truth) -> List[Dict]:
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        results = []
+        for dims in dims_list:
+            c_d, q_d = reduce_dims(corpus, dims), reduce_dims(queries, dims)
+            for storage in storages:
+                if storage not in PG_TYPE:
+                    continue
+                print(f"[embedding_bench] pgvector {dims} {storage} ...", flush=True)
+                results.append(await _pg_case(conn, c_d, q_d, dims, storage, k, truth))
+        await conn.execute("drop table if exists bench_embed")
+        return results
+    finally:
+        await conn.close()
+
+
+# ==================================================
+## 出力
+# ==================================================
+def print_results(results: List[Dict], k: int):
+    rows = []
+    for r in results:
+        rows.append([
+            r["mode"],
+            str(r["dims"]),
+            r["storage"],
+            f"{r['recall']:.3f}",
+            str(r["bytes_per_vec"]),
+            f"{r['data_mb']:.1f}",
+            f"{r['index_mb']:.1f}" if r.get("index_mb") is not None else "-",
+            f"{r['query_ms']:.2f}",
+        ])
+    print_table(
+        ["mode", "dims", "storage", f"recall@{k}", "bytes/vec", "data MB", "index MB", "ms/query"],
+        rows,
+    )
+
+
+def _parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Embedding dimensions / precision: recall vs memory vs latency")
+    p.add_argument("--source", choices=["synthetic", "openai"], default="synthetic")
+    p.add_argument("--texts", default="", help="--source openai のときのコーパス（UTF-8 テキスト）")
+    p.add_argument("--n", type=int, default=20000, help="合成ベクトルの件数")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--dims", default="1536,1024,768,512,256")
+    p.add_argument("--storage", default="float32,halfvec,int8")
+    p.add_argument("--dsn", default="", help="pgvector の入った Postgres（指定時は HNSW 索引で計測）")
+    p.add_argument("--json", default="")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    if args.source == "openai":
+        if not args.texts:
+            raise SystemExit("--source openai needs --texts")
+        corpus, queries = from_openai(args.texts, args.queries)
+    else:
+        corpus, queries = synthetic(args.n, args.queries)
+    dims_list = [int(d) for d in args.dims.split(",") if d]
+    storages = [s for s in args.storage.split(",") if s]
+    for s in storages:
+        if s not in STORAGE_BYTES:
+            raise SystemExit(f"unknown storage: {s} (choices: {', '.join(STORAGE_BYTES)})")
+    truth = topk(corpus, queries, args.k)  # 基準: 1536 次元 float32 の全探索
+
+    if args.dsn:
+        results = asyncio.run(run_pg(args.dsn, corpus, queries, dims_list, storages, args.k, truth))
+    else:
+        results = run_numpy(corpus, queries, dims_list, storages, args.k, truth)
+    print()
+    print(f"corpus={len(corpus)} queries={len(queries)} source={args.source}")
+    print_results(results, args.k)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
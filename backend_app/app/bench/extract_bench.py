@@ -0,0 +1,270 @@
+# 取り込み処理の CPU ホットスポット（各形式の抽出器とチャンク分割）のマイクロベンチマーク
+# フィクスチャは bench.fixtures で生成し、各ケースを個別の子プロセスで実行してピークメモリを分離する
+#
+#   cd backend_app/app
+#   python -m bench.extract_bench                   # 全ケース・全サイズ
+#   python -m bench.extract_bench --cases pdf,csv --quick
+#   python -m bench.extract_bench --cases splitter_recursive,splitter_token   # 分割器の比較
+#
+# 出力: ケース / 入力サイズごとの処理時間、MB/s、ページ（単位）/s、
+#       Python ヒープのピーク（tracemalloc）と RSS のピーク増分
+from __future__ import annotations
+import argparse, json, os, statistics, subprocess, sys, time, tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bench.common import APP_DIR, print_table
+from bench.fixtures import fixture_path
+
+MB = 1024 * 1024
+
+
+# ==================================================
+## ケース定義: 入力ファイルのパス → (処理単位数, 出力量)
+# ==================================================
+def _extract(path: str, name: str) -> List[Tuple[str, Optional[int]]]:
+    # 取り込みと同じレジストリ経由（ファイルパス / メモリマップから逐次抽出）
+    from workers.extractors import iter_extracted
+
+    return list(iter_extracted(path, name, None))
+
+
+def _run_pdf(path: str) -> Tuple[int, int]:
+    out = _extract(path, "bench.pdf")
+    return (len(out), sum(len(t) for t, _ in out))
+
+
+_pool = None
+
+
+def _pdf_pool():
+    # ページ並列抽出用のプール（起動と子プロセスの import は計測に含めない）
+    global _pool
+    if _pool is None:
+        from workers.extract_pool import ExtractPool
+
+        _pool = ExtractPool()
+        _pool.warm()
+        for _ in range(_pool.size):
+            list(_pool.iter_extract(fixture_path("pdf", 10), "warm.pdf", None))
+    return _pool
+
+
+def _run_pdf_parallel(path: str) -> Tuple[int, int]:
+    # ページ範囲をプールの全ワーカーに分担させる
+    from workers.extractors import pdf_page_count
+
+    pool = _pdf_pool()
+    n_pages = pdf_page_count(path)
+    parts = max(1, min(pool.size, n_pages))
+    out = list(pool.iter_extract_pdf_parallel(path, "bench.pdf", None, n_pages, parts))
+    return (len(out), sum(len(t) for t, _ in out))
+
+
+def _run_docx(path: str) -> Tuple[Optional[int], int]:
+    out = _extract(path, "bench.docx")
+    return (None, sum(len(t) for t, _ in out))  # ← 段落数はフィクスチャのサイズを使う
+
+
+def _run_pptx(path: str) -> Tuple[int, int]:
+    out = _extract(path, "bench.pptx")
+    return (len(out), sum(len(t) for t, _ in out))
+
+
+def _run_html(path: str) -> Tuple[int, int]:
+    out = _extract(path, "bench.html")
+    return (0, sum(len(t) for t, _ in out))
+
+
+def _run_json(path: str) -> Tuple[int, int]:
+    out = _extract(path, "bench.json")
+    return (0, sum(len(t) for t, _ in out))
+
+
+def _run_csv(path: str) -> Tuple[int, int]:
+    # ブロック単位で流れてくるので、溜めずに数えるだけにする（ピークメモリはブロック程度）
+    from workers.extractors import iter_extracted
+
+    return (0, sum(len(t) for t, _ in iter_extracted(path, "bench.csv", None)))
+
+
+def _run_splitter(path: str) -> Tuple[int, int]:
+    # 取り込みの分割段（workers.ingest_pipeline._split_stage）と同じ: 整形 → 設定中の分割器 → チャンクごとに整形
+    from workers.extractors import _clean_text
+    from workers.text_splitter import make_splitter
+
+    splitter = make_splitter()
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    chunks = [_clean_text(c) for c in splitter.split_text(_clean_text(text))]
+    return (len(chunks), sum(len(c) for c in chunks))
+
+
+def _run_split_with(kind: str) -> Callable[[str], Tuple[int, int]]:
+    # 分割器だけを比べる（recursive: 従来の文字数基準 / token: workers.text_splitter）
+    def run(path: str) -> Tuple[int, int]:
+        from workers.text_splitter import CHUNK_OVERLAP, CHUNK_SIZE, TokenTextSplitter
+
+        if kind == "token":
+            splitter = TokenTextSplitter()
+        else:
+            from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+            splitter = RecursiveCharacterTextSplitter(
+                chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+            )
+        with open(path, encoding="utf-8") as f:
+            chunks = splitter.split_text(f.read())
+        return (len(chunks), sum(len(c) for c in chunks))
+
+    return run
+
+
+# ケース名 → (フィクスチャ形式, サイズ一覧, 実行関数, 単位名)
+# サイズは形式ごとの生成パラメータ（pdf/pptx はページ数、docx は段落数、それ以外はバイト数）
+# 単位を持たない形式（"-"）は MB/s だけを見る
+CASES: Dict[str, Tuple[str, List[int], Callable[[str], Tuple[Optional[int], int]], str]] = {
+    "pdf": ("pdf", [10, 100, 1000], _run_pdf, "pages"),
+    # EXTRACT_POOL_SIZE 個のワーカーでページ並列（閾値を無視して常に分割）
+    "pdf_parallel": ("pdf", [100, 1000], _run_pdf_parallel, "pages"),
+    "docx": ("docx", [100, 1000, 10000], _run_docx, "paragraphs"),
+    "pptx": ("pptx", [10, 100, 500], _run_pptx, "slides"),
+    "html": ("html", [1 * MB, 10 * MB], _run_html, "-"),
+    "json": ("json", [1 * MB, 10 * MB], _run_json, "-"),
+    "csv": ("csv", [1 * MB, 10 * MB, 50 * MB], _run_csv, "-"),
+    # splitter は取り込みと同じ分割段（設定中の分割器 CHUNK_SPLITTER と整形）。_recursive / _token は分割器単体の比較
+    "splitter": ("txt", [1 * MB, 10 * MB], _run_splitter, "chunks"),
+    "splitter_recursive": ("txt", [1 * MB, 10 * MB], _run_split_with("recursive"), "chunks"),
+    "splitter_token": ("txt", [1 * MB, 10 * MB], _run_split_with("token"), "chunks"),
+    # 空行・空白の無い和文（文字数基準の再帰分割の最悪ケース）
+    "splitter_recursive_ja": ("txt_ja", [1 * MB, 4 * MB], _run_split_with("recursive"), "chunks"),
+    "splitter_token_ja": ("txt_ja", [1 * MB, 4 * MB], _run_split_with("token"), "chunks"),
+}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト
+    return peak / (MB if sys.platform == "darwin" else 1024)
+
+
+# 1 ケースを計測する（子プロセス内で呼ばれる）
+def measure(case: str, size: int, repeat: int) -> Dict:
+    kind, _, fn, unit = CASES[case]
+    path = fixture_path(kind, size)
+    n_bytes = os.path.getsize(path)
+    fn(path)  # 抽出器が遅延 import するライブラリの読み込みは計測に含めない
+    if case == "pdf_parallel":
+        _pdf_pool()
+    rss0 = _peak_rss_mb()
+
+    times: List[float] = []
+    units = out_len = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        units, out_len = fn(path)
+        times.append(time.perf_counter() - t0)
+    rss1 = _peak_rss_mb()
+    if units is None:
+        units = size
+
+    # tracemalloc は遅くなるので、計時とは別の 1 回で Python ヒープのピークを測る
+    tracemalloc.start()
+    fn(path)
+    _, py_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    med = statistics.median(times)
+    return {
+        "case": case,
+        "size": size,
+        "bytes": n_bytes,
+        "unit": unit,
+        "units": units,
+        "output_chars": out_len,
+        "time_median": med,
+        "time_min": min(times),
+        "mb_per_sec": n_bytes / MB / med if med else None,
+        "units_per_sec": units / med if med and units else None,
+        "py_peak_mb": py_peak / MB,
+        "rss_peak_delta_mb": (rss1 - rss0) if rss0 is not None and rss1 is not None else None,
+    }
+
+
+def _measure_isolated(case: str, size: int, repeat: int) -> Dict:
+    cmd = [sys.executable, "-m", "bench.extract_bench", "--child", f"{case}:{size}", "--repeat", str(repeat)]
+    r = subprocess.run(cmd, cwd=APP_DIR, capture_output=True, text=True)
+    if r.returncode != 0:
+        return {"case": case, "size": size, "error": (r.stderr.strip().splitlines() or ["?"])[-1]}
+    return json.loads(r.stdout.strip().splitlines()[-1])
+
+
+def print_results(results: List[Dict]):
+    rows = []
+    for r in results:
+        if "error" in r:
+            rows.append([r["case"], str(r["size"]), "-", "-", "-", "-", "-", "-", "-", r["error"][:40]])
+            continue
+        rows.append([
+            r["case"],
+            str(r["size"]),
+            f"{r['bytes'] / MB:.2f}",
+            f"{r['units']} {r['unit']}" if r["units"] else "-",
+            f"{r['time_median'] * 1000:.1f}",
+            f"{r['mb_per_sec']:.2f}" if r["mb_per_sec"] else "-",
+            f"{r['units_per_sec']:.1f}" if r["units_per_sec"] else "-",
+            f"{r['py_peak_mb']:.1f}",
+            f"{r['rss_peak_delta_mb']:.1f}" if r["rss_peak_delta_mb"] is not None else "-",
+            "",
+        ])
+    print_table(
+        ["case", "size", "MB", "units", "ms (median)", "MB/s", "units/s", "py peak MB", "rss +MB", "error"],
+        rows,
+    )
+
+
+def _parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Extractor / splitter microbenchmarks")
+    p.add_argument("--cases", default=",".join(CASES), help="カンマ区切りのケース名")
+    p.add_argument("--sizes", default="", help="サイズを上書き（カンマ区切り。全ケース共通）")
+    p.add_argument("--quick", action="store_true", help="各ケースの小さい 2 サイズのみ")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--no-isolate", action="store_true", help="子プロセスを使わず同一プロセスで実行")
+    p.add_argument("--json", default="")
+    p.add_argument("--child", default="", help=argparse.SUPPRESS)
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    if args.child:
+        case, _, size = args.child.partition(":")
+        print(json.dumps(measure(case, int(size), args.repeat)))
+        return
+
+    results = []
+    for case in [c.strip() for c in args.cases.split(",") if c.strip()]:
+        if case not in CASES:
+            raise SystemExit(f"unknown case: {case} (choices: {', '.join(CASES)})")
+        sizes = [int(s) for s in args.sizes.split(",") if s] or CASES[case][1]
+        if args.quick:
+            sizes = sizes[:2]
+        for size in sizes:
+            fixture_path(CASES[case][0], size)  # 生成時間を計測に含めないよう先に作る
+            print(f"[extract] {case} size={size} ...", flush=True)
+            if args.no_isolate:
+                results.append(measure(case, size, args.repeat))
+            else:
+                results.append(_measure_isolated(case, size, args.repeat))
+    print()
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
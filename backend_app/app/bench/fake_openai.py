@@ -0,0 +1,236 @@
+from __future__ import annotations
+import asyncio, base64, hashlib, json, os, random, struct, time
+from typing import Any, AsyncIterator, Dict, List
+from uuid import uuid4
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# ==================================================
+## スタンドインの設定（環境変数で子プロセスへ渡す）
+# ==================================================
+# 最初のトークンまでの遅延・トークン間隔（ミリ秒）と、1 回答あたりのトークン数
+TTFT_MS = float(os.getenv("BENCH_TTFT_MS", "300"))
+TOKEN_MS = float(os.getenv("BENCH_TOKEN_MS", "20"))
+TOKENS = int(os.getenv("BENCH_TOKENS", "200"))
+# 遅延のばらつき（0.2 なら ±20%）
+JITTER = float(os.getenv("BENCH_JITTER", "0.2"))
+# モデル名ごとの TTFT 倍率（例: "gpt-5-nano:0.5,gpt-5:2"）。ティア切り替えの挙動を見る用
+MODEL_TTFT_FACTORS = os.getenv("BENCH_MODEL_TTFT_FACTORS", "")
+# 埋め込み 1 リクエストあたりの遅延（ミリ秒）と、入力 1 件あたりの追加遅延
+EMBED_MS = float(os.getenv("BENCH_EMBED_MS", "50"))
+EMBED_PER_INPUT_MS = float(os.getenv("BENCH_EMBED_PER_INPUT_MS", "1"))
+EMBED_DIMS = int(os.getenv("BENCH_EMBED_DIMS", "1536"))
+# レート制限の再現（0 なら無制限）。1 分あたりのリクエスト数・トークン数を超えたら 429 を返し、
+# 応答には x-ratelimit-* ヘッダを付ける（モデルごとではなく全体で 1 つ）
+RATE_RPM = int(os.getenv("BENCH_OPENAI_RPM", "0"))
+RATE_TPM = int(os.getenv("BENCH_OPENAI_TPM", "0"))
+
+_WORDS = ["検索", "結果", "によると", "、", "研究", "の", "手法", "は", "有効", "です", "。", " [1]"]
+
+
+def _factors() -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for part in MODEL_TTFT_FACTORS.split(","):
+        name, _, f = part.partition(":")
+        if name.strip() and f.strip():
+            out[name.strip()] = float(f)
+    return out
+
+
+_TTFT_FACTORS = _factors()
+
+
+def _jitter(ms: float) -> float:
+    if ms <= 0:
+        return 0.0
+    return max(0.0, ms * (1 + random.uniform(-JITTER, JITTER))) / 1000.0
+
+
+def _event(payload: Dict[str, Any]) -> bytes:
+    return f"event: {payload['type']}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def _response_obj(resp_id: str, model: str, status: str, output: List[Dict], usage=None) -> Dict:
+    return {
+        "id": resp_id,
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": model,
+        "status": status,
+        "output": output,
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+        "temperature": 0,
+        "top_p": 1,
+        "text": {"format": {"type": "text"}},
+        "error": None,
+        "incomplete_details": None,
+        "instructions": None,
+        "metadata": {},
+        "usage": usage,
+    }
+
+
+# ==================================================
+## Responses API（stream=True のみ）
+# ==================================================
+async def _stream_response(model: str, n_input_chars: int) -> AsyncIterator[bytes]:
+    resp_id = f"resp_{uuid4().hex}"
+    msg_id = f"msg_{uuid4().hex}"
+    seq = iter(range(1_000_000))
+    ttft = _jitter(TTFT_MS * _TTFT_FACTORS.get(model, 1.0))
+
+    yield _event({"type": "response.created", "sequence_number": next(seq),
+                  "response": _response_obj(resp_id, model, "in_progress", [])})
+    yield _event({"type": "response.in_progress", "sequence_number": next(seq),
+                  "response": _response_obj(resp_id, model, "in_progress", [])})
+    await asyncio.sleep(ttft)
+
+    item = {"id": msg_id, "type": "message", "role": "assistant", "status": "in_progress", "content": []}
+    yield _event({"type": "response.output_item.added", "sequence_number": next(seq),
+                  "output_index": 0, "item": item})
+    yield _event({"type": "response.content_part.added", "sequence_number": next(seq),
+                  "item_id": msg_id, "output_index": 0, "content_index": 0,
+                  "part": {"type": "output_text", "text": "", "annotations": []}})
+
+    parts: List[str] = []
+    for i in range(TOKENS):
+        if i:
+            await asyncio.sleep(_jitter(TOKEN_MS))
+        delta = _WORDS[i % len(_WORDS)]
+        parts.append(delta)
+        yield _event({"type": "response.output_text.delta", "sequence_number": next(seq),
+                      "item_id": msg_id, "output_index": 0, "content_index": 0,
+                      "delta": delta, "logprobs": []})
+
+    text = "".join(parts)
+    part = {"type": "output_text", "text": text, "annotations": []}
+    done_item = {**item, "status": "completed", "content": [part]}
+    usage = {
+        "input_tokens": n_input_chars // 2,
+        "input_tokens_details": {"cached_tokens": 0},
+        "output_tokens": TOKENS,
+        "output_tokens_details": {"reasoning_tokens": 0},
+        "total_tokens": n_input_chars // 2 + TOKENS,
+    }
+    yield _event({"type": "response.output_text.done", "sequence_number": next(seq),
+                  "item_id": msg_id, "output_index": 0, "content_index": 0, "text": text, "logprobs": []})
+    yield _event({"type": "response.content_part.done", "sequence_number": next(seq),
+                  "item_id": msg_id, "output_index": 0, "content_index": 0, "part": part})
+    yield _event({"type": "response.output_item.done", "sequence_number": next(seq),
+                  "output_index": 0, "item": done_item})
+    yield _event({"type": "response.completed", "sequence_number": next(seq),
+                  "response": _response_obj(resp_id, model, "completed", [done_item], usage)})
+
+
+# ==================================================
+## Embeddings API（入力文字列から決定的なベクトルを作る）
+# ==================================================
+def _vector(text: str, dims: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    v = [rng.uniform(-1, 1) for _ in range(dims)]
+    norm = sum(x * x for x in v) ** 0.5 or 1.0
+    return [x / norm for x in v]
+
+
+class _RateLimit:
+    """1 分で満杯まで回復するバケット（リクエスト数・トークン数）"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm, self.tpm = rpm, tpm
+        self.req, self.tok = float(rpm), float(tpm)
+        self.at = time.monotonic()
+        self.rejected = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        dt = now - self.at
+        self.at = now
+        self.req = min(self.rpm, self.req + dt * self.rpm / 60.0)
+        self.tok = min(self.tpm, self.tok + dt * self.tpm / 60.0)
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-limit-tokens": str(self.tpm),
+            "x-ratelimit-remaining-requests": str(max(0, int(self.req))),
+            "x-ratelimit-remaining-tokens": str(max(0, int(self.tok))),
+            "x-ratelimit-reset-requests": f"{60.0 / self.rpm:.3f}s",
+            "x-ratelimit-reset-tokens": f"{max(0.0, -self.tok) * 60.0 / self.tpm:.3f}s",
+        }
+
+    def take(self, tokens: int):
+        """通れば None、超過なら 429 の応答"""
+        self._refill()
+        if self.req < 1 or self.tok < tokens:
+            self.rejected += 1
+            wait = max((1 - self.req) * 60.0 / self.rpm, (tokens - self.tok) * 60.0 / self.tpm, 0.0)
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={**self.headers(), "retry-after-ms": str(int(wait * 1000) + 1)},
+            )
+        self.req -= 1
+        self.tok -= tokens
+        return None
+
+
+def openai_router() -> APIRouter:
+    router = APIRouter(prefix="/v1")
+    limit = _RateLimit(RATE_RPM, RATE_TPM) if RATE_RPM and RATE_TPM else None
+
+    @router.get("/__rate_limit")
+    async def rate_limit_stats():
+        return {"rejected": limit.rejected if limit else 0}
+
+    @router.post("/responses")
+    async def responses(request: Request):
+        body = await request.json()
+        model = body.get("model") or "bench-model"
+        n_chars = len(json.dumps(body.get("input"), ensure_ascii=False))
+        headers = {}
+        if limit is not None:
+            rejected = limit.take(n_chars // 2 + TOKENS)
+            if rejected is not None:
+                return rejected
+            headers = limit.headers()
+        return StreamingResponse(
+            _stream_response(model, n_chars), media_type="text/event-stream", headers=headers
+        )
+
+    @router.post("/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body.get("input")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        dims = int(body.get("dimensions") or EMBED_DIMS)
+        n_tokens = sum(len(str(t)) for t in inputs) // 2
+        headers = {}
+        if limit is not None:
+            rejected = limit.take(n_tokens)
+            if rejected is not None:
+                return rejected
+            headers = limit.headers()
+        await asyncio.sleep(_jitter(EMBED_MS + EMBED_PER_INPUT_MS * len(inputs)))
+        data = []
+        for i, text in enumerate(inputs):
+            vec = _vector(str(text), dims)
+            if body.get("encoding_format") == "base64":
+                emb: Any = base64.b64encode(struct.pack(f"<{dims}f", *vec)).decode("ascii")
+            else:
+                emb = vec
+            data.append({"object": "embedding", "index": i, "embedding": emb})
+        return JSONResponse(
+            {
+                "object": "list",
+                "model": body.get("model"),
+                "data": data,
+                "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+            },
+            headers=headers,
+        )
+
+    return router
@@ -0,0 +1,717 @@
+from __future__ import annotations
+import asyncio, base64, os, random, time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+from uuid import uuid4
+
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import JSONResponse
+
+# ==================================================
+## スタンドインの設定（環境変数で子プロセスへ渡す）
+# ==================================================
+# PostgREST 1 リクエストあたりの遅延（ミリ秒）
+DB_MS = float(os.getenv("BENCH_DB_MS", "5"))
+# ベクトル検索 RPC の遅延（ミリ秒）。pgvector の探索分を上乗せする
+RPC_MATCH_MS = float(os.getenv("BENCH_RPC_MATCH_MS", "20"))
+# 検索ヒット件数と 1 件あたりの本文の文字数
+HITS = int(os.getenv("BENCH_HITS", "5"))
+HIT_CHARS = int(os.getenv("BENCH_HIT_CHARS", "800"))
+# 初期投入するスレッド数（thread-0 ... thread-N-1、すべて BENCH_PROJECT_ID に属する）
+SEED_THREADS = int(os.getenv("BENCH_THREADS", "64"))
+# Storage の保存・取得の遅延（ミリ秒）と、GoTrue の遅延（ミリ秒）
+STORAGE_MS = float(os.getenv("BENCH_STORAGE_MS", "10"))
+AUTH_MS = float(os.getenv("BENCH_AUTH_MS", "20"))
+# 初期データの ID（レスポンスモデルが UUID を要求するため UUID 形式）
+BENCH_PROJECT_ID = "00000000-0000-4000-8000-000000000001"
+BENCH_USER_ID = "00000000-0000-4000-8000-0000000000aa"
+BENCH_BUCKET = os.getenv("STORAGE_PRIVATE_BUCKET", "private")
+
+_FILLER = "研究支援のための生成AIとRAGによる検索拡張の評価データです。"
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+async def _delay(ms: float):
+    if ms > 0:
+        await asyncio.sleep(ms / 1000.0)
+
+
+# ==================================================
+## インメモリのテーブル
+# ==================================================
+class MemoryStore:
+    """PostgREST の代わりに使うテーブル群（スキーマは見ず、行は dict のまま持つ）"""
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        # RPC 名 → 処理（args）→ 返り値
+        self.rpcs: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+        # Storage: (バケット, パス) → バイト列
+        self.objects: Dict[tuple, bytes] = {}
+        self.buckets: Dict[str, Dict[str, Any]] = {}
+        self.seed()
+
+    def seed(self):
+        now = _now_iso()
+        self.tables.clear()
+        self.objects.clear()
+        self.tables["projects"] = [
+            {
+                "id": BENCH_PROJECT_ID,
+                "user_id": BENCH_USER_ID,
+                "name": "bench",
+                "overview": None,
+                "created_at": now,
+                "updated_at": now,
+            }
+        ]
+        self.tables["threads"] = [
+            {
+                "id": f"thread-{i}",
+                "project_id": BENCH_PROJECT_ID,
+                "name": f"bench thread {i}",
+                "created_at": now,
+                "updated_at": now,
+            }
+            for i in range(SEED_THREADS)
+        ]
+        self.tables["messages"] = []
+        self.tables["documents"] = []
+        self.tables["attachments"] = []
+        self.tables["lc_documents"] = []
+        self.buckets = {BENCH_BUCKET: _bucket(BENCH_BUCKET)}
+
+    def rows(self, table: str) -> List[Dict[str, Any]]:
+        return self.tables.setdefault(table, [])
+
+    def insert(self, table: str, row: Dict[str, Any], on_conflict: Optional[str]) -> Dict[str, Any]:
+        rows = self.rows(table)
+        keys = [k.strip() for k in (on_conflict or "").split(",") if k.strip()]
+        if keys and all(k in row for k in keys):
+            for existing in rows:
+                if all(existing.get(k) == row[k] for k in keys):
+                    existing.update(row)
+                    return existing
+        new = {"id": str(uuid4()), "created_at": _now_iso(), **row}
+        rows.append(new)
+        return new
+
+
+def _bucket(name: str, public: bool = False) -> Dict[str, Any]:
+    now = _now_iso()
+    return {
+        "id": name,
+        "name": name,
+        "owner": "",
+        "public": public,
+        "created_at": now,
+        "updated_at": now,
+        "file_size_limit": None,
+        "allowed_mime_types": None,
+    }
+
+
+def _cast(raw: str, sample: Any) -> Any:
+    # 比較相手の型に合わせる（数値列を文字列で比較しない）
+    if isinstance(sample, bool):
+        return raw.lower() == "true"
+    if isinstance(sample, (int, float)):
+        try:
+            return type(sample)(raw)
+        except ValueError:
+            return raw
+    return raw
+
+
+def _match(row: Dict[str, Any], col: str, spec: str) -> bool:
+    op, _, raw = spec.partition(".")
+    val = row.get(col)
+    if op == "is":
+        return val is None if raw == "null" else str(val).lower() == raw
+    if op == "in":
+        items = [s.strip().strip('"') for s in raw.strip("()").split(",") if s.strip()]
+        return str(val) in items
+    if op in ("like", "ilike"):
+        pat = raw.replace("*", "%").strip("%")
+        hay, needle = str(val or ""), pat
+        if op == "ilike":
+            hay, needle = hay.lower(), needle.lower()
+        return needle in hay
+    if val is None:
+        return False
+    other = _cast(raw, val)
+    try:
+        return {
+            "eq": val == other,
+            "neq": val != other,
+            "gt": val > other,
+            "gte": val >= other,
+            "lt": val < other,
+            "lte": val <= other,
+        }.get(op, True)
+    except TypeError:
+        return False
+
+
+_RESERVED = {"select", "limit", "offset", "order", "on_conflict", "columns"}
+
+
+def _filter(rows: List[Dict[str, Any]], params) -> List[Dict[str, Any]]:
+    conds = [(k, v) for k, v in params.multi_items() if k not in _RESERVED]
+    out = [r for r in rows if all(_match(r, c, s) for c, s in conds)]
+    order = params.get("order")
+    if order:
+        col, _, direction = order.split(",")[0].partition(".")
+        out.sort(key=lambda r: str(r.get(col) or ""), reverse=direction.startswith("desc"))
+    offset = int(params.get("offset") or 0)
+    limit = params.get("limit")
+    out = out[offset:]
+    if limit is not None:
+        out = out[: int(limit)]
+    return out
+
+
+def _wants_representation(request: Request) -> bool:
+    return "return=representation" in (request.headers.get("prefer") or "")
+
+
+# ==================================================
+## ベクトル検索 RPC（ランダムな本文と類似度を返す）
+# ==================================================
+def _fake_hits(document_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    body = (_FILLER * (HIT_CHARS // len(_FILLER) + 1))[:HIT_CHARS]
+    ids = document_ids or [f"doc-{i}" for i in range(max(HITS, 1))]
+    hits = []
+    for i in range(HITS):
+        doc_id = ids[i % len(ids)]
+        hits.append(
+            {
+                "id": str(uuid4()),
+                "document_id": doc_id,
+                "chunk_index": i,
+                "text": body,
+                "metadata": {"title": f"bench-{i}.pdf", "source": f"bench/{doc_id}", "page": i + 1},
+                "similarity": round(random.uniform(0.7, 0.95), 4),
+            }
+        )
+    return hits
+
+
+def _register_match_rpcs(store: MemoryStore):
+    store.rpcs["match_documents_scoped"] = lambda args: _fake_hits()
+    store.rpcs["match_by_document_ids"] = lambda args: _fake_hits(args.get("in_document_ids"))
+    store.rpcs["match_documents"] = lambda args: _fake_hits()
+    store.rpcs["embedding_config"] = lambda args: [
+        {"dims": int(os.getenv("BENCH_EMBED_DIMS", "1536")), "storage": os.getenv("BENCH_EMBED_STORAGE", "vector")}
+    ]
+
+
+# ==================================================
+## アプリ固有の RPC（app_data.sql の関数を最小限に模したもの。権限は常に許可）
+# ==================================================
+def _register_app_rpcs(store: MemoryStore):
+    def create_project(args):
+        now = _now_iso()
+        row = {
+            "id": str(uuid4()),
+            "user_id": BENCH_USER_ID,
+            "name": args.get("name"),
+            "overview": args.get("overview"),
+            "created_at": now,
+            "updated_at": now,
+        }
+        store.rows("projects").append(row)
+        return row
+
+    def add_attachment(args):
+        return store.insert(
+            "attachments",
+            {
+                "storage_path": args.get("in_storage_path"),
+                "mime": args.get("in_mime"),
+                "size": args.get("in_size"),
+                "title": args.get("in_title"),
+                "project_id": args.get("in_project_id"),
+                "thread_id": args.get("in_thread_id"),
+                "owner_user_id": BENCH_USER_ID,
+            },
+            None,
+        )
+
+    def add_attachments(args):
+        return [
+            add_attachment({
+                "in_storage_path": it.get("storage_path"),
+                "in_mime": it.get("mime"),
+                "in_size": it.get("size"),
+                "in_title": it.get("title"),
+                "in_project_id": args.get("in_project_id"),
+                "in_thread_id": args.get("in_thread_id"),
+            })
+            for it in args.get("in_items") or []
+        ]
+
+    def reassign_attachment(args):
+        for r in store.rows("attachments"):
+            if r["id"] == args.get("in_id"):
+                for col in ("project_id", "thread_id", "title"):
+                    if args.get(f"in_{col}") is not None:
+                        r[col] = args[f"in_{col}"]
+                return r
+        return None
+
+    def delete_attachment(args):
+        store.tables["attachments"] = [
+            r for r in store.rows("attachments") if r["id"] != args.get("in_id")
+        ]
+        return None
+
+    def admin_list_users(args):
+        now = _now_iso()
+        return [
+            {
+                "id": f"00000000-0000-4000-8000-{i:012d}",
+                "email": f"user{i}@example.com",
+                "created_at": now,
+                "last_sign_in_at": now,
+                "name": f"user{i}",
+                "role": "user",
+            }
+            for i in range(50)
+        ]
+
+    # ---- 永続ジョブキュー（app.jobs）----
+    def _job(job_id):
+        return next((r for r in store.rows("jobs") if r["id"] == job_id), None)
+
+    def claim_jobs(args):
+        now = time.time()
+        limit = int(args.get("in_limit") or 1)
+        running = sum(1 for r in store.rows("jobs") if r.get("status") == "running")
+        if args.get("in_max_running"):
+            limit = min(limit, int(args["in_max_running"]) - running)
+        ready = [
+            r
+            for r in store.rows("jobs")
+            if r.get("kind") in (args.get("in_kinds") or [])
+            and r.get("status", "queued") == "queued"
+            and r.get("_run_at", 0) <= now
+        ]
+        ready.sort(key=lambda r: (-(r.get("priority") or 0), r["created_at"]))
+        claimed = []
+        for r in ready[: max(limit, 0)]:
+            r.update(
+                status="running",
+                attempts=(r.get("attempts") or 0) + 1,
+                locked_by=args.get("in_worker"),
+                _locked_until=now + int(args.get("in_lease_sec") or 60),
+            )
+            claimed.append({k: v for k, v in r.items() if not k.startswith("_")})
+        return claimed
+
+    def heartbeat_job(args):
+        r = _job(args.get("in_id"))
+        if not r or r.get("status") != "running" or r.get("locked_by") != args.get("in_worker"):
+            return False
+        r["_locked_until"] = time.time() + int(args.get("in_lease_sec") or 60)
+        return True
+
+    def finish_job(args):
+        r = _job(args.get("in_id"))
+        if not r or r.get("locked_by") != args.get("in_worker"):
+            return False
+        r.update(status="succeeded", result=args.get("in_result"), locked_by=None, finished_at=_now_iso())
+        return True
+
+    def fail_job(args):
+        r = _job(args.get("in_id"))
+        if not r or r.get("locked_by") != args.get("in_worker"):
+            return None
+        retry = (r.get("attempts") or 0) < (r.get("max_attempts") or 1)
+        r.update(
+            status="queued" if retry else "failed",
+            last_error=args.get("in_error"),
+            locked_by=None,
+            _run_at=time.time() + int(args.get("in_retry_in_sec") or 0),
+        )
+        return r["status"]
+
+    # ---- 差分再取り込み ----
+    def reconcile_chunks(args):
+        doc_id = args.get("in_document_id")
+        updates = {
+            i: (idx, page)
+            for i, idx, page in zip(
+                args.get("in_keep_ids") or [],
+                args.get("in_keep_index") or [],
+                args.get("in_keep_page") or [],
+            )
+        }
+        extra = {k: args[f"in_{k}"] for k in ("title", "source") if args.get(f"in_{k}") is not None}
+        for r in store.rows("chunks"):
+            if r.get("document_id") == doc_id and r["id"] in updates:
+                r["chunk_index"], page = updates[r["id"]]
+                r["meta"] = {**(r.get("meta") or {}), "page": page, **extra}
+        drop = set(args.get("in_delete_ids") or [])
+        before = len(store.rows("chunks"))
+        store.tables["chunks"] = [
+            r for r in store.rows("chunks") if not (r.get("document_id") == doc_id and r["id"] in drop)
+        ]
+        return before - len(store.rows("chunks"))
+
+    def adopt_document(args):
+        docs = [d for d in store.rows("documents") if d.get("attachment_id") == args.get("in_from_attachment_id")]
+        if not docs:
+            return None
+        doc = max(docs, key=lambda d: d["created_at"])
+        doc.update(attachment_id=args.get("in_to_attachment_id"), status="stale")
+        return doc["id"]
+
+    # ---- 取り込みの冪等化・リース ----
+    def begin_ingest(args):
+        att = next((a for a in store.rows("attachments") if a["id"] == args.get("in_attachment_id")), None)
+        if att is None:
+            return JSONResponse(status_code=400, content={"message": "attachment not found"})
+        now = time.time()
+        worker = args.get("in_worker")
+        lease = now + int(args.get("in_lease_sec") or 600)
+        docs = [d for d in store.rows("documents") if d.get("attachment_id") == att["id"]]
+        if not docs:
+            doc = store.insert(
+                "documents",
+                {
+                    "attachment_id": att["id"],
+                    "owner_user_id": att.get("owner_user_id"),
+                    "project_id": att.get("project_id"),
+                    "thread_id": att.get("thread_id"),
+                    "title": att.get("title") or "Untitled",
+                    "status": "ingesting",
+                    "meta": {"source": att.get("storage_path")},
+                    "ingest_locked_by": worker,
+                    "_locked_until": lease,
+                },
+                None,
+            )
+            return [{"document_id": doc["id"], "state": "acquired", "prev_key": None}]
+        doc = max(docs, key=lambda d: d["created_at"])
+        row = {"document_id": doc["id"], "prev_key": doc.get("ingest_key")}
+        if doc.get("status") == "ready" and doc.get("ingest_key") == args.get("in_ingest_key"):
+            return [{**row, "state": "done"}]
+        if doc.get("ingest_locked_by") not in (None, worker) and doc.get("_locked_until", 0) > now:
+            return [{**row, "state": "busy"}]
+        doc.update(ingest_locked_by=worker, _locked_until=lease)
+        return [{**row, "state": "acquired"}]
+
+    def end_ingest(args):
+        doc = next((d for d in store.rows("documents") if d["id"] == args.get("in_document_id")), None)
+        if not doc or doc.get("ingest_locked_by") != args.get("in_worker"):
+            return False
+        key = args.get("in_ingest_key")
+        if key:
+            doc.update(status="ready", ingest_key=key)
+        elif doc.get("status") == "ingesting":
+            doc["status"] = "failed"
+        doc.update(ingest_locked_by=None, _locked_until=0)
+        return True
+
+    store.rpcs.update(
+        {
+            "begin_ingest": begin_ingest,
+            "end_ingest": end_ingest,
+            "reconcile_chunks": reconcile_chunks,
+            "adopt_document": adopt_document,
+            "claim_jobs": claim_jobs,
+            "heartbeat_job": heartbeat_job,
+            "finish_job": finish_job,
+            "fail_job": fail_job,
+            "create_project": create_project,
+            "add_attachment": add_attachment,
+            "add_attachments": add_attachments,
+            "reassign_attachment": reassign_attachment,
+            "delete_attachment": delete_attachment,
+            "admin_list_users": admin_list_users,
+            "is_admin_or_superuser": lambda args: True,
+            "is_superuser": lambda args: True,
+            "count_superusers": lambda args: 2,
+            "check_thread_writable": lambda args: True,
+        }
+    )
+
+
+# ==================================================
+## PostgREST（/rest/v1）
+# ==================================================
+def postgrest_router(store: MemoryStore) -> APIRouter:
+    router = APIRouter(prefix="/rest/v1")
+    _register_match_rpcs(store)
+    _register_app_rpcs(store)
+
+    @router.post("/rpc/{fn}")
+    async def rpc(fn: str, request: Request):
+        args = await request.json() if await request.body() else {}
+        await _delay(DB_MS + (RPC_MATCH_MS if fn.startswith("match_") else 0))
+        handler = store.rpcs.get(fn)
+        if handler is None:
+            return JSONResponse(
+                status_code=404,
+                content={"code": "PGRST202", "message": f"function {fn} not found"},
+            )
+        return handler(args or {})
+
+    @router.get("/{table}")
+    async def select(table: str, request: Request):
+        await _delay(DB_MS)
+        return _filter(store.rows(table), request.query_params)
+
+    @router.post("/{table}")
+    async def insert(table: str, request: Request):
+        await _delay(DB_MS)
+        body = await request.json()
+        on_conflict = request.query_params.get("on_conflict")
+        rows = [store.insert(table, r, on_conflict) for r in (body if isinstance(body, list) else [body])]
+        if _wants_representation(request):
+            return JSONResponse(status_code=201, content=rows)
+        return Response(status_code=201)
+
+    @router.patch("/{table}")
+    async def update(table: str, request: Request):
+        await _delay(DB_MS)
+        patch = await request.json()
+        hit = _filter(store.rows(table), request.query_params)
+        for r in hit:
+            r.update(patch)
+        if _wants_representation(request):
+            return hit
+        return Response(status_code=204)
+
+    @router.delete("/{table}")
+    async def delete(table: str, request: Request):
+        await _delay(DB_MS)
+        hit = _filter(store.rows(table), request.query_params)
+        ids = {id(r) for r in hit}
+        store.tables[table] = [r for r in store.rows(table) if id(r) not in ids]
+        if _wants_representation(request):
+            return hit
+        return Response(status_code=204)
+
+    return router
+
+
+# ==================================================
+## Storage（/storage/v1）。storage3 SDK が使うエンドポイントのみ
+# ==================================================
+def storage_router(store: MemoryStore) -> APIRouter:
+    router = APIRouter(prefix="/storage/v1")
+
+    def _not_found(what: str) -> JSONResponse:
+        return JSONResponse(
+            status_code=404, content={"statusCode": "404", "error": "not_found", "message": what}
+        )
+
+    @router.get("/bucket/{bucket_id}")
+    async def get_bucket(bucket_id: str):
+        await _delay(STORAGE_MS)
+        b = store.buckets.get(bucket_id)
+        return b if b else _not_found("Bucket not found")
+
+    @router.post("/bucket")
+    async def create_bucket(request: Request):
+        await _delay(STORAGE_MS)
+        body = await request.json()
+        name = body.get("id") or body.get("name")
+        store.buckets.setdefault(name, _bucket(name, bool(body.get("public"))))
+        return {"name": name}
+
+    # 署名 URL（/object/{bucket}/{path} より先に登録する）
+    @router.post("/object/sign/{bucket}")
+    async def sign_many(bucket: str, request: Request):
+        await _delay(STORAGE_MS)
+        body = await request.json()
+        return [
+            {"path": p, "signedURL": f"/object/sign/{bucket}/{p}?token=bench", "error": None}
+            if (bucket, p) in store.objects
+            else {"path": p, "signedURL": None, "error": "Either the object does not exist or you do not have access to it"}
+            for p in body.get("paths") or []
+        ]
+
+    @router.post("/object/sign/{bucket}/{path:path}")
+    async def sign(bucket: str, path: str):
+        await _delay(STORAGE_MS)
+        if (bucket, path) not in store.objects:
+            return _not_found("Object not found")
+        return {"signedURL": f"/object/sign/{bucket}/{path}?token=bench"}
+
+    # 署名つきアップロード URL（直接アップロード）。発行した token 1 つにつき 1 オブジェクト
+    upload_tokens: Dict[str, tuple] = {}
+
+    @router.post("/object/upload/sign/{bucket}/{path:path}")
+    async def sign_upload(bucket: str, path: str):
+        await _delay(STORAGE_MS)
+        token = uuid4().hex
+        upload_tokens[token] = (bucket, path)
+        return {"url": f"/object/upload/sign/{bucket}/{path}?token={token}"}
+
+    @router.put("/object/upload/sign/{bucket}/{path:path}")
+    async def upload_signed(bucket: str, path: str, token: str, request: Request):
+        if upload_tokens.get(token) != (bucket, path):
+            return JSONResponse(status_code=400, content={"statusCode": "403", "message": "invalid signature"})
+        data = await request.body()
+        await _delay(STORAGE_MS)
+        if (bucket, path) in store.objects:
+            return JSONResponse(
+                status_code=400,
+                content={"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"},
+            )
+        store.objects[(bucket, path)] = data
+        return {"Key": f"{bucket}/{path}"}
+
+    @router.head("/object/authenticated/{bucket}/{path:path}")
+    async def object_head(bucket: str, path: str):
+        await _delay(STORAGE_MS)
+        data = store.objects.get((bucket, path))
+        if data is None:
+            return Response(status_code=400)
+        return Response(content=data, media_type="application/octet-stream")
+
+    @router.post("/object/{bucket}/{path:path}")
+    async def upload(bucket: str, path: str, request: Request):
+        if (request.headers.get("content-type") or "").startswith("multipart/"):
+            form = await request.form()
+            f = form.get("file")
+            data = await f.read() if hasattr(f, "read") else str(f or "").encode("utf-8")
+        else:
+            data = await request.body()  # 本文をそのまま送る方式（ストリーミング・アップロード）
+        await _delay(STORAGE_MS)
+        if (bucket, path) in store.objects and request.headers.get("x-upsert") != "true":
+            return JSONResponse(
+                status_code=400,
+                content={"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"},
+            )
+        store.objects[(bucket, path)] = data
+        return {"Key": f"{bucket}/{path}"}
+
+    # TUS（再開可能アップロード）: 作成 → PATCH で追記 → 最後まで届いたらオブジェクトにする
+    uploads: Dict[str, Dict[str, Any]] = {}
+
+    @router.post("/upload/resumable")
+    async def tus_create(request: Request):
+        await _delay(STORAGE_MS)
+        meta = {}
+        for item in (request.headers.get("upload-metadata") or "").split(","):
+            key, _, val = item.strip().partition(" ")
+            meta[key] = base64.b64decode(val).decode() if val else ""
+        key = (meta.get("bucketName"), meta.get("objectName"))
+        if key in store.objects and request.headers.get("x-upsert") != "true":
+            return JSONResponse(status_code=409, content={"statusCode": "409", "message": "The resource already exists"})
+        upload_id = uuid4().hex
+        uploads[upload_id] = {"key": key, "length": int(request.headers["upload-length"]), "data": bytearray()}
+        return Response(
+            status_code=201,
+            headers={"Location": f"/storage/v1/upload/resumable/{upload_id}", "Tus-Resumable": "1.0.0"},
+        )
+
+    @router.head("/upload/resumable/{upload_id}")
+    async def tus_head(upload_id: str):
+        u = uploads.get(upload_id)
+        if u is None:
+            return Response(status_code=404)
+        return Response(headers={"Upload-Offset": str(len(u["data"])), "Upload-Length": str(u["length"])})
+
+    @router.patch("/upload/resumable/{upload_id}")
+    async def tus_patch(upload_id: str, request: Request):
+        u = uploads.get(upload_id)
+        if u is None:
+            return Response(status_code=404)
+        if int(request.headers.get("upload-offset", -1)) != len(u["data"]):
+            return Response(status_code=409)
+        u["data"] += await request.body()
+        await _delay(STORAGE_MS)
+        if len(u["data"]) >= u["length"]:
+            store.objects[u["key"]] = bytes(u["data"])
+        return Response(status_code=204, headers={"Upload-Offset": str(len(u["data"]))})
+
+    @router.get("/object/{bucket}/{path:path}")
+    async def download(bucket: str, path: str):
+        await _delay(STORAGE_MS)
+        data = store.objects.get((bucket, path))
+        if data is None:
+            return _not_found("Object not found")
+        return Response(content=data, media_type="application/octet-stream")
+
+    return router
+
+
+# ==================================================
+## GoTrue（/auth/v1）。パスワードは検査せず、メールアドレスからトークンを作る
+# ==================================================
+def gotrue_router() -> APIRouter:
+    router = APIRouter(prefix="/auth/v1")
+
+    def _user(email: str) -> Dict[str, Any]:
+        return {
+            "id": BENCH_USER_ID,
+            "aud": "authenticated",
+            "role": "authenticated",
+            "email": email,
+            "created_at": _now_iso(),
+        }
+
+    def _session(email: str) -> Dict[str, Any]:
+        return {
+            "access_token": f"bench-access.{email}",
+            "refresh_token": f"bench-refresh.{email}",
+            "token_type": "bearer",
+            "expires_in": 3600,
+            "user": _user(email),
+        }
+
+    @router.post("/token")
+    async def token(request: Request):
+        await _delay(AUTH_MS)
+        body = await request.json()
+        if request.query_params.get("grant_type") == "refresh_token":
+            email = str(body.get("refresh_token", "")).partition(".")[2] or "bench@example.com"
+        else:
+            email = body.get("email") or "bench@example.com"
+        return _session(email)
+
+    @router.get("/user")
+    async def user(request: Request):
+        await _delay(AUTH_MS)
+        auth = request.headers.get("authorization") or ""
+        email = auth.partition(".")[2]
+        if not email:
+            return JSONResponse(status_code=401, content={"msg": "invalid token"})
+        return _user(email)
+
+    @router.post("/admin/users")
+    async def admin_create_user(request: Request):
+        await _delay(AUTH_MS)
+        body = await request.json()
+        return {**_user(body.get("email") or "new@example.com"), "id": str(uuid4())}
+
+    @router.delete("/admin/users/{user_id}")
+    async def admin_delete_user(user_id: str):
+        await _delay(AUTH_MS)
+        return {}
+
+    return router
+
+
+# 計測中に溜まった行を初期状態に戻す（レベル間で messages が膨らまないように）
+def reset_router(store: MemoryStore) -> APIRouter:
+    router = APIRouter(prefix="/__bench")
+
+    @router.post("/reset")
+    async def reset():
+        store.seed()
+        return {"ok": True, "at": time.time()}
+
+    @router.get("/counts")
+    async def counts():
+        return {t: len(rows) for t, rows in store.tables.items()}
+
+    return router
@@ -0,0 +1,172 @@
+# 抽出器ベンチマーク用のフィクスチャ生成
+# 乱数は固定シードなので、同じ名前のフィクスチャは常に同じ内容になる（生成結果はディスクにキャッシュ）
+from __future__ import annotations
+import csv, io, json, os, random, tempfile
+from typing import Callable, Dict
+
+# 生成したフィクスチャの置き場所
+FIXTURE_DIR = os.getenv(
+    "BENCH_FIXTURE_DIR", os.path.join(tempfile.gettempdir(), "bench_fixtures")
+)
+
+_JA = [
+    "本研究では検索拡張生成（RAG）の応答品質を評価した。",
+    "実験の結果、チャンクサイズが小さいほど再現率が向上した。",
+    "一方で、文脈の断片化により回答の一貫性が低下する傾向が見られた。",
+    "今後の課題として、文境界を考慮した分割手法の検討が挙げられる。",
+    "表1に各手法の平均応答時間と正答率を示す。",
+]
+_EN = [
+    "Retrieval augmented generation combines a retriever with a language model.",
+    "We measured latency, recall at k and answer faithfulness on three datasets.",
+    "The embedding model maps each chunk to a 1536 dimensional vector.",
+    "Chunk overlap trades index size for robustness at chunk boundaries.",
+]
+
+
+def _paragraph(rng: random.Random, n_sentences: int = 6) -> str:
+    return "".join(rng.choice(_JA + _EN) + ("" if rng.random() < 0.7 else "\n") for _ in range(n_sentences))
+
+
+def _text_of_size(rng: random.Random, n_bytes: int) -> str:
+    parts, size = [], 0
+    while size < n_bytes:
+        p = _paragraph(rng) + "\n\n"
+        parts.append(p)
+        size += len(p.encode("utf-8"))
+    return "".join(parts)
+
+
+# ==================================================
+## 形式ごとの生成器
+# ==================================================
+def make_pdf(pages: int) -> bytes:
+    import fitz  # PyMuPDF
+
+    rng = random.Random(pages)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 545, 420), _paragraph(rng, 12), fontname="japan", fontsize=9)
+        page.insert_textbox(fitz.Rect(50, 430, 545, 800), " ".join(rng.choice(_EN) for _ in range(10)), fontname="helv", fontsize=9)
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+
+def make_docx(paragraphs: int) -> bytes:
+    from docx import Document as DocxDocument
+
+    rng = random.Random(paragraphs)
+    doc = DocxDocument()
+    for i in range(paragraphs):
+        if i % 50 == 0:
+            doc.add_heading(f"第{i // 50 + 1}章", level=1)
+        doc.add_paragraph(_paragraph(rng, 4))
+    for _ in range(max(1, paragraphs // 200)):
+        table = doc.add_table(rows=10, cols=4)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = f"{rng.random():.4f}"
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+
+def make_pptx(slides: int) -> bytes:
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    rng = random.Random(slides)
+    prs = Presentation()
+    layout = prs.slide_layouts[1]  # タイトル + 本文
+    for i in range(slides):
+        s = prs.slides.add_slide(layout)
+        s.shapes.title.text = f"スライド {i + 1}"
+        s.placeholders[1].text = _paragraph(rng, 5)
+        if i % 5 == 0:
+            shape = s.shapes.add_table(4, 3, Inches(1), Inches(5), Inches(6), Inches(1.5))
+            for row in shape.table.rows:
+                for cell in row.cells:
+                    cell.text = f"{rng.randint(0, 9999)}"
+    bio = io.BytesIO()
+    prs.save(bio)
+    return bio.getvalue()
+
+
+def make_html(n_bytes: int) -> bytes:
+    rng = random.Random(n_bytes)
+    parts, size = ["<html><head><title>bench</title><style>p{margin:0}</style></head><body>"], 0
+    while size < n_bytes:
+        block = (
+            f"<div class='section'><h2>{rng.choice(_EN)}</h2>"
+            f"<p>{_paragraph(rng)}</p><ul><li>{rng.choice(_JA)}</li><li>{rng.choice(_EN)}</li></ul>"
+            f"<script>var x{size} = {rng.random()};</script></div>\n"
+        )
+        parts.append(block)
+        size += len(block.encode("utf-8"))
+    parts.append("</body></html>")
+    return "".join(parts).encode("utf-8")
+
+
+def make_json(n_bytes: int) -> bytes:
+    rng = random.Random(n_bytes)
+    rows, size = [], 0
+    while size < n_bytes:
+        row = {"id": len(rows), "title": rng.choice(_EN), "body": _paragraph(rng, 3), "score": rng.random(), "tags": ["rag", "bench"]}
+        rows.append(row)
+        size += len(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+    return json.dumps(rows, ensure_ascii=False).encode("utf-8")
+
+
+def make_csv(n_bytes: int) -> bytes:
+    rng = random.Random(n_bytes)
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["id", "title", "body", "value"])
+    i = 0
+    while buf.tell() < n_bytes:
+        w.writerow([i, rng.choice(_EN), rng.choice(_JA), f"{rng.random():.6f}"])
+        i += 1
+    return buf.getvalue().encode("utf-8")
+
+
+def make_text(n_bytes: int) -> bytes:
+    return _text_of_size(random.Random(n_bytes), n_bytes).encode("utf-8")
+
+
+def make_text_ja(n_bytes: int) -> bytes:
+    # 段落の区切り（空行）も空白も無い和文だけの本文（PDF から抽出した日本語文書に近い）。
+    # 文字数基準の再帰分割が 1 文字単位の分割まで降りる、分割器にとっての最悪ケース
+    rng = random.Random(n_bytes)
+    parts, size = [], 0
+    while size < n_bytes:
+        s = rng.choice(_JA)
+        parts.append(s)
+        size += len(s.encode("utf-8"))
+    return "".join(parts).encode("utf-8")
+
+
+MAKERS: Dict[str, Callable[[int], bytes]] = {
+    "pdf": make_pdf,
+    "docx": make_docx,
+    "pptx": make_pptx,
+    "html": make_html,
+    "json": make_json,
+    "csv": make_csv,
+    "txt": make_text,
+    "txt_ja": make_text_ja,
+}
+
+
+def fixture_path(kind: str, size: int) -> str:
+    """フィクスチャを生成（キャッシュ済みなら再利用）してパスを返す"""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    path = os.path.join(FIXTURE_DIR, f"{kind}_{size}.{kind}")
+    if not os.path.exists(path):
+        data = MAKERS[kind](size)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return path
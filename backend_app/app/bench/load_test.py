@@ -0,0 +1,261 @@
+# 全ルータ（auth / projects / threads / messages / files / attachments / admin / chat）の負荷試験
+# PostgREST / Storage / GoTrue / OpenAI はローカルのスタンドインに置き換える
+#
+#   cd backend_app/app
+#   python -m bench.load_test --users 32 --duration 30 --mix full:3,browse:5,manage:1,files:1,admin:1
+#
+# 出力: エンドポイント別の件数 / RPS / エラー率 / p50・p95・p99
+# --max-p95-ms / --max-error-rate / --baseline を指定すると、超過時に終了コード 1 を返す（デプロイ前の検査用）
+# 注意: アップロード後のバックグラウンド取り込みは、チャンク分割に tiktoken のエンコーディングを使う。
+#       オフラインでは事前に取得したものを TIKTOKEN_CACHE_DIR で渡すこと（無いと文字種からの見積もりで分割する）
+from __future__ import annotations
+import argparse, asyncio, json, random, sys, time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+
+from bench.common import ServerProcess, app_env, fmt_ms, free_port, print_table, summarize
+from bench.scenarios import DEFAULT_MIX, SCENARIOS, parse_mix
+
+
+@dataclass
+class EndpointStats:
+    latencies: List[float] = field(default_factory=list)
+    errors: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, latency: float, error: Optional[str]):
+        self.latencies.append(latency)
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    @property
+    def count(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def n_errors(self) -> int:
+        return sum(self.errors.values())
+
+
+class Recorder:
+    def __init__(self):
+        self.by_endpoint: Dict[str, EndpointStats] = {}
+        self.iterations: Dict[str, int] = {}
+
+    def add(self, name: str, latency: float, error: Optional[str]):
+        self.by_endpoint.setdefault(name, EndpointStats()).add(latency, error)
+
+
+async def _virtual_user(
+    vu: int,
+    app_url: str,
+    mix: List[tuple],
+    rec: Recorder,
+    *,
+    deadline: float,
+    start_delay: float,
+    think: float,
+    timeout: float,
+    upload_kb: int,
+):
+    await asyncio.sleep(start_delay)
+    names = [n for n, _ in mix]
+    weights = [w for _, w in mix]
+    rng = random.Random(vu)
+    # 仮想ユーザごとに cookie jar を分ける
+    async with httpx.AsyncClient(base_url=app_url, timeout=timeout) as client:
+        it = 0
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(names, weights)[0]
+            ctx = {"vu": vu, "iter": it, "upload_kb": upload_kb}
+            for name, step in SCENARIOS[scenario]:
+                t0 = time.perf_counter()
+                error = None
+                try:
+                    r = await step(client, ctx)
+                    if r.status_code >= 400:
+                        error = f"http_{r.status_code}"
+                    elif ctx.pop("stream_error", None):
+                        error = "stream_error"
+                except (httpx.HTTPError, KeyError, ValueError) as e:
+                    error = type(e).__name__
+                rec.add(name, time.perf_counter() - t0, error)
+                if error:
+                    break  # 後続ステップは前の結果（ID など）に依存するので打ち切る
+                if think:
+                    await asyncio.sleep(rng.uniform(0, 2 * think))
+            rec.iterations[scenario] = rec.iterations.get(scenario, 0) + 1
+            it += 1
+
+
+def build_report(rec: Recorder, elapsed: float, lag: Dict) -> Dict:
+    endpoints = {}
+    for name, st in sorted(rec.by_endpoint.items()):
+        endpoints[name] = {
+            "count": st.count,
+            "errors": st.n_errors,
+            "error_rate": st.n_errors / st.count if st.count else 0.0,
+            "rps": st.count / elapsed if elapsed else None,
+            "latency": summarize(st.latencies),
+            "error_kinds": st.errors,
+        }
+    total = sum(e["count"] for e in endpoints.values())
+    errors = sum(e["errors"] for e in endpoints.values())
+    return {
+        "elapsed_sec": elapsed,
+        "requests": total,
+        "rps": total / elapsed if elapsed else None,
+        "error_rate": errors / total if total else 0.0,
+        "iterations": rec.iterations,
+        "endpoints": endpoints,
+        "loop_lag": lag,
+    }
+
+
+def print_report(report: Dict):
+    print()
+    rows = []
+    for name, e in report["endpoints"].items():
+        lat = e["latency"]
+        rows.append([
+            name, str(e["count"]), f"{e['rps']:.1f}", f"{e['error_rate'] * 100:.1f}%",
+            fmt_ms(lat["p50"]), fmt_ms(lat["p95"]), fmt_ms(lat["p99"]), fmt_ms(lat["max"]),
+        ])
+    print_table(["endpoint", "count", "rps", "errors", "p50", "p95", "p99", "max"], rows)
+    print(
+        f"\ntotal: {report['requests']} requests in {report['elapsed_sec']:.1f}s "
+        f"({report['rps']:.1f} rps), error rate {report['error_rate'] * 100:.2f}%  (時間は ms)"
+    )
+    lag = report["loop_lag"]
+    print(f"event loop lag (app): p99={fmt_ms(lag.get('p99'))}ms max={fmt_ms(lag.get('max'))}ms")
+    print(f"iterations: {report['iterations']}")
+    for name, e in report["endpoints"].items():
+        for kind, n in e["error_kinds"].items():
+            print(f"  {name}: {kind} x{n}")
+
+
+def check_thresholds(report: Dict, args) -> List[str]:
+    """閾値・ベースラインとの比較。違反内容の一覧を返す"""
+    problems = []
+    for name, e in report["endpoints"].items():
+        p95 = e["latency"]["p95"]
+        if args.max_p95_ms and p95 is not None and p95 * 1000 > args.max_p95_ms:
+            problems.append(f"{name}: p95 {p95 * 1000:.1f}ms > {args.max_p95_ms}ms")
+        if args.max_error_rate is not None and e["error_rate"] > args.max_error_rate:
+            problems.append(f"{name}: error rate {e['error_rate']:.3f} > {args.max_error_rate}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)["report"]
+        tol = args.tolerance
+        for name, b in base["endpoints"].items():
+            e = report["endpoints"].get(name)
+            if not e:
+                continue
+            bp95, p95 = b["latency"]["p95"], e["latency"]["p95"]
+            if bp95 and p95 and p95 > bp95 * (1 + tol):
+                problems.append(f"{name}: p95 {p95 * 1000:.1f}ms vs baseline {bp95 * 1000:.1f}ms")
+        if base.get("rps") and report["rps"] < base["rps"] * (1 - tol):
+            problems.append(f"total rps {report['rps']:.1f} vs baseline {base['rps']:.1f}")
+    return problems
+
+
+def _parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Load test for every router (offline stand-ins)")
+    p.add_argument("--users", type=int, default=16, help="仮想ユーザ数")
+    p.add_argument("--duration", type=float, default=20.0, help="計測時間（秒）")
+    p.add_argument("--ramp", type=float, default=2.0, help="全ユーザが開始するまでの時間（秒）")
+    p.add_argument("--think-ms", type=float, default=0.0, help="ステップ間の平均待ち時間")
+    p.add_argument("--mix", default=DEFAULT_MIX, help=f"シナリオと重み（{', '.join(SCENARIOS)}）")
+    p.add_argument("--upload-kb", type=int, default=64)
+    p.add_argument("--timeout", type=float, default=60.0)
+    # スタンドインの遅延
+    p.add_argument("--db-ms", type=float, default=5)
+    p.add_argument("--storage-ms", type=float, default=10)
+    p.add_argument("--auth-ms", type=float, default=20)
+    p.add_argument("--embed-ms", type=float, default=50)
+    p.add_argument("--ttft-ms", type=float, default=300)
+    p.add_argument("--token-ms", type=float, default=20)
+    p.add_argument("--tokens", type=int, default=100)
+    # 既に起動しているサーバを使う場合
+    p.add_argument("--app-url", default="")
+    p.add_argument("--stand-in-url", default="")
+    # 結果と合否判定
+    p.add_argument("--json", default="", help="結果を JSON で書き出すパス（--baseline に使える）")
+    p.add_argument("--max-p95-ms", type=float, default=0.0)
+    p.add_argument("--max-error-rate", type=float, default=None)
+    p.add_argument("--baseline", default="", help="以前の --json 出力と比較する")
+    p.add_argument("--tolerance", type=float, default=0.2, help="ベースラインからの許容劣化率")
+    return p.parse_args(argv)
+
+
+async def _main(args) -> int:
+    mix = parse_mix(args.mix)
+    servers: List[ServerProcess] = []
+    try:
+        stand_in_url = args.stand_in_url
+        if not stand_in_url:
+            stand_in = ServerProcess(
+                "bench.stand_in:app",
+                free_port(),
+                {
+                    "BENCH_DB_MS": str(args.db_ms),
+                    "BENCH_STORAGE_MS": str(args.storage_ms),
+                    "BENCH_AUTH_MS": str(args.auth_ms),
+                    "BENCH_EMBED_MS": str(args.embed_ms),
+                    "BENCH_TTFT_MS": str(args.ttft_ms),
+                    "BENCH_TOKEN_MS": str(args.token_ms),
+                    "BENCH_TOKENS": str(args.tokens),
+                },
+            )
+            servers.append(stand_in.start())
+            stand_in_url = stand_in.url
+        app_url = args.app_url
+        if not app_url:
+            app = ServerProcess("bench.app_under_test:app", free_port(), app_env(stand_in_url))
+            servers.append(app.start())
+            app_url = app.url
+
+        async with httpx.AsyncClient() as ctl:
+            await ctl.post(stand_in_url + "/__bench/reset")
+            await ctl.post(app_url + "/__bench/loop_lag")
+            rec = Recorder()
+            print(f"[load] users={args.users} duration={args.duration}s mix={args.mix}", flush=True)
+            t0 = time.perf_counter()
+            deadline = t0 + args.duration
+            await asyncio.gather(
+                *(
+                    _virtual_user(
+                        vu, app_url, mix, rec,
+                        deadline=deadline,
+                        start_delay=args.ramp * vu / max(args.users, 1),
+                        think=args.think_ms / 1000.0,
+                        timeout=args.timeout,
+                        upload_kb=args.upload_kb,
+                    )
+                    for vu in range(args.users)
+                )
+            )
+            elapsed = time.perf_counter() - t0
+            lag = (await ctl.post(app_url + "/__bench/loop_lag")).json()
+
+        report = build_report(rec, elapsed, lag)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"args": vars(args), "report": report}, f, ensure_ascii=False, indent=2)
+        problems = check_thresholds(report, args)
+        for msg in problems:
+            print("[load] FAIL", msg)
+        return 1 if problems else 0
+    finally:
+        for s in reversed(servers):
+            s.stop()
+
+
+def main(argv=None):
+    sys.exit(asyncio.run(_main(_parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# 負荷試験のシナリオ定義
+# 1 シナリオ = 仮想ユーザが順に叩くステップの列。各ステップの名前がエンドポイント別集計のキーになる
+# ステップは (名前, 非同期関数) で、関数は httpx.Response を返す。前のステップの結果は ctx で受け渡す
+from __future__ import annotations
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import httpx
+
+from bench.fake_supabase import BENCH_PROJECT_ID
+
+Ctx = Dict[str, Any]
+Step = Tuple[str, Callable[[httpx.AsyncClient, Ctx], Awaitable[httpx.Response]]]
+
+API = "/api/v1"
+
+
+# ==================================================
+## 個々のステップ
+# ==================================================
+async def login(c: httpx.AsyncClient, ctx: Ctx) -> httpx.Response:
+    # Cookie（sb-access-token）はクライアントの cookie jar に保存され、以降のステップで使われる
+    return await c.post(
+        f"{API}/auth/login", json={"id": f"vu{ctx['vu']}@example.com", "password": "bench"}
+    )
+
+
+async def me(c, ctx):
+    return await c.get(f"{API}/auth/me")
+
+
+async def list_projects(c, ctx):
+    r = await c.get(f"{API}/projects")
+    if r.status_code == 200 and r.json():
+        ctx.setdefault("project_id", r.json()[0]["id"])
+    return r
+
+
+async def list_threads(c, ctx):
+    r = await c.get(f"{API}/threads", params={"projectId": ctx.get("project_id", BENCH_PROJECT_ID)})
+    if r.status_code == 200 and r.json():
+        ctx.setdefault("thread_id", r.json()[0]["id"])
+    return r
+
+
+async def create_project(c, ctx):
+    r = await c.post(f"{API}/projects", json={"name": f"bench-{ctx['vu']}", "overview": "load test"})
+    if r.status_code == 201:
+        ctx["project_id"] = r.json()["id"]
+    return r
+
+
+async def rename_project(c, ctx):
+    return await c.patch(f"{API}/projects/{ctx['project_id']}", json={"overview": "renamed"})
+
+
+async def delete_project(c, ctx):
+    return await c.delete(f"{API}/projects/{ctx['project_id']}")
+
+
+async def create_thread(c, ctx):
+    r = await c.post(
+        f"{API}/threads",
+        json={"projectId": ctx.get("project_id", BENCH_PROJECT_ID), "name": "load test"},
+    )
+    if r.status_code == 201:
+        ctx["thread_id"] = r.json()["id"]
+    return r
+
+
+async def rename_thread(c, ctx):
+    return await c.patch(f"{API}/threads/{ctx['thread_id']}", json={"name": "renamed"})
+
+
+async def delete_thread(c, ctx):
+    return await c.delete(f"{API}/threads/{ctx['thread_id']}")
+
+
+async def list_messages(c, ctx):
+    return await c.get(f"{API}/messages", params={"threadId": ctx.get("thread_id", "thread-0")})
+
+
+async def post_message(c, ctx):
+    return await c.post(
+        f"{API}/messages",
+        json={"threadId": ctx.get("thread_id", "thread-0"), "role": "user", "content": "負荷試験のメッセージ"},
+    )
+
+
+async def upload_attachment(c, ctx):
+    body = ("負荷試験用のアップロードファイルです。\n" * 64).encode("utf-8")
+    data = (body * (ctx["upload_kb"] * 1024 // len(body) + 1))[: ctx["upload_kb"] * 1024]
+    r = await c.post(
+        f"{API}/attachments",
+        data={"thread_id": ctx.get("thread_id", "thread-0")},
+        files={"file": ("bench.txt", data, "text/plain")},
+    )
+    if r.status_code == 200:
+        ctx["attachment_id"] = r.json()["id"]
+    return r
+
+
+async def list_files(c, ctx):
+    return await c.get(f"{API}/files", params={"thread_id": ctx.get("thread_id", "thread-0"), "mime_prefix": ""})
+
+
+async def create_file(c, ctx):
+    r = await c.post(
+        f"{API}/files",
+        json={
+            "storage_path": f"private/attachments/bench-{ctx['vu']}.txt",
+            "mime": "text/plain",
+            "size": 1024,
+            "title": "bench.txt",
+            "thread_id": ctx.get("thread_id", "thread-0"),
+        },
+    )
+    if r.status_code == 201:
+        ctx["file_id"] = r.json()["id"]
+    return r
+
+
+async def update_file(c, ctx):
+    return await c.patch(f"{API}/files/{ctx['file_id']}", json={"title": "renamed.txt"})
+
+
+async def delete_file(c, ctx):
+    return await c.delete(f"{API}/files/{ctx['file_id']}")
+
+
+async def admin_users(c, ctx):
+    return await c.get(f"{API}/admin/users")
+
+
+async def chat(c, ctx):
+    # SSE を最後まで読み切った時間を計測する（TTFT などの詳細は bench.chat_bench で）
+    body = {
+        "threadId": ctx.get("thread_id", "thread-0"),
+        "messages": [{"role": "user", "content": f"負荷試験の質問 vu={ctx['vu']} #{ctx['iter']}"}],
+    }
+    async with c.stream("POST", f"{API}/chatbot", json=body) as r:
+        async for line in r.aiter_lines():
+            if line.startswith("data: ") and '"type": "error"' in line:
+                ctx["stream_error"] = json.loads(line[6:]).get("where")
+        return r
+
+
+# ==================================================
+## シナリオ
+# ==================================================
+SCENARIOS: Dict[str, List[Step]] = {
+    # ログイン → プロジェクト一覧 → スレッドを開く → 送信 → アップロード
+    "full": [
+        ("POST /auth/login", login),
+        ("GET /auth/me", me),
+        ("GET /projects", list_projects),
+        ("GET /threads", list_threads),
+        ("GET /messages", list_messages),
+        ("POST /messages", post_message),
+        ("POST /attachments", upload_attachment),
+        ("GET /files", list_files),
+    ],
+    # 閲覧のみ
+    "browse": [
+        ("POST /auth/login", login),
+        ("GET /auth/me", me),
+        ("GET /projects", list_projects),
+        ("GET /threads", list_threads),
+        ("GET /messages", list_messages),
+    ],
+    # プロジェクト / スレッドの作成・更新・削除
+    "manage": [
+        ("POST /auth/login", login),
+        ("POST /projects", create_project),
+        ("PATCH /projects/{id}", rename_project),
+        ("POST /threads", create_thread),
+        ("PATCH /threads/{id}", rename_thread),
+        ("DELETE /threads/{id}", delete_thread),
+        ("DELETE /projects/{id}", delete_project),
+    ],
+    # 添付メタデータの CRUD
+    "files": [
+        ("POST /auth/login", login),
+        ("POST /files", create_file),
+        ("PATCH /files/{id}", update_file),
+        ("GET /files", list_files),
+        ("DELETE /files/{id}", delete_file),
+    ],
+    "admin": [
+        ("POST /auth/login", login),
+        ("GET /admin/users", admin_users),
+    ],
+    "chat": [
+        ("POST /auth/login", login),
+        ("POST /chatbot", chat),
+    ],
+}
+
+DEFAULT_MIX = "full:3,browse:5,manage:1,files:1,admin:1"
+
+
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    """"full:3,browse:5" → [("full", 3.0), ("browse", 5.0)]"""
+    out = []
+    for part in spec.split(","):
+        name, _, w = part.strip().partition(":")
+        if not name:
+            continue
+        if name not in SCENARIOS:
+            raise SystemExit(f"unknown scenario: {name} (choices: {', '.join(SCENARIOS)})")
+        out.append((name, float(w or 1)))
+    return out
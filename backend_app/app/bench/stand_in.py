@@ -0,0 +1,28 @@
+# ベンチマーク用のスタンドイン（PostgREST / Storage / GoTrue / OpenAI）を 1 つのサーバにまとめたもの
+# ネットワークには出ず、遅延は BENCH_* 環境変数で調整する
+#   uvicorn bench.stand_in:app --port 18000
+from __future__ import annotations
+from fastapi import FastAPI
+
+from bench.fake_supabase import (
+    MemoryStore,
+    gotrue_router,
+    postgrest_router,
+    reset_router,
+    storage_router,
+)
+from bench.fake_openai import openai_router
+
+store = MemoryStore()
+
+app = FastAPI(title="bench stand-in (PostgREST / Storage / GoTrue / OpenAI)")
+app.include_router(postgrest_router(store))
+app.include_router(storage_router(store))
+app.include_router(gotrue_router())
+app.include_router(openai_router())
+app.include_router(reset_router(store))
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import asyncio, time
+from contextlib import aclosing
 from uuid import uuid4
 from typing import AsyncIterable, List, Optional
 from fastapi import HTTPException
@@ -9,9 +10,20 @@ from config import DEBUG_TRACE
 from schemas.chat_schema import ChatRequest
 from utils.see import sse, sse_debug, sse_error_payload
 from utils.context import format_hits
-from services.openai_client import embed_text, stream_llm
-from services.vector_store import rpc_match_by_doc_ids, rpc_match_scoped
-from workers.ingest_sync import ingest_sync_from_attachment
+from services.model_router import router as model_router
+from services.vector_store import rpc_match_by_doc_ids
+from services.generation_registry import owner_of
+from chat_system.retrieval import (
+    MATCH_COUNT,
+    embed_query,
+    is_retrieval_cached,
+    resolve_thread_project,
+    scoped_search,
+)
+from workers.ingest_sync import IngestBusy, ingest_sync_from_attachment
+
+# 切断時に部分回答の末尾へ付ける目印
+ABORTED_MARKER = "[aborted]"
 
 
 # RAG チャットの本体（SSE ジェネレータ）
@@ -29,6 +41,36 @@ async def run_rag_chat(req: ChatRequest, token: str) -> AsyncIterable[bytes]:
         assistant_msg_id: Optional[str] = None
         token_counter = 0
         got_token = False
+        aborted = False  # クライアント切断で打ち切られたか
+
+        # 切断時の保存（yield できないので SSE は返さない。一度だけ書き込む）
+        async def _persist_aborted():
+            partial = "".join(assistant_parts).strip()
+            if not (user_client and partial):
+                return
+            body = {
+                "thread_id": req.threadId,
+                "role": "assistant",
+                "content": f"{partial}\n\n{ABORTED_MARKER}",
+            }
+            try:
+                if assistant_msg_id:
+                    await user_client.upsert(
+                        "messages",
+                        json={"id": assistant_msg_id, **body},
+                        on_conflict="id",
+                        content_profile="app",
+                        returning=False,
+                    )
+                else:
+                    await user_client.post(
+                        "messages",
+                        json=body,
+                        content_profile="app",
+                        prefer="return=minimal",
+                    )
+            except Exception as e:
+                print("[chat] aborted save failed:", repr(e))
 
         yield sse({"type": "start"})
 
@@ -42,17 +84,12 @@ async def run_rag_chat(req: ChatRequest, token: str) -> AsyncIterable[bytes]:
                 yield sse(sse_error_payload(e, "client_init"))
                 return
 
-            # 1) プロジェクトIDの抽出（リクエスト内のスレッドから）
+            # 1) プロジェクトIDの抽出（リクエスト内のスレッドから。先読み済みならキャッシュ）
+            owner = owner_of(token)
             try:
-                t = await user_client.get_one(
-                    "threads",
-                    select="project_id",
-                    id=req.threadId,
-                    accept_profile="app",
+                project_id = await resolve_thread_project(
+                    user_client, owner, req.threadId
                 )
-                if not t:
-                    raise HTTPException(status_code=404, detail="thread not found")
-                project_id = t["project_id"]
                 yield sse_debug("resolve_thread_project", project_id=project_id)
             except Exception as e:
                 yield sse(sse_error_payload(e, "resolve_thread_project"))
@@ -80,6 +117,9 @@ async def run_rag_chat(req: ChatRequest, token: str) -> AsyncIterable[bytes]:
                         yield sse_debug(
                             "ingest_one", attachment_id=att_id, inserted=inserted
                         )
+                    except IngestBusy:
+                        # 別のワーカーが取り込み中: 完了は 3.1 の READY 待ちで確認する
+                        yield sse_debug("ingest_busy", attachment_id=att_id)
                     except Exception as ie:
                         yield sse(sse_error_payload(ie, "ingest_one"))
             except Exception as e:
@@ -151,10 +191,13 @@ async def run_rag_chat(req: ChatRequest, token: str) -> AsyncIterable[bytes]:
                 else:
                     yield sse_debug("doc_ids", doc_ids=doc_ids)
 
-            # 4) 埋め込み & ベクトル検索
+            # 4) 埋め込み & ベクトル検索（/chatbot/prefetch で先読み済みならキャッシュから）
+            prefetched = not doc_ids and is_retrieval_cached(
+                owner, req.threadId, project_id, last_user
+            )
             try:
-                q_emb = await embed_text(last_user)
-                yield sse_debug("embed_text_ok")
+                q_emb = await embed_query(last_user)
+                yield sse_debug("embed_text_ok", prefetched=prefetched)
             except Exception as e:
                 yield sse(sse_error_payload(e, "embed_text"))
                 return
@@ -166,23 +209,22 @@ async def run_rag_chat(req: ChatRequest, token: str) -> AsyncIterable[bytes]:
                         user_client,
                         {
                             "query_embedding": q_emb,
-                            "match_count": 5,
+                            "match_count": MATCH_COUNT,
                             "in_document_ids": doc_ids,  # 添付ファイルのアドレス
                         },
                     )
                 # 添付画像なし（他の紐づけファイル探索）
                 else:
-                    hits = await rpc_match_scoped(
-                        user_client,
-                        {
-                            "query_embedding": q_emb,
-                            "match_count": 5,
-                            "in_thread_id": req.threadId,
-                            "in_project_id": project_id,
-                        },
+                    hits = await scoped_search(
+                        user_client, owner, req.threadId, project_id, last_user
                     )
                 n_hits = len(hits or [])  # 検索結果の数
-                yield sse_debug("vector_search", hits=n_hits, scoped=bool(not doc_ids))
+                yield sse_debug(
+                    "vector_search",
+                    hits=n_hits,
+                    scoped=bool(not doc_ids),
+                    prefetched=prefetched,
+                )
                 context = format_hits(hits or [])  # 検索結果
                 yield sse_debug("context_ready", context_chars=len(context))
             except Exception as e:
@@ -195,10 +237,11 @@ async def run_rag_chat(req: ChatRequest, token: str) -> AsyncIterable[bytes]:
                 for m in req.messages
                 if m.role in ("user", "assistant", "system")
             ]
-            yield sse_debug("llm_begin")
+            route = model_router.route(history, last_user, context)  # モデルのティア選択
+            yield sse_debug("llm_begin", route=route.describe())
             try:
-                for delta in stream_llm(
-                    history, last_user, context
+                async for delta in model_router.astream(
+                    route, history, last_user, context
                 ):  # チャット送信（delta: 返信の一部）
                     got_token = True
                     assistant_parts.append(delta)
@@ -255,112 +298,124 @@ async def run_rag_chat(req: ChatRequest, token: str) -> AsyncIterable[bytes]:
                             yield sse(sse_error_payload(e_mid, "mid_update"))
             except Exception as e:
                 yield sse(sse_error_payload(e, "openai_stream"))
+            yield sse_debug("llm_done", route=route.describe())
 
-        except asyncio.CancelledError:
+        except (asyncio.CancelledError, GeneratorExit):
+            # クライアント切断（safe_stream によるキャンセル / aclose）
+            aborted = True
             raise
         except Exception as e:
             yield sse(sse_error_payload(e, "top_level"))
         finally:
-            # トークン未受信時のフォールバック（エラーハンドリング）
-            if not got_token:
-                yield sse(
-                    {
-                        "type": "error",
-                        "where": "openai_stream",
-                        "message": "no_tokens_emitted",
-                    }
-                )
+            if aborted:
+                # 切断時: 上流ストリームは astream_llm の後始末で停止済み。
+                # キャンセルが再送されても保存だけは完了させる
                 try:
-                    fallback = "[assistant empty response]"
-                    await user_client.post(
-                        "messages",
-                        json={
-                            "thread_id": req.threadId,
-                            "role": "assistant",
-                            "content": fallback,
-                        },
-                        content_profile="app",
-                        prefer="return=representation",
-                    )
-                    yield sse({"type": "saved", "who": "assistant", "mode": "fallback"})
-                except Exception:
+                    await asyncio.shield(_persist_aborted())
+                except asyncio.CancelledError:
                     pass
+            else:
+                # トークン未受信時のフォールバック（エラーハンドリング）
+                if not got_token:
+                    yield sse(
+                        {
+                            "type": "error",
+                            "where": "openai_stream",
+                            "message": "no_tokens_emitted",
+                        }
+                    )
+                    try:
+                        fallback = "[assistant empty response]"
+                        await user_client.post(
+                            "messages",
+                            json={
+                                "thread_id": req.threadId,
+                                "role": "assistant",
+                                "content": fallback,
+                            },
+                            content_profile="app",
+                            prefer="return=representation",
+                        )
+                        yield sse({"type": "saved", "who": "assistant", "mode": "fallback"})
+                    except Exception:
+                        pass
 
-            # 最終保存
-            try:
-                if user_client:
-                    final_text = "".join(assistant_parts).strip()  # 回答全文
-                    if final_text:
-                        if (
-                            assistant_msg_id
-                        ):  # メッセージIDがある場合（chatAPIからのメッセージを正常に保存できた場合）
-                            try:
-                                # 最終の文章を保存する
-                                await user_client.upsert(
-                                    "messages",
-                                    json={
-                                        "id": assistant_msg_id,
-                                        "thread_id": req.threadId,
-                                        "role": "assistant",
-                                        "content": final_text,
-                                    },
-                                    on_conflict="id",
-                                    content_profile="app",
-                                    returning=False,
-                                )
-                                yield sse_debug(
-                                    "final_saved",
-                                    id=assistant_msg_id,
-                                    chars=len(final_text),
-                                )
-                                yield sse(
-                                    {
-                                        "type": "saved",
-                                        "who": "assistant",
-                                        "mode": "final",
-                                        "id": assistant_msg_id,
-                                    }
-                                )
-                            except Exception as e_final_up:
-                                yield sse(sse_error_payload(e_final_up, "final_upsert"))
-                        else:
-                            try:
-                                # 通信エラーなどで、下書きの保存が行われなければ
-                                created = await user_client.post(
-                                    "messages",
-                                    json={
-                                        "thread_id": req.threadId,
-                                        "role": "assistant",
-                                        "content": final_text,
-                                    },
-                                    content_profile="app",
-                                    prefer="return=representation",
-                                )
-                                new_id = (
-                                    created[0]["id"]
-                                    if isinstance(created, list) and created
-                                    else None
-                                )
-                                yield sse_debug(
-                                    "final_inserted", id=new_id, chars=len(final_text)
-                                )
-                                yield sse(
-                                    {
-                                        "type": "saved",
-                                        "who": "assistant",
-                                        "mode": "final",
-                                        "id": new_id,
-                                    }
-                                )
-                            except Exception as e_post:
-                                yield sse(sse_error_payload(e_post, "final_insert"))
-            except Exception as e:
-                yield sse(sse_error_payload(e, "final_block"))
+                # 最終保存
+                try:
+                    if user_client:
+                        final_text = "".join(assistant_parts).strip()  # 回答全文
+                        if final_text:
+                            if (
+                                assistant_msg_id
+                            ):  # メッセージIDがある場合（chatAPIからのメッセージを正常に保存できた場合）
+                                try:
+                                    # 最終の文章を保存する
+                                    await user_client.upsert(
+                                        "messages",
+                                        json={
+                                            "id": assistant_msg_id,
+                                            "thread_id": req.threadId,
+                                            "role": "assistant",
+                                            "content": final_text,
+                                        },
+                                        on_conflict="id",
+                                        content_profile="app",
+                                        returning=False,
+                                    )
+                                    yield sse_debug(
+                                        "final_saved",
+                                        id=assistant_msg_id,
+                                        chars=len(final_text),
+                                    )
+                                    yield sse(
+                                        {
+                                            "type": "saved",
+                                            "who": "assistant",
+                                            "mode": "final",
+                                            "id": assistant_msg_id,
+                                        }
+                                    )
+                                except Exception as e_final_up:
+                                    yield sse(sse_error_payload(e_final_up, "final_upsert"))
+                            else:
+                                try:
+                                    # 通信エラーなどで、下書きの保存が行われなければ
+                                    created = await user_client.post(
+                                        "messages",
+                                        json={
+                                            "thread_id": req.threadId,
+                                            "role": "assistant",
+                                            "content": final_text,
+                                        },
+                                        content_profile="app",
+                                        prefer="return=representation",
+                                    )
+                                    new_id = (
+                                        created[0]["id"]
+                                        if isinstance(created, list) and created
+                                        else None
+                                    )
+                                    yield sse_debug(
+                                        "final_inserted", id=new_id, chars=len(final_text)
+                                    )
+                                    yield sse(
+                                        {
+                                            "type": "saved",
+                                            "who": "assistant",
+                                            "mode": "final",
+                                            "id": new_id,
+                                        }
+                                    )
+                                except Exception as e_post:
+                                    yield sse(sse_error_payload(e_post, "final_insert"))
+                except Exception as e:
+                    yield sse(sse_error_payload(e, "final_block"))
 
-            yield sse_debug("end")
-            yield sse({"type": "end"})
-            yield sse("done", event="done")
+                yield sse_debug("end")
+                yield sse({"type": "end"})
+                yield sse("done", event="done")
 
-    # generator をそのまま返す
-    async for chunk in generator():
-        yield chunk
+    # generator をそのまま返す（外側が閉じられたら内側も即座に閉じる）
+    async with aclosing(generator()) as gen:
+        async for chunk in gen:
+            yield chunk
@@ -8,11 +8,10 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.runnables import RunnableParallel
-from langchain_openai import ChatOpenAI
+from services import openai_langchain
 
 # RAGの検索に使用するドキュメント保存やベクトルデータにするためのパッケージ
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 from langchain_community.document_loaders import TextLoader
 from langchain_community.document_loaders import WebBaseLoader
 
@@ -28,16 +27,16 @@ from create_documents.search_gitlab import (
 
 def chat_to_agent(input_prompt: str) -> str:
     # 埋め込みベクトルの復元に使用するモジュール
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+    embeddings = openai_langchain.embeddings("text-embedding-3-small")
     # DBから取得
     db = Chroma(persist_directory="./chroma_db", embedding_function=embeddings)
     # 類似ベクトル上位3件を取得
     retrieve_context = db.as_retriever(search_kwargs={"k": 3})
 
     # モデルの設定
-    GPT4_1_nano = ChatOpenAI(model="gpt-4.1-nano", temperature=0)
-    GPT4o_mini = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    GPT4o = ChatOpenAI(model="gpt-4o", temperature=0)
+    GPT4_1_nano = openai_langchain.chat_model("gpt-4.1-nano", temperature=0)
+    GPT4o_mini = openai_langchain.chat_model("gpt-4o-mini", temperature=0)
+    GPT4o = openai_langchain.chat_model("gpt-4o", temperature=0)
 
     model = GPT4_1_nano
 
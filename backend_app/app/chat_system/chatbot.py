@@ -11,11 +11,10 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.runnables import RunnableParallel
-from langchain_openai import ChatOpenAI
+from services import openai_langchain
 
 # RAGの検索に使用するドキュメント保存やベクトルデータにするためのパッケージ
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 
 # from langchain_community.document_loaders import TextLoader
 # from langchain_community.document_loaders import WebBaseLoader
@@ -30,21 +29,15 @@ from create_documents.search_gitlab import (
 #     text = f.read()
 
 # 埋め込みベクトルの復元に使用するモジュール
-EMBEDDINGS = OpenAIEmbeddings(model="text-embedding-3-small")
+EMBEDDINGS = openai_langchain.embeddings("text-embedding-3-small")
 # DBから取得
 DB = Chroma(persist_directory="./chroma_db", embedding_function=EMBEDDINGS)
 # 類似ベクトル上位3件を取得
 RETRIEVER = DB.as_retriever(search_kwargs={"k": 3})
 
-# モデルの設定
-GPT4_1_nano = ChatOpenAI(model="gpt-4.1-nano", temperature=0)
-GPT4o_mini = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-GPT4o = ChatOpenAI(model="gpt-4o", temperature=0)
-GPT5 = ChatOpenAI(model="gpt-5", temperature=0)
-GPT5_mini = ChatOpenAI(model="gpt-5-mini", temperature=0)
-GPT5_nano = ChatOpenAI(model="gpt-5-nano", temperature=0)
-
-MODEL = GPT4_1_nano
+# モデルの設定（使用するモデルのみ生成する。切り替えは環境変数で）
+# 候補: gpt-4.1-nano / gpt-4o-mini / gpt-4o / gpt-5 / gpt-5-mini / gpt-5-nano
+MODEL = openai_langchain.chat_model(os.getenv("CHATBOT_MODEL", "gpt-4.1-nano"), temperature=0)
 
 # HyDEの実装
 # 検索に使用するRAG機能なしの回答を出力
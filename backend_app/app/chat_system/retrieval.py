@@ -0,0 +1,109 @@
+from __future__ import annotations
+import asyncio
+from typing import Dict, List, Optional, Set
+
+from fastapi import HTTPException
+
+from crud import SupaRest
+from services import ingest_progress
+from services.openai_client import embed_text
+from services.vector_store import rpc_match_scoped
+from services.retrieval_cache import (
+    embedding_cache,
+    normalize_query,
+    retrieval_cache,
+    thread_project_cache,
+)
+
+# スコープ付き検索で取得する件数
+MATCH_COUNT = 5
+# 先読みを行う最小文字数（短すぎる入力途中の文字列は無視）
+PREFETCH_MIN_CHARS = 4
+
+# 実行中の先読みタスク（完了まで参照を持っておかないと GC で消えることがある）
+_prefetching: Set[asyncio.Task] = set()
+
+
+# スレッドが属するプロジェクトID（RLS で読めなければ 404）
+async def resolve_thread_project(client: SupaRest, owner: str, thread_id: str) -> str:
+    async def _fetch() -> str:
+        t = await client.get_one(
+            "threads", select="project_id", id=thread_id, accept_profile="app"
+        )
+        if not t:
+            raise HTTPException(status_code=404, detail="thread not found")
+        return t["project_id"]
+
+    return await thread_project_cache.get_or_compute((owner, thread_id), _fetch)
+
+
+# 質問文の埋め込み（正規化した文字列をキーにキャッシュ。埋め込むのは元の文字列）
+async def embed_query(text: str) -> List[float]:
+    return await embedding_cache.get_or_compute(normalize_query(text), lambda: embed_text(text))
+
+
+def is_retrieval_cached(owner: str, thread_id: str, project_id: str, text: str) -> bool:
+    return retrieval_cache.peek((owner, thread_id, project_id, normalize_query(text)))
+
+
+# 取り込みが終わったら、そのスレッド / プロジェクトを範囲に含む検索結果を捨てる
+# （別プロセス（ジョブワーカー）での取り込みも進捗の中継で届く）
+def _on_ingest_progress(_attachment_id: str, data: bytes):
+    f = ingest_progress.parse(data)
+    if not f or f.get("stage") != "ready" or f.get("skipped"):
+        return
+    thread_id: Optional[str] = f.get("threadId")
+    project_id: Optional[str] = f.get("projectId")
+    retrieval_cache.drop(
+        lambda k: (thread_id is not None and k[1] == thread_id)
+        or (project_id is not None and k[2] == project_id)
+    )
+
+
+ingest_progress.progress_hub.watch(_on_ingest_progress)
+
+
+# スレッド / プロジェクト範囲のベクトル検索（(所有者, スレッド, プロジェクト, 質問文) 単位でキャッシュ）
+async def scoped_search(
+    client: SupaRest, owner: str, thread_id: str, project_id: str, text: str
+) -> List[Dict]:
+    q = normalize_query(text)
+
+    async def _search() -> List[Dict]:
+        q_emb = await embed_query(text)
+        hits = await rpc_match_scoped(
+            client,
+            {
+                "query_embedding": q_emb,
+                "match_count": MATCH_COUNT,
+                "in_thread_id": thread_id,
+                "in_project_id": project_id,
+            },
+        )
+        return hits or []
+
+    return await retrieval_cache.get_or_compute((owner, thread_id, project_id, q), _search)
+
+
+# 入力途中の下書きに対して、埋め込みと検索を先に済ませておく（結果は待たない）
+def prefetch(client: SupaRest, owner: str, thread_id: str, text: str) -> bool:
+    q = normalize_query(text)
+    if len(q) < PREFETCH_MIN_CHARS:
+        return False
+
+    # 計算済みならキャッシュから返るだけ
+    async def _run() -> List[Dict]:
+        project_id = await resolve_thread_project(client, owner, thread_id)
+        return await scoped_search(client, owner, thread_id, project_id, text)
+
+    task = asyncio.ensure_future(_run())
+    _prefetching.add(task)
+
+    # 先読みの失敗は本送信で再計算されるので、ここでは握りつぶす
+    def _done(t: asyncio.Task):
+        _prefetching.discard(t)
+        if not t.cancelled():
+            t.exception()
+
+    task.add_done_callback(_done)
+    return True
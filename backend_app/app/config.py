@@ -3,4 +3,12 @@ import os
 
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+# 埋め込みの次元数（キャッシュのキーにも使う）。text-embedding-3-* では API の dimensions で減らせる
+EMBED_DIMS = int(os.getenv("EMBED_DIMS", "1536"))
+# chunks.embedding の保存形式: vector（float32）/ halfvec（float16）。DB 側の app.embed_storage と揃える
+EMBED_STORAGE = os.getenv("EMBED_STORAGE", "vector")
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-5-mini")  # ティア未指定時の既定モデル
 DEBUG_TRACE = os.getenv("DEBUG_SSE_TRACE", "1") == "1"  # ← 本番は0に
+# 取り込み時の埋め込み: 1 リクエストあたりの入力数と、同時に投げるリクエスト数
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
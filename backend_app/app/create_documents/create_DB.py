@@ -9,15 +9,15 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.runnables import RunnableParallel
-from langchain_openai import ChatOpenAI
 
 # RAGの検索に使用するドキュメント保存やベクトルデータにするためのパッケージ
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 from langchain_community.document_loaders import TextLoader
 from langchain_community.document_loaders import WebBaseLoader
 
 # 別ファイルからのメソッド読み出し
+from services import openai_langchain
+from services.openai_quota import BACKGROUND
 from create_documents.search_gitlab import load_gitlab_wiki # 引数(target: str, repository_name: str, token: str): ドキュメントのリストを出力
 from create_documents.search_gitlab import load_gitlab_issue # 引数(target: str, repository_name: str, token: str): ドキュメントのリストを出力
 
@@ -43,8 +43,8 @@ else :
     raise ValueError("wikiかissueを選択してください") # 対象が不正or未記入ならエラー出力
 print("length: ", len(documents))
 
-# ベクトルデータにする
-embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+# ベクトルデータにする（一括の構築なので、チャットに枠を譲るバックグラウンドの優先度で埋め込む）
+embeddings = openai_langchain.embeddings("text-embedding-3-small", priority=BACKGROUND)
 # ドキュメントをベクトルデータにする
 db = Chroma.from_documents(documents, embeddings, persist_directory="./chroma_db")
 # ベクトルデータから検索する関数を作成
@@ -20,7 +20,17 @@ from fastapi.responses import JSONResponse, StreamingResponse
 
 from dotenv import load_dotenv
 
-from routers import auth, projects, threads, messages, admin, attachments, chat, files
+from routers import auth, projects, threads, messages, admin, attachments, chat, files, jobs
+from services.ingest_progress import progress_hub
+from services.thread_hub import hub
+from services.vector_store import check_embedding_config
+from workers.extract_pool import (
+    EXTRACT_POOL_ENABLED,
+    EXTRACT_POOL_PREWARM,
+    get_pool as get_extract_pool,
+    shutdown_pool as shutdown_extract_pool,
+)
+from workers.job_worker import JobWorker
 
 # ---- 入出力スキーマ ----
 Role = Literal["user", "assistant", "system"]
@@ -63,6 +73,63 @@ app.include_router(admin.router, prefix="/api/v1")
 app.include_router(attachments.router, prefix="/api/v1")
 app.include_router(chat.router, prefix="/api/v1")
 app.include_router(files.router, prefix="/api/v1")
+app.include_router(jobs.router, prefix="/api/v1")
+
+# API プロセス内で取り込みジョブを実行するか（専用プロセスで python -m workers.job_worker を動かすなら 0）
+JOB_WORKER_ENABLED = os.getenv("JOB_WORKER_ENABLED", "1") == "1"
+job_worker = JobWorker()
+
+
+# スレッド配信ハブのワーカー間中継（Postgres LISTEN/NOTIFY）の開始・停止
+@app.on_event("startup")
+async def start_thread_hub():
+    await hub.start()
+
+
+@app.on_event("shutdown")
+async def stop_thread_hub():
+    await hub.stop()
+
+
+# 取り込み進捗の配信ハブ（ジョブワーカーのプロセスからの中継を受ける）
+@app.on_event("startup")
+async def start_ingest_progress_hub():
+    await progress_hub.start()
+
+
+@app.on_event("shutdown")
+async def stop_ingest_progress_hub():
+    await progress_hub.stop()
+
+
+# 永続ジョブキューのワーカー
+@app.on_event("startup")
+async def start_job_worker():
+    if JOB_WORKER_ENABLED:
+        job_worker.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_worker():
+    await job_worker.stop()
+
+
+# 抽出用プロセスプールの起動（応答開始は待たせない）・停止
+@app.on_event("startup")
+async def start_extract_pool():
+    if EXTRACT_POOL_ENABLED and EXTRACT_POOL_PREWARM:
+        asyncio.get_running_loop().run_in_executor(None, get_extract_pool().warm)
+
+
+@app.on_event("shutdown")
+async def stop_extract_pool():
+    await asyncio.to_thread(shutdown_extract_pool)
+
+
+# 埋め込みの保存形式（DB の chunks.embedding）と EMBED_DIMS / EMBED_STORAGE の突き合わせ（ずれていれば警告のみ）
+@app.on_event("startup")
+async def check_embedding_storage():
+    asyncio.ensure_future(check_embedding_config())
 
 
 @app.get("/health")
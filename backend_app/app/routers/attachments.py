@@ -1,5 +1,5 @@
-import os, uuid, time
-from storage3.utils import StorageException
+import asyncio, os, uuid, time
+from typing import List, Optional
 from fastapi import (
     APIRouter,
     UploadFile,
@@ -7,12 +7,18 @@ from fastapi import (
     HTTPException,
     Depends,
     Form,
-    BackgroundTasks,
     Request,
 )
-from workers.ingest_RAG_document import ingest_from_storage
+from pydantic import BaseModel, Field
+from fastapi.responses import StreamingResponse
+from services import ingest_progress, job_queue, storage_upload, upload_spool
+from services.embedding_cache import stats as embedding_cache_stats
+from workers.extract_pool import get_pool as get_extract_pool
+from workers.ingest_sync import is_image, split_storage_path
+from utils.sse_stream import SSE_HEADERS, safe_stream
 from supabase import create_client, Client
 from deps import bearer_token
+from routers.admin import require_admin_or_403
 from crud import SupaRest
 
 router = APIRouter(tags=["attachments"])
@@ -20,6 +26,27 @@ router = APIRouter(tags=["attachments"])
 SUPABASE_URL = os.environ["SUPABASE_URL"]
 SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]  # server-only
 STORAGE_BUCKET = os.getenv("STORAGE_PRIVATE_BUCKET", "private")
+# まとめてアップロード: 1 リクエストのファイル数の上限と、Storage へ同時に送る数
+ATTACHMENTS_BATCH_MAX_FILES = int(os.getenv("ATTACHMENTS_BATCH_MAX_FILES", "100"))
+ATTACHMENTS_BATCH_CONCURRENCY = int(os.getenv("ATTACHMENTS_BATCH_CONCURRENCY", "4"))
+# 進捗ストリーム 1 本で購読できる添付の数
+INGEST_PROGRESS_MAX_IDS = int(os.getenv("INGEST_PROGRESS_MAX_IDS", "50"))
+
+
+# ==================================================
+## 型定義（直接アップロード）
+# ==================================================
+class UploadUrlRequest(BaseModel):
+    # フロントは camelCase で送ってくる
+    threadId: str
+    filename: str = Field(..., min_length=1)
+    mime: Optional[str] = None
+    size: Optional[int] = Field(None, ge=1, description="分かれば登録時に Storage 上のサイズと照合する")
+
+
+class UploadCompleteRequest(BaseModel):
+    ticket: str = Field(..., description="upload-url が返したチケット")
+    replacesAttachmentId: Optional[str] = None
 
 
 # supabaseにアクセスできるクライアントの作成
@@ -44,30 +71,198 @@ def ensure_bucket(sb: Client, bucket: str, public: bool = False):
             raise
 
 
+async def _insert_attachment(
+    client: SupaRest,
+    *,
+    thread_id: str,
+    storage_path: str,
+    mime: str,
+    size: int,
+    title: str,
+):
+    """スレッドのプロジェクトを引き、app.attachments へメタを登録する。(添付の行, project_id) を返す"""
+    phase = "fetch_thread_project"
+    try:
+        trow = await client.get_one(
+            "threads",
+            select="project_id",
+            id=thread_id,
+            accept_profile="app",
+        )  # 指定したスレッドIDのスレッドを取得
+    except Exception as e:
+        print("[attachments] get_one(threads) error:", repr(e))
+        raise HTTPException(
+            status_code=400, detail=f"phase={phase}: failed to fetch thread"
+        ) from e
+    if not trow:
+        raise HTTPException(status_code=404, detail=f"phase={phase}: thread not found")
+    project_id = trow["project_id"]
+
+    phase = "insert_attachment_row"
+    try:
+        # 物理キーは att_id 基点で確定済みなので、そのまま格納
+        att = await client.rpc(
+            "add_attachment",
+            {
+                "in_storage_path": storage_path,  # 物理キー（主キー）
+                "in_mime": mime,
+                "in_size": size,
+                "in_title": title,
+                "in_project_id": project_id,  # 任意（null可）
+                "in_thread_id": thread_id,  # 任意（null可）
+            },
+            accept_profile="app",
+        )
+        att_row = att if isinstance(att, dict) else att[0]
+    except Exception as e:
+        print("[attachments] insert attachment error:", repr(e))
+        raise HTTPException(
+            status_code=400, detail=f"phase={phase}: failed to insert attachment"
+        ) from e
+    return att_row, project_id
+
+
+async def _finish_attachment(
+    sb: Client,
+    client: SupaRest,
+    att_row: dict,
+    object_path: str,
+    replaces_attachment_id: Optional[str],
+):
+    """登録済みの添付について、改訂版の引き継ぎ・閲覧用の署名URL・取り込みジョブの登録を行う"""
+    att_id = att_row["id"]
+
+    # ===== 改訂版: 旧添付の文書を新しい添付に付け替える =====
+    adopted_document_id = None
+    if replaces_attachment_id:
+        phase = "adopt_document"
+        try:
+            adopted_document_id = await client.rpc(
+                "adopt_document",
+                {
+                    "in_from_attachment_id": replaces_attachment_id,
+                    "in_to_attachment_id": att_id,
+                },
+                accept_profile="app",
+            )
+        except Exception as e:
+            print("[attachments] adopt_document error:", repr(e))
+            raise HTTPException(
+                status_code=400,
+                detail=f"phase={phase}: failed to adopt previous document",
+            ) from e
+
+    # ===== 署名URL =====
+    phase = "create_signed_url"
+    try:
+        signed = sb.storage.from_(STORAGE_BUCKET).create_signed_url(object_path, 600)
+        if isinstance(signed, dict):
+            if signed.get("error"):
+                msg = (
+                    signed["error"].get("message")
+                    if isinstance(signed["error"], dict)
+                    else str(signed["error"])
+                )
+                raise RuntimeError(msg or "signed url failed")
+            signed_url = (
+                signed.get("signedURL") or signed.get("signedUrl") or signed.get("url")
+            )
+        else:
+            signed_url = (
+                getattr(signed, "signedURL", None)
+                or getattr(signed, "signedUrl", None)
+                or getattr(signed, "url", None)
+            )
+        if not signed_url:
+            raise RuntimeError("signed url empty")
+    except Exception as e:
+        print("[attachments] create_signed_url error:", repr(e))
+        raise HTTPException(
+            status_code=500, detail=f"phase={phase}: failed to create signed url"
+        ) from e
+
+    # ===== 取り込みジョブの登録 =====
+    # RAG 用のベクトル化は永続ジョブキュー（app.jobs）に積み、ジョブワーカーが実行する
+    # （チャット時の取り込みと同じ documents / chunks に入るので、先に済めばチャットでは何もしない）
+    phase = "enqueue_ingest_job"
+    try:
+        job = await job_queue.enqueue(
+            "ingest_attachment",
+            {"attachment_id": att_id},
+            owner_user_id=att_row.get("owner_user_id"),
+            attachment_id=att_id,
+        )
+    except Exception as e:
+        print("[attachments] enqueue ingest job error:", repr(e))
+        raise HTTPException(
+            status_code=500, detail=f"phase={phase}: failed to enqueue ingest job"
+        ) from e
+    return adopted_document_id, signed_url, job
+
+
+async def _stream_upload(
+    file: UploadFile, first: bytes, object_path: str, spool: upload_spool.SpoolWriter
+) -> storage_upload.UploadResult:
+    """読み込み済みの先頭 first に続けて file を Storage へ流し、送りながら手元の控え（spool）にも書く"""
+    pending = [first]
+
+    async def _read(n: int) -> bytes:
+        if pending:
+            return pending.pop()
+        return await file.read(n)
+
+    async def _spool(chunk: bytes):
+        try:
+            await asyncio.to_thread(spool.write, chunk)
+        except Exception as e:
+            print("[attachments] upload spool error:", repr(e))
+            spool.abort()
+
+    return await storage_upload.upload_stream(
+        _read,
+        STORAGE_BUCKET,
+        object_path,
+        content_type=file.content_type or "application/octet-stream",
+        size=file.size,
+        on_chunk=_spool,
+    )
+
+
+async def _commit_spool(spool: upload_spool.SpoolWriter, att_id: str):
+    try:
+        await asyncio.to_thread(spool.commit, att_id)
+    except Exception as e:
+        print("[attachments] upload spool error:", repr(e))
+        spool.abort()
+
+
 @router.post("/attachments")
 async def upload_attachment(
-    bg: BackgroundTasks,
     request: Request,
     file: UploadFile = File(...),
     thread_id: str = Form(...),
+    replaces_attachment_id: Optional[str] = Form(None),
     token: str = Depends(bearer_token),
 ):
     """
     1) Storage(private) へ保存（物理キーは attachment_id 基点 / thread_id 非依存）
     2) app.attachments へメタ登録
     3) 署名URLを返却（閲覧期限つき）
+    replaces_attachment_id を渡すと改訂版として扱い、旧添付の文書を引き継ぐ
+    （次のチャット時の取り込みでは、変わったチャンクだけを埋め込む）
     """
     phase = "start"
+    spool = None
     try:
         # ===== 1) Storage アップロード =====
         phase = "init_supabase_admin_client"
         sb = sb_admin()
         ensure_bucket(sb, STORAGE_BUCKET, public=False)
 
-        # === ファイル読み込み ===
+        # === ファイル読み込み（先頭だけ。空ファイルはここで弾く） ===
         phase = "read_file"
-        data = await file.read()
-        if not data or len(data) == 0:
+        first = await file.read(storage_upload.UPLOAD_READ_BYTES)
+        if not first:
             raise HTTPException(status_code=400, detail="phase=read_file: empty file")
 
         # === ファイルパス（保存先）を作成 ===
@@ -77,162 +272,411 @@ async def upload_attachment(
         object_path = f"attachments/{att_id}{ext}"  # attachements/<ランダムID>.<拡張子>
         storage_path = f"{STORAGE_BUCKET}/{object_path}"
 
-        # === ファイルをDBストレージに保尊 ===
-        phase = "storage_upload_try_upsert"
+        # === ファイルをDBストレージに保尊（全体をメモリに載せず、読みながら送る） ===
+        # 取り込み側がダウンロードし直さないよう、送りながら手元にも控えを書く
+        phase = "storage_upload_stream"
+        spool = await asyncio.to_thread(upload_spool.SpoolWriter, ext, file.size)
         try:
-            sb.storage.from_(STORAGE_BUCKET).upload(
+            uploaded = await _stream_upload(file, first, object_path, spool)
+        except storage_upload.StorageUploadError as e:
+            print(
+                "[attachments] upload failed:",
+                repr(e),
+                "mime=",
+                file.content_type,
+                "size=",
+                file.size,
+                "path=",
                 object_path,
-                data,
-                {
-                    "content-type": file.content_type or "application/octet-stream",
-                    "upsert": "false",  # 文字列で指定が必要なSDK向け
-                },
             )
-        except StorageException as e1:
-            # 400系は "x-upsert" でもう一度試す
-            status1 = e1.args[0] if e1.args else {}
-            code1 = status1.get("statusCode") if isinstance(status1, dict) else None
-            msg1 = status1.get("message") if isinstance(status1, dict) else None
-            print("[attachments] upload first failed:", repr(e1))
-            if code1 and 400 <= int(code1) < 500:
-                phase = "storage_upload_retry_x_upsert"
-                try:
-                    sb.storage.from_(STORAGE_BUCKET).upload(
-                        object_path,
-                        data,
-                        {
-                            "content-type": file.content_type
-                            or "application/octet-stream",
-                            "x-upsert": "false",
-                        },
-                    )
-                except StorageException as e2:
-                    status2 = e2.args[0] if e2.args else {}
-                    code2 = (
-                        status2.get("statusCode") if isinstance(status2, dict) else None
-                    )
-                    msg2 = status2.get("message") if isinstance(status2, dict) else None
-                    print(
-                        "[attachments] upload retry failed:",
-                        repr(e2),
-                        "mime=",
-                        file.content_type,
-                        "size=",
-                        len(data),
-                        "path=",
-                        object_path,
-                    )
-                    raise HTTPException(
-                        status_code=code2 or 500,
-                        detail=f"phase={phase}: storage upload failed: {msg2 or 'unknown'}",
-                    ) from e2
-            else:
-                raise HTTPException(
-                    status_code=code1 or 500,
-                    detail=f"phase={phase}: storage upload failed: {msg1 or 'unknown'}",
-                ) from e1
+            raise HTTPException(
+                status_code=e.status if 400 <= e.status < 600 else 500,
+                detail=f"phase={phase}: storage upload failed: {e.message or 'unknown'}",
+            ) from e
 
         # ===== 2) DB 紐づけ =====
-        phase = "fetch_thread_project"
+        phase = "register_attachment"
         client = SupaRest(token)  # データベース操作（CRUD）を行うクライアントを取得
+        att_row, project_id = await _insert_attachment(
+            client,
+            thread_id=thread_id,
+            storage_path=storage_path,
+            mime=file.content_type or "application/octet-stream",
+            size=uploaded.size,
+            title=file.filename or "ファイル",
+        )
+        att_id = att_row["id"]
+
+        # 控えに添付 ID の名前を付ける（失敗しても続行。取り込みは Storage から読む）
+        await _commit_spool(spool, att_id)
+
+        # ===== 3) 改訂版の引き継ぎ・署名URL・取り込みジョブ =====
+        adopted_document_id, signed_url, job = await _finish_attachment(
+            sb, client, att_row, object_path, replaces_attachment_id
+        )
+
+        # ===== OK =====
+        phase = "complete"
+        return {
+            "id": att_id,
+            "threadId": thread_id,
+            "projectId": project_id,
+            "path": storage_path,
+            "url": signed_url,
+            "mime": file.content_type or "application/octet-stream",
+            "size": uploaded.size,
+            "sha256": uploaded.sha256,
+            "jobId": job["id"],
+            "adoptedDocumentId": adopted_document_id,
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+
+        tb = traceback.format_exc()
+        print(
+            "[attachments] unexpected error at phase:", phase, "err=", repr(e), "\n", tb
+        )
+        raise HTTPException(status_code=500, detail=f"phase={phase}: unexpected error")
+    finally:
+        if spool is not None:
+            spool.abort()  # 名前を付けずに終わった控え（途中で失敗した場合）を消す
+
+
+@router.post("/attachments/batch")
+async def upload_attachments_batch(
+    files: List[UploadFile] = File(...),
+    thread_id: str = Form(...),
+    token: str = Depends(bearer_token),
+):
+    """
+    複数ファイルを 1 回のリクエストでアップロードする（フォルダごとの追加など）。
+    POST /attachments を件数分呼ぶのと同じ結果になるが、スレッドの確認・バケットの確認は 1 回、
+    Storage へは最大 ATTACHMENTS_BATCH_CONCURRENCY 本を並行に送り、
+    添付の登録（add_attachments）・署名 URL・取り込みジョブの登録はそれぞれ 1 回の呼び出しでまとめて行う。
+    ファイルごとの失敗（空ファイル・Storage エラー）は items の error に入れて、残りは続ける。
+    登録した添付は必ず items で返す（署名 URL・取り込みジョブの登録に失敗したものは url / jobId が null）。
+    改訂版（replaces_attachment_id）の引き継ぎは扱わない（POST /attachments を使う）
+    """
+    phase = "start"
+    spools: List[Optional[upload_spool.SpoolWriter]] = [None] * len(files)
+    try:
+        if not files or len(files) > ATTACHMENTS_BATCH_MAX_FILES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"phase=read_files: give 1..{ATTACHMENTS_BATCH_MAX_FILES} files",
+            )
+
+        # ===== 0) スレッド（RLS）とバケットの確認は 1 回だけ =====
+        phase = "fetch_thread_project"
+        client = SupaRest(token)
         try:
             trow = await client.get_one(
-                "threads",
-                select="project_id",
-                id=thread_id,
-                accept_profile="app",
-            )  # 指定したスレッドIDのスレッドを取得
+                "threads", select="project_id", id=thread_id, accept_profile="app"
+            )
         except Exception as e:
             print("[attachments] get_one(threads) error:", repr(e))
             raise HTTPException(
                 status_code=400, detail=f"phase={phase}: failed to fetch thread"
             ) from e
         if not trow:
-            raise HTTPException(
-                status_code=404, detail=f"phase={phase}: thread not found"
-            )
+            raise HTTPException(status_code=404, detail=f"phase={phase}: thread not found")
         project_id = trow["project_id"]
 
-        phase = "insert_attachment_row"
+        phase = "init_supabase_admin_client"
+        sb = sb_admin()
+        ensure_bucket(sb, STORAGE_BUCKET, public=False)
+
+        # ===== 1) Storage へ並行にアップロード =====
+        phase = "storage_upload_stream"
+        sem = asyncio.Semaphore(max(1, ATTACHMENTS_BATCH_CONCURRENCY))
+        results: List[dict] = [{} for _ in files]
+
+        async def _upload(i: int, file: UploadFile):
+            res = results[i]
+            res["filename"] = file.filename
+            async with sem:
+                first = await file.read(storage_upload.UPLOAD_READ_BYTES)
+                if not first:
+                    res["error"] = "phase=read_file: empty file"
+                    return
+                ext = os.path.splitext(file.filename or "")[1].lower()
+                object_path = f"attachments/{uuid.uuid4()}{ext}"
+                spools[i] = await asyncio.to_thread(upload_spool.SpoolWriter, ext, file.size)
+                try:
+                    uploaded = await _stream_upload(file, first, object_path, spools[i])
+                except storage_upload.StorageUploadError as e:
+                    print("[attachments] batch upload failed:", repr(e), "path=", object_path)
+                    res["error"] = f"phase={phase}: storage upload failed: {e.message or 'unknown'}"
+                    return
+                except Exception as e:
+                    print("[attachments] batch upload error:", repr(e), "path=", object_path)
+                    res["error"] = f"phase={phase}: storage upload failed"
+                    return
+            res.update(
+                object_path=object_path,
+                mime=file.content_type or "application/octet-stream",
+                uploaded=uploaded,
+            )
+
+        await asyncio.gather(*(_upload(i, f) for i, f in enumerate(files)))
+        done = [i for i, r in enumerate(results) if "uploaded" in r]
+
+        # ===== 2) DB 紐づけ（1 回の RPC） =====
+        phase = "insert_attachment_rows"
+        att_rows: List[dict] = []
+        if done:
+            try:
+                att_rows = await client.rpc(
+                    "add_attachments",
+                    {
+                        "in_items": [
+                            {
+                                "storage_path": f"{STORAGE_BUCKET}/{results[i]['object_path']}",
+                                "mime": results[i]["mime"],
+                                "size": results[i]["uploaded"].size,
+                                "title": results[i]["filename"] or "ファイル",
+                            }
+                            for i in done
+                        ],
+                        "in_project_id": project_id,
+                        "in_thread_id": thread_id,
+                    },
+                    accept_profile="app",
+                )
+            except Exception as e:
+                print("[attachments] insert attachments error:", repr(e))
+                raise HTTPException(
+                    status_code=400, detail=f"phase={phase}: failed to insert attachments"
+                ) from e
+        by_path = {row.get("storage_path"): row for row in att_rows or []}
+        for i in done:
+            row = by_path.get(f"{STORAGE_BUCKET}/{results[i]['object_path']}")
+            if row is None:
+                # RPC が行を返さなかった（想定外）。そのファイルだけ失敗として返す
+                results[i]["error"] = f"phase={phase}: attachment row not returned"
+                continue
+            results[i]["row"] = row
+            await _commit_spool(spools[i], row["id"])
+        registered = [i for i in done if "row" in results[i]]
+
+        # ここから先の失敗では登録済みの添付を捨てない（行は items で必ず返す）
+        # ===== 3) 取り込みジョブ（ファイルごとに 1 件。登録は 1 回の INSERT） =====
+        # 失敗した添付は jobId が null になる（チャット時の取り込みで補われる）
+        phase = "enqueue_ingest_job"
+        job_by_att: dict = {}
         try:
-            # 物理キーは att_id 基点で確定済みなので、そのまま格納
-            att = await client.rpc(
-                "add_attachment",
-                {
-                    "in_storage_path": storage_path,  # 物理キー（主キー）
-                    "in_mime": file.content_type or "application/octet-stream",
-                    "in_size": len(data),
-                    "in_title": file.filename or "ファイル",
-                    "in_project_id": project_id,  # 任意（null可）
-                    "in_thread_id": thread_id,  # 任意（null可）
-                },
-                accept_profile="app",
+            jobs = await job_queue.enqueue_many(
+                "ingest_attachment",
+                [
+                    {
+                        "payload": {"attachment_id": results[i]["row"]["id"]},
+                        "owner_user_id": results[i]["row"].get("owner_user_id"),
+                        "attachment_id": results[i]["row"]["id"],
+                    }
+                    for i in registered
+                ],
             )
-            att_id = (
-                att["id"] if isinstance(att, dict) else att[0]["id"]
-            )  # テーブル定義に合わせて取得
+            job_by_att = {j.get("attachment_id"): j for j in jobs}
         except Exception as e:
-            print("[attachments] insert attachment error:", repr(e))
-            raise HTTPException(
-                status_code=400, detail=f"phase={phase}: failed to insert attachment"
-            ) from e
+            print("[attachments] enqueue ingest jobs error:", repr(e))
 
-        # ===== 3) 署名URL =====
+        # ===== 4) 署名 URL（1 回。発行できなかったものは url が null） =====
         phase = "create_signed_url"
+        signed: dict = {}
         try:
-            signed = sb.storage.from_(STORAGE_BUCKET).create_signed_url(
-                object_path, 600
+            signed = await storage_upload.create_signed_urls(
+                STORAGE_BUCKET, [results[i]["object_path"] for i in registered], 600
+            )
+        except Exception as e:
+            print("[attachments] create_signed_urls error:", repr(e))
+
+        # ===== OK（items は送られたファイルの順） =====
+        phase = "complete"
+        items = []
+        for r in results:
+            if "row" not in r:
+                items.append({"filename": r.get("filename"), "error": r.get("error")})
+                continue
+            row, uploaded = r["row"], r["uploaded"]
+            items.append(
+                {
+                    "filename": r["filename"],
+                    "id": row["id"],
+                    "path": row["storage_path"],
+                    "url": signed.get(r["object_path"]),
+                    "mime": r["mime"],
+                    "size": uploaded.size,
+                    "sha256": uploaded.sha256,
+                    "jobId": (job_by_att.get(row["id"]) or {}).get("id"),
+                }
+            )
+        return {
+            "threadId": thread_id,
+            "projectId": project_id,
+            "uploaded": len(registered),
+            "failed": len(files) - len(registered),
+            "items": items,
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+
+        tb = traceback.format_exc()
+        print(
+            "[attachments] unexpected error at phase:", phase, "err=", repr(e), "\n", tb
+        )
+        raise HTTPException(status_code=500, detail=f"phase={phase}: unexpected error")
+    finally:
+        for spool in spools:
+            if spool is not None:
+                spool.abort()  # 名前を付けずに終わった控えを消す
+
+
+@router.post("/attachments/upload-url")
+async def create_upload_url(body: UploadUrlRequest, token: str = Depends(bearer_token)):
+    """
+    直接アップロード 1/2: Storage(private) への署名つきアップロード URL を発行する。
+    クライアントは uploadUrl へ本文を PUT し（API を経由しない）、続けて ticket を
+    POST /attachments/complete に渡して登録する
+    """
+    phase = "start"
+    try:
+        # 自分のスレッドか（RLS）を先に確かめる。他人のスレッド向けの URL は出さない
+        phase = "fetch_thread"
+        client = SupaRest(token)
+        try:
+            trow = await client.get_one(
+                "threads", select="id", id=body.threadId, accept_profile="app"
             )
-            if isinstance(signed, dict):
-                if signed.get("error"):
-                    msg = (
-                        signed["error"].get("message")
-                        if isinstance(signed["error"], dict)
-                        else str(signed["error"])
-                    )
-                    raise RuntimeError(msg or "signed url failed")
-                signed_url = (
-                    signed.get("signedURL")
-                    or signed.get("signedUrl")
-                    or signed.get("url")
-                )
-            else:
-                signed_url = (
-                    getattr(signed, "signedURL", None)
-                    or getattr(signed, "signedUrl", None)
-                    or getattr(signed, "url", None)
-                )
-            if not signed_url:
-                raise RuntimeError("signed url empty")
         except Exception as e:
-            print("[attachments] create_signed_url error:", repr(e))
+            print("[attachments] get_one(threads) error:", repr(e))
             raise HTTPException(
-                status_code=500, detail=f"phase={phase}: failed to create signed url"
+                status_code=400, detail=f"phase={phase}: failed to fetch thread"
             ) from e
+        if not trow:
+            raise HTTPException(status_code=404, detail=f"phase={phase}: thread not found")
 
-        # ===== 4) レスポンスを返した後のタスク処理 =====
-        # ここでは、ingest_from_storageを使用して、RAG用のベクトルデータベースを作成する
-        phase = "enqueue_ingest_task"
-        bg.add_task(
-            ingest_from_storage,
-            storage_bucket=STORAGE_BUCKET,
-            object_path=object_path,
-            project_id=project_id,
-            attachment_id=att_id,
-            title=(file.filename or "Untitled"),
-            mime=(file.content_type or "application/octet-stream"),
+        phase = "init_supabase_admin_client"
+        sb = sb_admin()
+        ensure_bucket(sb, STORAGE_BUCKET, public=False)
+
+        phase = "build_paths"
+        ext = os.path.splitext(body.filename)[1].lower()
+        object_path = f"attachments/{uuid.uuid4()}{ext}"
+
+        phase = "create_upload_url"
+        try:
+            signed = await storage_upload.create_upload_url(STORAGE_BUCKET, object_path)
+        except storage_upload.StorageUploadError as e:
+            print("[attachments] create_upload_url error:", repr(e))
+            raise HTTPException(
+                status_code=e.status if 400 <= e.status < 600 else 500,
+                detail=f"phase={phase}: {e.message or 'failed to create upload url'}",
+            ) from e
+
+        ticket = storage_upload.issue_ticket(
+            {
+                "path": object_path,
+                "thread": body.threadId,
+                "title": body.filename,
+                "mime": body.mime,
+                "size": body.size,
+            }
+        )
+        return {
+            "uploadUrl": signed["url"],
+            "token": signed["token"],
+            "path": f"{STORAGE_BUCKET}/{object_path}",
+            "ticket": ticket,
+            "expiresIn": storage_upload.UPLOAD_TICKET_TTL_SEC,
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print("[attachments] unexpected error at phase:", phase, "err=", repr(e))
+        raise HTTPException(status_code=500, detail=f"phase={phase}: unexpected error")
+
+
+@router.post("/attachments/complete")
+async def complete_upload(body: UploadCompleteRequest, token: str = Depends(bearer_token)):
+    """
+    直接アップロード 2/2: Storage に届いたオブジェクトを確かめ、app.attachments へ登録して
+    取り込みジョブを積む（レスポンスは POST /attachments と同じ形）。
+    同じチケットでの再送は、登録済みの添付を返す（取り込みジョブは積み直す。取り込み自体は冪等）
+    """
+    phase = "read_ticket"
+    try:
+        claims = storage_upload.read_ticket(body.ticket)
+        if not claims:
+            raise HTTPException(
+                status_code=400, detail=f"phase={phase}: invalid or expired upload ticket"
+            )
+        object_path = claims["path"]
+        thread_id = claims["thread"]
+        storage_path = f"{STORAGE_BUCKET}/{object_path}"
+
+        # ===== 1) Storage 上のオブジェクトを確認 =====
+        phase = "verify_object"
+        info = await storage_upload.object_info(STORAGE_BUCKET, object_path)
+        if info is None:
+            raise HTTPException(
+                status_code=409, detail=f"phase={phase}: object has not been uploaded yet"
+            )
+        if claims.get("size") and info["size"] != claims["size"]:
+            raise HTTPException(
+                status_code=400,
+                detail=f"phase={phase}: size mismatch (declared {claims['size']}, stored {info['size']})",
+            )
+        if info["size"] <= 0:
+            raise HTTPException(status_code=400, detail=f"phase={phase}: empty file")
+        mime = claims.get("mime") or info["content_type"] or "application/octet-stream"
+
+        # ===== 2) DB 紐づけ（再送なら登録済みの行を使う） =====
+        phase = "register_attachment"
+        sb = sb_admin()
+        client = SupaRest(token)
+        rows = await client.get(
+            "attachments",
+            params={"select": "*", "storage_path": f"eq.{storage_path}", "limit": 1},
+            accept_profile="app",
+        )
+        if rows:
+            att_row, project_id = rows[0], rows[0].get("project_id")
+            replaces = None  # 引き継ぎは初回で済んでいる
+        else:
+            att_row, project_id = await _insert_attachment(
+                client,
+                thread_id=thread_id,
+                storage_path=storage_path,
+                mime=mime,
+                size=info["size"],
+                title=claims.get("title") or "ファイル",
+            )
+            replaces = body.replacesAttachmentId
+
+        # ===== 3) 改訂版の引き継ぎ・署名URL・取り込みジョブ =====
+        adopted_document_id, signed_url, job = await _finish_attachment(
+            sb, client, att_row, object_path, replaces
         )
 
-        # ===== OK =====
         phase = "complete"
         return {
-            "id": att_id,
+            "id": att_row["id"],
             "threadId": thread_id,
             "projectId": project_id,
             "path": storage_path,
             "url": signed_url,
-            "mime": file.content_type or "application/octet-stream",
-            "size": len(data),
+            "mime": att_row.get("mime") or mime,
+            "size": info["size"],
+            "sha256": None,  # 本文は API を通らないので計算しない
+            "jobId": job["id"],
+            "adoptedDocumentId": adopted_document_id,
         }
 
     except HTTPException:
@@ -245,3 +689,129 @@ async def upload_attachment(
             "[attachments] unexpected error at phase:", phase, "err=", repr(e), "\n", tb
         )
         raise HTTPException(status_code=500, detail=f"phase={phase}: unexpected error")
+
+
+def _initial_state(att: dict, doc: Optional[dict]) -> bytes:
+    """購読開始時の 1 フレーム。documents.status を正とし、途中経過は配信ハブが覚えている最後のフレームで補う"""
+    att_id = att["id"]
+    last = ingest_progress.progress_hub.last(att_id)
+    last_stage = (ingest_progress.parse(last) or {}).get("stage") if last else None
+    status = (doc or {}).get("status")
+    if status in ingest_progress.TERMINAL:
+        if last_stage == status:
+            return last
+        return ingest_progress.frame(att_id, status, documentId=doc["id"])
+    # 取り込み中（別プロセスの分も中継で届いている）
+    if last and last_stage not in ingest_progress.TERMINAL:
+        return last
+    if status == "ingesting":
+        return ingest_progress.frame(att_id, "started", documentId=doc["id"])
+    # 画像は取り込まない（文書も作られない）ので、最初から ready
+    _, object_path = split_storage_path(att.get("storage_path") or "")
+    if is_image(att.get("mime"), object_path):
+        return ingest_progress.frame(att_id, "ready", skipped="image")
+    # 文書がまだ無い / 内容が変わって取り込み待ち（stale）
+    return ingest_progress.frame(att_id, "queued", documentId=(doc or {}).get("id"))
+
+
+async def _until_settled(frames, att_ids):
+    # すべての添付が ready / failed になったら閉じる
+    pending = set(att_ids)
+    try:
+        async for chunk in frames:
+            yield chunk
+            evt = ingest_progress.parse(chunk)
+            if evt and evt.get("stage") in ingest_progress.TERMINAL:
+                pending.discard(evt.get("attachmentId"))
+                if not pending:
+                    break
+    finally:
+        await frames.aclose()
+
+
+@router.get("/attachments/ingest-progress")
+async def ingest_progress_stream(
+    request: Request,
+    ids: str,
+    token: str = Depends(bearer_token),
+):
+    """
+    添付の取り込み進捗を SSE で流す（ids はカンマ区切りで複数可）。
+    最初に各添付の現在の状態を 1 フレームずつ送り、以降は取り込み側（別プロセスのジョブワーカーを含む）の
+    進捗をそのまま中継する: started → downloaded → extracted / embedded / inserted → ready | failed。
+    すべての添付が ready / failed になったら閉じる（failed の後にジョブが再試行されたら、購読し直す）
+    """
+    att_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not att_ids or len(att_ids) > INGEST_PROGRESS_MAX_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"phase=parse_ids: give 1..{INGEST_PROGRESS_MAX_IDS} attachment ids",
+        )
+    client = SupaRest(token)
+    id_in = f"in.({','.join(att_ids)})"
+
+    # ===== 見える添付だけに絞る（RLS） =====
+    phase = "fetch_attachments"
+    try:
+        atts = await client.get(
+            "attachments",
+            params={"select": "id,mime,storage_path", "id": id_in},
+            accept_profile="app",
+        )
+    except Exception as e:
+        print("[attachments] ingest-progress fetch error:", repr(e))
+        raise HTTPException(
+            status_code=500, detail=f"phase={phase}: failed to fetch attachments"
+        ) from e
+    by_id = {a["id"]: a for a in atts or []}
+    missing = [i for i in att_ids if i not in by_id]
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"phase={phase}: attachment not found: {','.join(missing)}",
+        )
+
+    async def _initial():
+        # 購読を登録した後に読む（読む間に届いた進捗は、この後に続けて流れる）
+        docs = await client.get(
+            "documents",
+            params={
+                "select": "id,attachment_id,status",
+                "attachment_id": id_in,
+                "order": "created_at.desc",
+            },
+            accept_profile="app",
+        )
+        latest: dict = {}
+        for d in docs or []:
+            latest.setdefault(d["attachment_id"], d)
+        return [_initial_state(by_id[i], latest.get(i)) for i in att_ids]
+
+    frames = ingest_progress.progress_hub.subscribe(*att_ids, initial=_initial)
+    return StreamingResponse(
+        safe_stream(_until_settled(frames, att_ids), request),
+        headers=SSE_HEADERS,
+    )
+
+
+@router.get("/attachments/embedding-cache")
+async def embedding_cache(token: str = Depends(bearer_token)):
+    """取り込み時の埋め込みキャッシュのヒット率（監視用。管理者のみ。プロセス起動からの累積）"""
+    await require_admin_or_403(token)
+    return embedding_cache_stats.snapshot()
+
+
+@router.get("/attachments/upload-spool")
+async def upload_spool_stats(token: str = Depends(bearer_token)):
+    """アップロードの控え（取り込み時のダウンロード省略）と、送信中バイト予算の状態（監視用。管理者のみ）"""
+    await require_admin_or_403(token)
+    snap = await asyncio.to_thread(upload_spool.stats.snapshot)
+    snap["inflight"] = storage_upload.budget.snapshot()
+    return snap
+
+
+@router.get("/attachments/extract-pool")
+async def extract_pool(token: str = Depends(bearer_token)):
+    """抽出用プロセスプールの状態（監視用。管理者のみ）"""
+    await require_admin_or_403(token)
+    return get_extract_pool().snapshot()
@@ -1,31 +1,108 @@
 from __future__ import annotations
-from fastapi import APIRouter, Depends
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
 from fastapi.responses import StreamingResponse
+from crud import SupaRest
 from deps import bearer_token
-from schemas.chat_schema import ChatRequest
+from utils.sse_stream import SSE_HEADERS, safe_stream
+from routers.admin import require_admin_or_403
+from schemas.chat_schema import ChatRequest, PrefetchRequest
 from chat_system.RAGchat import run_rag_chat
+from chat_system.retrieval import prefetch
+from services.generation_registry import owner_of, parse_last_event_id, registry
+from services.thread_hub import hub
+from services.model_router import router as model_router
+from services import openai_quota
 
 router = APIRouter(tags=["chat"])
 
 
-async def _safe_stream(gen):
-    async for chunk in gen:
-        if chunk is None:  # ← None は捨てる
-            continue
-        if isinstance(chunk, str):  # ← 念のため文字列は bytes に
-            chunk = chunk.encode("utf-8")
-        yield chunk
+@router.post("/chatbot")
+async def rag_chat(
+    req: ChatRequest,
+    request: Request,
+    token: str = Depends(bearer_token),
+    last_event_id: Optional[str] = Header(default=None, alias="Last-Event-ID"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+):
+    """
+    回答生成を SSE で返す。
+    - 各フレームに "id: <generation_id>:<seq>" を付与
+    - Last-Event-ID / Idempotency-Key 付きの再接続は、進行中または完了直後の
+      同じ生成に再接続し、取りこぼしたフレームだけを再送する（再計算しない）
+    """
+    owner = owner_of(token)
+    gen_id, after_seq = parse_last_event_id(last_event_id)
+    gen = registry.find(owner, generation_id=gen_id, key=idempotency_key)
+    if gen is not None and gen.thread_id != req.threadId:
+        gen = None
+    if gen is None:
+        gen = registry.start(
+            owner, req.threadId, run_rag_chat(req, token), key=idempotency_key
+        )
+        after_seq = -1
+    elif gen_id != gen.id:
+        # Idempotency-Key のみ一致：この生成の最初から再生する
+        after_seq = -1
 
+    return StreamingResponse(
+        safe_stream(gen.subscribe(after_seq), request),
+        headers={**SSE_HEADERS, "X-Generation-Id": gen.id},
+    )
 
-@router.post("/chatbot")
-async def rag_chat(req: ChatRequest, token: str = Depends(bearer_token)):
-    headers = {
-        "Content-Type": "text/event-stream",
-        "Cache-Control": "no-cache, no-transform",
-        "Connection": "keep-alive",
-        "X-Accel-Buffering": "no",
-    }
+
+@router.post("/chatbot/generations/{generation_id}/cancel")
+async def cancel_generation(generation_id: str, token: str = Depends(bearer_token)):
+    """
+    回答生成を止める（利用者の停止操作用）。
+    接続を切るだけだと Idempotency-Key 付きの生成は再接続の猶予ぶん走り続けるので、即座に打ち切る。
+    """
+    gen = registry.find(owner_of(token), generation_id=generation_id)
+    if gen is None:
+        raise HTTPException(status_code=404, detail="generation not found")
+    return {"cancelled": gen.cancel()}
+
+
+@router.post("/chatbot/prefetch", status_code=202)
+async def chat_prefetch(req: PrefetchRequest, token: str = Depends(bearer_token)):
+    """
+    入力中の下書き（デバウンス済み）を受け取り、埋め込みとスコープ付き検索を先に実行する。
+    結果は (スレッド, 正規化した質問文) 単位でキャッシュされ、本送信時に再利用される。
+    計算の完了は待たずに返す。
+    """
+    scheduled = prefetch(SupaRest(token), owner_of(token), req.threadId, req.text)
+    return {"scheduled": scheduled}
+
+
+@router.get("/chatbot/threads/{thread_id}/stream")
+async def thread_stream(
+    thread_id: str, request: Request, token: str = Depends(bearer_token)
+):
+    """
+    スレッドで進行中の回答生成を購読する（別タブ・共同閲覧者向け）。
+    生成は POST /chatbot 側で 1 回だけ行われ、フレームはハブ経由で配信される。
+    """
+    # RLS で閲覧できるスレッドかを確認
+    t = await SupaRest(token).get_one(
+        "threads", select="id", id=thread_id, accept_profile="app"
+    )
+    if not t:
+        raise HTTPException(status_code=404, detail="thread not found")
     return StreamingResponse(
-        _safe_stream(run_rag_chat(req, token)),
-        headers=headers,
+        safe_stream(hub.subscribe(thread_id), request),
+        headers=SSE_HEADERS,
     )
+
+
+@router.get("/chatbot/models")
+async def model_tiers(token: str = Depends(bearer_token)):
+    """モデルティアごとの観測レイテンシ・エラー率（監視用。管理者のみ）"""
+    await require_admin_or_403(token)
+    return model_router.snapshot()
+
+
+@router.get("/chatbot/quota")
+async def openai_quota_state(token: str = Depends(bearer_token)):
+    """OpenAI のレート制限の枠（モデルごとの残量・優先度別の待ち・429 の回数。監視用。管理者のみ）"""
+    await require_admin_or_403(token)
+    return openai_quota.snapshot()
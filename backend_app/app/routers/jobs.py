@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Depends, Query, HTTPException
+from typing import Optional
+
+from crud import SupaRest
+from deps import bearer_token
+
+# このファイル内のルートは"route/api/v1/jobs"から始まるようにする
+# ジョブ（取り込みなど）の状態確認用。RLS により自分のジョブだけが見える
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+JOB_COLUMNS = (
+    "id,kind,status,priority,attempts,max_attempts,run_at,last_error,result,"
+    "attachment_id,created_at,updated_at,finished_at"
+)
+
+
+@router.get("")
+async def list_jobs(
+    status: Optional[str] = Query(None, description="queued / running / succeeded / failed"),
+    kind: Optional[str] = Query(None),
+    attachment_id: Optional[str] = Query(None, alias="attachmentId"),
+    limit: int = Query(50, ge=1, le=200),
+    token: str = Depends(bearer_token),
+):
+    client = SupaRest(token)
+    params = {"select": JOB_COLUMNS, "order": "created_at.desc", "limit": limit}
+    if status:
+        params["status"] = f"eq.{status}"
+    if kind:
+        params["kind"] = f"eq.{kind}"
+    if attachment_id:
+        params["attachment_id"] = f"eq.{attachment_id}"
+    try:
+        return await client.get("jobs", params=params)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"list_jobs failed: {e}")
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str, token: str = Depends(bearer_token)):
+    client = SupaRest(token)
+    job = await client.get_one("jobs", select=JOB_COLUMNS, id=job_id, accept_profile="app")
+    if not job:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job
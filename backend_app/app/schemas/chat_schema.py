@@ -16,3 +16,8 @@ class ChatRequest(BaseModel):
     threadId: str
     messages: List[Message] = Field(min_items=1)
     attachmentIds: Optional[List[str]] = None
+
+
+class PrefetchRequest(BaseModel):
+    threadId: str
+    text: str = Field(max_length=8000)  # 入力途中の下書き
@@ -0,0 +1,152 @@
+from __future__ import annotations
+import hashlib, json, os, threading, unicodedata
+from typing import Dict, List, Optional, Sequence
+
+from config import EMBED_MODEL, EMBED_DIMS
+from crud import SupaRest
+from services.openai_client import embed_texts
+
+# チャンク埋め込みの永続キャッシュ（app.embedding_cache）
+# キーは (正規化したチャンク本文の sha256, 埋め込みモデル, 次元数)。
+# 同じ資料が別スレッド・別プロジェクトに上がっても、OpenAI には未登録のチャンクだけを投げる。
+# キャッシュ表は RLS で一般ユーザから隠し、service_role で読み書きする
+
+SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "1") == "1"
+# 1 回の一括参照に載せるハッシュ数（URL 長の制限に収まるように）
+EMBED_CACHE_LOOKUP_BATCH = int(os.getenv("EMBED_CACHE_LOOKUP_BATCH", "100"))
+
+TABLE = "embedding_cache"
+
+
+def normalize_chunk(text: str) -> str:
+    """表記ゆれ（Unicode 正規化・前後の空白）を吸収してからハッシュする"""
+    return unicodedata.normalize("NFKC", text or "").strip()
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(normalize_chunk(text).encode("utf-8")).hexdigest()
+
+
+class CacheStats:
+    """ヒット率などの累積値（プロセス単位。取り込みはスレッドからも呼ばれるのでロックする）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requested = 0  # 埋め込みを要求されたチャンク数
+        self.hits = 0  # キャッシュから返した数
+        self.deduped = 0  # 同じ呼び出し内の重複で省いた数
+        self.embedded = 0  # OpenAI に投げた数
+        self.errors = 0  # 参照・書き込みの失敗回数（失敗してもキャッシュなしで続行）
+
+    def record(self, **counts: int):
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "model": EMBED_MODEL,
+                "dims": EMBED_DIMS,
+                "enabled": EMBED_CACHE_ENABLED,
+                "requested": self.requested,
+                "hits": self.hits,
+                "deduped": self.deduped,
+                "embedded": self.embedded,
+                "errors": self.errors,
+                "hit_rate": round(self.hits / self.requested, 4) if self.requested else None,
+            }
+
+
+stats = CacheStats()
+
+
+def _parse_vector(v) -> List[float]:
+    # PostgREST は vector 型を "[0.1,0.2,...]" の文字列で返す
+    return json.loads(v) if isinstance(v, str) else list(v)
+
+
+async def _lookup(client: SupaRest, hashes: List[str]) -> Dict[str, List[float]]:
+    found: Dict[str, List[float]] = {}
+    for i in range(0, len(hashes), EMBED_CACHE_LOOKUP_BATCH):
+        part = hashes[i : i + EMBED_CACHE_LOOKUP_BATCH]
+        rows = await client.get(
+            TABLE,
+            params={
+                "select": "text_sha256,embedding",
+                "model": f"eq.{EMBED_MODEL}",
+                "dims": f"eq.{EMBED_DIMS}",
+                "text_sha256": f"in.({','.join(part)})",
+            },
+        )
+        for r in rows or []:
+            found[r["text_sha256"]] = _parse_vector(r["embedding"])
+    return found
+
+
+async def _store(client: SupaRest, vectors: Dict[str, List[float]]):
+    rows = [
+        {"text_sha256": h, "model": EMBED_MODEL, "dims": EMBED_DIMS, "embedding": v}
+        for h, v in vectors.items()
+    ]
+    for i in range(0, len(rows), EMBED_CACHE_LOOKUP_BATCH):
+        await client.upsert(
+            TABLE,
+            rows[i : i + EMBED_CACHE_LOOKUP_BATCH],
+            on_conflict="text_sha256,model,dims",
+            returning=False,
+        )
+
+
+async def embed_texts_cached(
+    texts: Sequence[str], *, client: Optional[SupaRest] = None
+) -> List[List[float]]:
+    """
+    embed_texts のキャッシュ付き版（戻り値は入力と同じ順序）
+    1) 全チャンクのハッシュを一括参照 → 2) 未登録分だけ重複を除いて埋め込み → 3) 結果を登録
+    """
+    if not texts:
+        return []
+    if not EMBED_CACHE_ENABLED:
+        stats.record(requested=len(texts), embedded=len(texts))
+        return await embed_texts(texts)
+
+    client = client or SupaRest(service_key=SUPABASE_SERVICE_ROLE_KEY)
+    hashes = [chunk_hash(t) for t in texts]
+    unique = list(dict.fromkeys(hashes))
+
+    try:
+        cached = await _lookup(client, unique)
+    except Exception as e:
+        print("[embedding_cache] lookup failed:", repr(e))
+        stats.record(errors=1)
+        cached = {}
+
+    # 未登録のハッシュごとに代表のテキストを 1 つ選んで埋め込む
+    first_text: Dict[str, str] = {}
+    for h, t in zip(hashes, texts):
+        if h not in cached:
+            first_text.setdefault(h, t)
+    missing = list(first_text)
+    fresh: Dict[str, List[float]] = {}
+    if missing:
+        vectors = await embed_texts([first_text[h] for h in missing])
+        fresh = dict(zip(missing, vectors))
+        try:
+            await _store(client, fresh)
+        except Exception as e:
+            print("[embedding_cache] store failed:", repr(e))
+            stats.record(errors=1)
+
+    n_hits = sum(1 for h in hashes if h in cached)
+    stats.record(
+        requested=len(texts),
+        hits=n_hits,
+        deduped=len(texts) - n_hits - len(missing),
+        embedded=len(missing),
+    )
+    print(
+        f"[embedding_cache] chunks={len(texts)} hits={n_hits} embedded={len(missing)}"
+    )
+    return [cached.get(h) or fresh[h] for h in hashes]
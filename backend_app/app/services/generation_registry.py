@@ -0,0 +1,203 @@
+from __future__ import annotations
+import asyncio, hashlib, os, time
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterable, AsyncIterator, Deque, Dict, Optional, Tuple
+from uuid import uuid4
+
+from utils.see import sse, sse_error_payload
+from services.thread_hub import hub
+
+# 1 生成あたりに保持する再送用フレーム数（古いものから捨てる）
+REPLAY_FRAMES = int(os.getenv("SSE_REPLAY_FRAMES", "2048"))
+# 完了後に再接続を受け付ける時間（秒）
+RESUME_TTL_SEC = float(os.getenv("SSE_RESUME_TTL_SEC", "120"))
+# Idempotency-Key 付きの生成で、購読者が 0 になってから打ち切るまでの猶予（秒）
+# 通信断からの再接続を待つためのもの。利用者が止めた場合は cancel() で猶予なしに打ち切る
+RESUME_GRACE_SEC = float(os.getenv("SSE_RESUME_GRACE_SEC", "3"))
+
+
+def owner_of(token: str) -> str:
+    """トークンから再接続の所有者識別子を作る（トークン自体は保持しない）"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+def parse_last_event_id(value: Optional[str]) -> Tuple[Optional[str], int]:
+    """
+    Last-Event-ID（"<generation_id>:<seq>"）を分解する。
+    不正な値は (None, -1) とし、最初から再生する扱いにする。
+    """
+    if not value or ":" not in value:
+        return (None, -1)
+    gen_id, _, seq = value.rpartition(":")
+    try:
+        return (gen_id, int(seq))
+    except ValueError:
+        return (None, -1)
+
+
+class Generation:
+    """
+    1 回の回答生成（run_rag_chat）を表す。
+    - フレームに連番を振り、SSE の id 行として "<generation_id>:<seq>" を付与
+    - 直近 REPLAY_FRAMES 件をリングバッファに保持し、再接続時に取りこぼし分だけ再送
+    - 生成は接続とは独立したタスクで動き、購読者がいなくなったら打ち切る
+      （購読者は POST /chatbot の接続だけ。スレッド配信（thread_hub）の閲覧者は数えないので、
+      閲覧者が残っていても依頼者が去れば打ち切る）
+    """
+
+    def __init__(self, owner: str, thread_id: str, key: Optional[str] = None):
+        self.id = str(uuid4())
+        self.owner = owner
+        self.thread_id = thread_id
+        self.key = key
+        self.frames: Deque[Tuple[int, bytes]] = deque(maxlen=REPLAY_FRAMES)
+        self.next_seq = 0
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._cond = asyncio.Condition()
+        self._grace: Optional[asyncio.Task] = None
+
+    # フレームを 1 件追加して購読者を起こす（同じスレッドの閲覧者にも配信）
+    async def publish(self, frame: bytes) -> int:
+        seq = self.next_seq
+        self.next_seq += 1
+        framed = f"id: {self.id}:{seq}\n".encode("utf-8") + frame
+        self.frames.append((seq, framed))
+        hub.publish(self.thread_id, framed)
+        async with self._cond:
+            self._cond.notify_all()
+        return seq
+
+    async def finish(self):
+        self.done = True
+        self.finished_at = time.time()
+        async with self._cond:
+            self._cond.notify_all()
+
+    # after_seq より後のフレームを順に返す（生成が終わるまで待つ）
+    async def subscribe(self, after_seq: int = -1) -> AsyncIterator[bytes]:
+        self.subscribers += 1
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+        try:
+            cursor = after_seq
+            oldest = self.frames[0][0] if self.frames else self.next_seq
+            if cursor + 1 < oldest and self.next_seq > 0:
+                # バッファから溢れた分は再送できないことを通知してから続きを送る
+                yield sse({"type": "resume_gap", "missed": oldest - cursor - 1})
+                cursor = oldest - 1
+            while True:
+                for seq, frame in list(self.frames):
+                    if seq > cursor:
+                        cursor = seq
+                        yield frame
+                if self.done and cursor >= self.next_seq - 1:
+                    return
+                async with self._cond:
+                    if not self.done and cursor >= self.next_seq - 1:
+                        await self._cond.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._on_idle()
+
+    # 利用者による停止：猶予を待たずに打ち切る
+    def cancel(self) -> bool:
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+        if self.task is None or self.task.done():
+            return False
+        self.task.cancel()
+        return True
+
+    # 購読者が 0 になった：再接続の見込みがなければ即座に打ち切る
+    def _on_idle(self):
+        if self.task is None or self.task.done():
+            return
+        if not self.key or RESUME_GRACE_SEC <= 0:
+            self.task.cancel()
+            return
+
+        async def _cancel_later():
+            await asyncio.sleep(RESUME_GRACE_SEC)
+            if self.subscribers == 0 and self.task and not self.task.done():
+                self.task.cancel()
+
+        self._grace = asyncio.ensure_future(_cancel_later())
+
+
+class GenerationRegistry:
+    """生成 ID / Idempotency-Key から進行中・完了直後の生成を引くための表"""
+
+    def __init__(self):
+        self._by_id: Dict[str, Generation] = {}
+        self._by_key: Dict[Tuple[str, str], str] = {}
+
+    # 完了後 RESUME_TTL_SEC を過ぎた生成を掃除
+    def _sweep(self):
+        now = time.time()
+        for gid, g in list(self._by_id.items()):
+            if g.done and g.finished_at and now - g.finished_at > RESUME_TTL_SEC:
+                self._by_id.pop(gid, None)
+                if g.key:
+                    self._by_key.pop((g.owner, g.key), None)
+
+    def find(
+        self,
+        owner: str,
+        *,
+        generation_id: Optional[str] = None,
+        key: Optional[str] = None,
+    ) -> Optional[Generation]:
+        self._sweep()
+        g = None
+        if generation_id:
+            g = self._by_id.get(generation_id)
+        if g is None and key:
+            gid = self._by_key.get((owner, key))
+            g = self._by_id.get(gid) if gid else None
+        # 他人の生成には再接続させない
+        return g if g is not None and g.owner == owner else None
+
+    # 新しい生成を登録し、フレーム供給タスクを起動する
+    def start(
+        self,
+        owner: str,
+        thread_id: str,
+        frames: AsyncIterable[Optional[bytes]],
+        *,
+        key: Optional[str] = None,
+    ) -> Generation:
+        self._sweep()
+        g = Generation(owner, thread_id, key)
+        self._by_id[g.id] = g
+        if key:
+            self._by_key[(owner, key)] = g.id
+
+        async def _produce():
+            try:
+                async with aclosing(frames) as src:
+                    async for chunk in src:
+                        if chunk is None:
+                            continue
+                        if isinstance(chunk, str):
+                            chunk = chunk.encode("utf-8")
+                        await g.publish(chunk)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 接続から切り離されているので、例外はエラーフレームとして届ける
+                await g.publish(sse(sse_error_payload(e, "generation")))
+            finally:
+                await g.finish()
+
+        g.task = asyncio.ensure_future(_produce())
+        return g
+
+
+registry = GenerationRegistry()
@@ -0,0 +1,91 @@
+from __future__ import annotations
+import json, os, time
+from typing import Any, Dict, Optional
+
+from services.thread_hub import ThreadHub
+from utils.see import sse
+
+# 取り込みの進捗配信（添付 ID ごと）
+# 取り込み側（ingest_sync / ingest_pipeline）が段ごとに publish し、
+# GET /attachments/ingest-progress の SSE が購読する。配信はスレッド配信と同じ ThreadHub を
+# 別チャンネルで使う（Postgres LISTEN/NOTIFY で、ジョブワーカーのプロセスで進んだ取り込みも届く）
+#
+# 1 フレーム = {"type": "ingest", "attachmentId", "stage", ...数値}
+#   stage: started / downloaded / extracted / embedded / inserted / ready / failed
+#   数値: bytes（ダウンロード量）, pages（抽出済みページ）, chunks（分割済みチャンク）,
+#         total（分割が終わって確定したチャンク数。確定前は null）,
+#         embedded（新しく埋め込んだ数）, reused（差分取り込みで流用した数）, inserted（INSERT 済み）
+#   threadId / projectId: 添付の所属（添付を読めた後のフレームに付く）
+#   failed は error（メッセージ）を持つ
+INGEST_PROGRESS_CHANNEL = os.getenv("INGEST_PROGRESS_CHANNEL", "app_ingest_progress")
+# 途中経過（extracted / embedded / inserted）を送る最小間隔（秒）。開始・ダウンロード・分割完了・終了は必ず送る
+INGEST_PROGRESS_INTERVAL_SEC = float(os.getenv("INGEST_PROGRESS_INTERVAL_SEC", "0.5"))
+# 最後の状態を覚えておく添付の数（後から購読した接続に現在の状態を返す）
+INGEST_PROGRESS_KEEP = int(os.getenv("INGEST_PROGRESS_KEEP", "1024"))
+
+TERMINAL = ("ready", "failed")
+
+progress_hub = ThreadHub(channel=INGEST_PROGRESS_CHANNEL, keep_last=INGEST_PROGRESS_KEEP)
+
+
+def frame(attachment_id: str, stage: str, **fields: Any) -> bytes:
+    return sse({"type": "ingest", "attachmentId": attachment_id, "stage": stage, **fields})
+
+
+def parse(data: bytes) -> Optional[Dict[str, Any]]:
+    """frame() が作ったフレームを読み戻す（keep-alive などは None）"""
+    if not data.startswith(b"data: "):
+        return None
+    try:
+        return json.loads(data[6:])
+    except ValueError:
+        return None
+
+
+class Reporter:
+    """
+    取り込み 1 回分の進捗。カウンタを足し込み、一定間隔ごと（force なら即座）に publish する。
+    ingest_pipeline の各段から同じイベントループ上で呼ばれる（スレッドからは呼ばない）
+    """
+
+    def __init__(self, attachment_id: str):
+        self.attachment_id = attachment_id
+        self.state: Dict[str, Any] = {
+            "bytes": None,
+            "pages": 0,
+            "chunks": 0,
+            "total": None,
+            "embedded": 0,
+            "reused": 0,
+            "inserted": 0,
+        }
+        self._sent_at = 0.0
+
+    def add(self, stage: str, **counts: int):
+        """カウンタに足して、必要なら送る（extracted / embedded / inserted の途中経過用）"""
+        for k, v in counts.items():
+            self.state[k] = (self.state.get(k) or 0) + v
+        self._emit(stage)
+
+    def scope(self, thread_id: Optional[str], project_id: Optional[str]):
+        """添付の所属を以降のフレームに付ける（検索キャッシュの破棄に使う）"""
+        self.state.update(threadId=thread_id, projectId=project_id)
+
+    def update(self, stage: str, force: bool = False, **fields: Any):
+        """値を上書きして送る"""
+        self.state.update(fields)
+        self._emit(stage, force=force)
+
+    def _emit(self, stage: str, force: bool = False):
+        now = time.monotonic()
+        # 段は並行して進む（抽出しながら埋め込む）ので、間引きは段によらず時間で行う
+        if not force and now - self._sent_at < INGEST_PROGRESS_INTERVAL_SEC:
+            return
+        self._sent_at = now
+        progress_hub.publish(self.attachment_id, frame(self.attachment_id, stage, **self.state))
+
+    def ready(self, **fields: Any):
+        self.update("ready", force=True, **fields)
+
+    def failed(self, exc: BaseException):
+        self.update("failed", force=True, error=str(exc)[:500] or type(exc).__name__)
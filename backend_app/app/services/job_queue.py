@@ -0,0 +1,153 @@
+from __future__ import annotations
+import asyncio, os, random
+from typing import Any, Dict, List, Optional
+
+from crud import SupaRest
+
+# 永続ジョブキュー（app.jobs）の操作
+# 登録・リース・完了/失敗の記録はサーバ（service_role）だけが行う。状態の参照はユーザのトークンで RLS 越しに行う
+
+SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# 再試行までの待ち時間（指数バックオフ + ジッタ）
+JOB_BACKOFF_BASE_SEC = float(os.getenv("JOB_BACKOFF_BASE_SEC", "5"))
+JOB_BACKOFF_MAX_SEC = float(os.getenv("JOB_BACKOFF_MAX_SEC", "600"))
+
+# ジョブの優先度（大きいほど先）
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+# 同じプロセス内のワーカーを登録直後に起こす（次のポーリングを待たない）
+_wakeup: Optional[asyncio.Event] = None
+
+
+def wakeup_event() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+
+def _admin() -> SupaRest:
+    return SupaRest(service_key=SUPABASE_SERVICE_ROLE_KEY)
+
+
+def backoff_sec(attempts: int) -> int:
+    """attempts 回目の失敗後に待つ秒数"""
+    base = min(JOB_BACKOFF_MAX_SEC, JOB_BACKOFF_BASE_SEC * (2 ** max(attempts - 1, 0)))
+    return int(base * random.uniform(0.8, 1.2))
+
+
+async def enqueue(
+    kind: str,
+    payload: Dict[str, Any],
+    *,
+    priority: int = PRIORITY_NORMAL,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+    owner_user_id: Optional[str] = None,
+    attachment_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    rows = await _admin().post(
+        "jobs",
+        json={
+            "kind": kind,
+            "payload": payload,
+            "priority": priority,
+            "max_attempts": max_attempts,
+            "owner_user_id": owner_user_id,
+            "attachment_id": attachment_id,
+        },
+        content_profile="app",
+        prefer="return=representation",
+    )
+    wakeup_event().set()
+    return rows[0]
+
+
+async def enqueue_many(
+    kind: str,
+    items: List[Dict[str, Any]],
+    *,
+    priority: int = PRIORITY_NORMAL,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+) -> List[Dict[str, Any]]:
+    """
+    同じ種類のジョブをまとめて登録する（1 回の INSERT）。
+    items は {"payload", "owner_user_id", "attachment_id"} の並び。戻り値は同じ順序のジョブの行
+    """
+    if not items:
+        return []
+    rows = await _admin().post(
+        "jobs",
+        json=[
+            {
+                "kind": kind,
+                "payload": it["payload"],
+                "priority": priority,
+                "max_attempts": max_attempts,
+                "owner_user_id": it.get("owner_user_id"),
+                "attachment_id": it.get("attachment_id"),
+            }
+            for it in items
+        ],
+        content_profile="app",
+        prefer="return=representation",
+    )
+    wakeup_event().set()
+    return rows
+
+
+# ==================================================
+## ワーカー側（workers/job_worker.py から使う）
+# ==================================================
+async def claim(
+    worker_id: str,
+    kinds: List[str],
+    limit: int,
+    lease_sec: int,
+    max_running: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    rows = await _admin().rpc(
+        "claim_jobs",
+        {
+            "in_worker": worker_id,
+            "in_kinds": kinds,
+            "in_limit": limit,
+            "in_lease_sec": lease_sec,
+            "in_max_running": max_running,
+        },
+    )
+    return rows or []
+
+
+async def heartbeat(job_id: str, worker_id: str, lease_sec: int) -> bool:
+    return bool(
+        await _admin().rpc(
+            "heartbeat_job",
+            {"in_id": job_id, "in_worker": worker_id, "in_lease_sec": lease_sec},
+        )
+    )
+
+
+async def finish(job_id: str, worker_id: str, result: Optional[Dict] = None) -> bool:
+    return bool(
+        await _admin().rpc(
+            "finish_job",
+            {"in_id": job_id, "in_worker": worker_id, "in_result": result},
+        )
+    )
+
+
+async def fail(job_id: str, worker_id: str, error: str, attempts: int) -> Optional[str]:
+    """失敗を記録し、新しい状態（'queued' なら再試行待ち / 'failed'）を返す"""
+    return await _admin().rpc(
+        "fail_job",
+        {
+            "in_id": job_id,
+            "in_worker": worker_id,
+            "in_error": error,
+            "in_retry_in_sec": backoff_sec(attempts),
+        },
+    )
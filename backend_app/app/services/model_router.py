@@ -0,0 +1,232 @@
+from __future__ import annotations
+import asyncio, os, re, time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import CHAT_MODEL
+from services.openai_client import acquire_llm, astream_llm
+
+# ==================================================
+## ティア定義
+# ==================================================
+# 形式: "<ティア名>:<モデル名>:<TTFT目標秒>:<入力100万トークンあたりのUSD>" をカンマ区切り
+# 小さい（速い・安い）順に並べる
+CHAT_MODEL_TIERS = os.getenv(
+    "CHAT_MODEL_TIERS",
+    f"nano:gpt-5-nano:2.0:0.05,mini:{CHAT_MODEL}:4.0:0.25,full:gpt-5:8.0:1.25",
+)
+# 1 リクエストあたりの入力コスト上限（USD）。超える場合は下位ティアに落とす
+CHAT_MAX_INPUT_COST_USD = float(os.getenv("CHAT_MAX_INPUT_COST_USD", "0.05"))
+# 最初のトークンを待つ上限 = TTFT目標 × この倍率。超えたら次のティアへフォールバック
+FALLBACK_TTFT_FACTOR = float(os.getenv("CHAT_FALLBACK_TTFT_FACTOR", "2.0"))
+# 直近のエラー率がこれを超えたティアは避ける
+MAX_ERROR_RATE = float(os.getenv("CHAT_MAX_ERROR_RATE", "0.5"))
+# SLO を外れたティアを再び試すまでの時間（秒）。観測が止まって復帰できなくなるのを防ぐ
+RECOVERY_SEC = float(os.getenv("CHAT_TIER_RECOVERY_SEC", "60"))
+# 統計の指数移動平均の重み
+_EWMA_ALPHA = 0.2
+
+# 文字数→トークン数の概算（日本語は 1 文字 ≒ 1 トークン寄りなので控えめに）
+_CHARS_PER_TOKEN = 2.0
+# 短い事実確認とみなす質問の文字数
+_SHORT_QUESTION_CHARS = 60
+# 下位ティアで扱う参照コンテキストの上限（概算トークン）
+_SMALL_CONTEXT_TOKENS = 1500
+# 総合・分析系の質問とみなす語
+_SYNTHESIS_RE = re.compile(
+    r"(比較|違い|なぜ|理由|要約|まとめ|考察|分析|説明して|設計|評価|長所|短所|メリット|デメリット"
+    r"|compare|difference|why|summari[sz]e|explain|analy[sz]e|design|evaluate|pros|cons)",
+    re.IGNORECASE,
+)
+
+
+@dataclass
+class TierStats:
+    """ティアごとの観測値（指数移動平均）"""
+
+    ttft: Optional[float] = None  # 最初のトークンまでの秒数
+    total: Optional[float] = None  # 生成完了までの秒数
+    error_rate: float = 0.0
+    calls: int = 0
+    updated_at: float = 0.0
+
+    def _ewma(self, old: Optional[float], new: float) -> float:
+        return new if old is None else (1 - _EWMA_ALPHA) * old + _EWMA_ALPHA * new
+
+    def record(self, ttft: Optional[float], total: Optional[float], ok: bool):
+        self.calls += 1
+        self.updated_at = time.time()
+        if ttft is not None:
+            self.ttft = self._ewma(self.ttft, ttft)
+        if total is not None:
+            self.total = self._ewma(self.total, total)
+        self.error_rate = self._ewma(self.error_rate, 0.0 if ok else 1.0)
+
+
+@dataclass
+class Tier:
+    name: str
+    model: str
+    ttft_slo: float
+    usd_per_mtok: float
+    stats: TierStats = field(default_factory=TierStats)
+
+    # 観測値が SLO を満たしているか（観測前は満たしているとみなす）
+    def healthy(self) -> bool:
+        if time.time() - self.stats.updated_at > RECOVERY_SEC:
+            return True  # しばらく観測がなければもう一度試す
+        if self.stats.error_rate > MAX_ERROR_RATE:
+            return False
+        return self.stats.ttft is None or self.stats.ttft <= self.ttft_slo
+
+
+@dataclass
+class Route:
+    """1 リクエスト分の選択結果（候補は優先順）"""
+
+    tiers: List[Tier]
+    reason: str
+    used: Optional[Tier] = None
+    fallbacks: int = 0
+
+    def describe(self) -> Dict:
+        return {
+            "tiers": [t.name for t in self.tiers],
+            "reason": self.reason,
+            "used": self.used.name if self.used else None,
+            "model": self.used.model if self.used else None,
+            "fallbacks": self.fallbacks,
+        }
+
+
+class _FirstTokenTimeout(Exception):
+    pass
+
+
+def _parse_tiers(spec: str) -> List[Tier]:
+    tiers: List[Tier] = []
+    for part in spec.split(","):
+        fields = [f.strip() for f in part.split(":")]
+        if len(fields) < 2 or not fields[1]:
+            continue
+        slo = float(fields[2]) if len(fields) > 2 and fields[2] else 4.0
+        cost = float(fields[3]) if len(fields) > 3 and fields[3] else 0.0
+        tiers.append(Tier(fields[0], fields[1], slo, cost))
+    if not tiers:
+        tiers.append(Tier("default", CHAT_MODEL, 4.0, 0.0))
+    return tiers
+
+
+class ModelRouter:
+    """
+    リクエストごとにモデルのティアを選ぶ。
+    - 質問の複雑さ（長さ・分析系の語・履歴の長さ）と参照コンテキストの量で基準ティアを決める
+    - 入力コストが上限を超える場合、観測 TTFT / エラー率が SLO を外れている場合は下位ティアへ
+    - 生成時は最初のトークンが遅い・失敗したティアから次の候補へ自動で切り替える
+    """
+
+    def __init__(self, tiers: List[Tier]):
+        self.tiers = tiers
+
+    def _estimate_tokens(self, history: list[dict], question: str, context: str) -> int:
+        chars = len(question) + len(context)
+        chars += sum(len(m.get("content") or "") for m in history)
+        return int(chars / _CHARS_PER_TOKEN)
+
+    def _base_index(self, history: list[dict], question: str, context: str) -> tuple[int, str]:
+        top = len(self.tiers) - 1
+        ctx_tokens = len(context) / _CHARS_PER_TOKEN
+        if _SYNTHESIS_RE.search(question) or len(question) > 4 * _SHORT_QUESTION_CHARS:
+            return (top, "synthesis")
+        if len(question) <= _SHORT_QUESTION_CHARS and ctx_tokens <= _SMALL_CONTEXT_TOKENS:
+            return (0, "short_factual")
+        if len(history) > 10:
+            return (min(1, top), "long_history")
+        return (min(1, top), "default")
+
+    def route(self, history: list[dict], question: str, context: str) -> Route:
+        idx, reason = self._base_index(history, question, context)
+
+        # コスト上限：見積もりが収まるティアまで下げる
+        tokens = self._estimate_tokens(history, question, context)
+        while idx > 0 and tokens * self.tiers[idx].usd_per_mtok / 1e6 > CHAT_MAX_INPUT_COST_USD:
+            idx -= 1
+            reason += "+cost_cap"
+
+        # レイテンシ / エラー率：SLO を外れていれば健全な下位ティアへ
+        if not self.tiers[idx].healthy():
+            for j in range(idx - 1, -1, -1):
+                if self.tiers[j].healthy():
+                    idx = j
+                    reason += "+slo_downgrade"
+                    break
+
+        # フォールバック順：選んだティア → それより下位（近い順）→ 上位
+        order = [self.tiers[idx]]
+        order += [self.tiers[j] for j in range(idx - 1, -1, -1)]
+        order += [self.tiers[j] for j in range(idx + 1, len(self.tiers))]
+        return Route(tiers=order, reason=reason)
+
+    async def astream(
+        self, route: Route, history: list[dict], question: str, context: str
+    ) -> AsyncIterator[str]:
+        """
+        候補ティアを順に試して差分を返す。
+        最初のトークンが届く前の遅延・失敗のみフォールバックする（途中からの切り替えはしない）。
+        """
+        last_error: Optional[Exception] = None
+        for i, tier in enumerate(route.tiers):
+            is_last = i == len(route.tiers) - 1
+            timeout = None if is_last else tier.ttft_slo * FALLBACK_TTFT_FACTOR
+            # レート制限の枠待ちはティアの遅さではないので、枠を取ってから計時を始める
+            grant = await acquire_llm(history, question, context, model=tier.model)
+            started = time.perf_counter()
+            ttft: Optional[float] = None
+            agen = astream_llm(history, question, context, model=tier.model, grant=grant)
+            try:
+                try:
+                    first = await asyncio.wait_for(agen.__anext__(), timeout)
+                except asyncio.TimeoutError:
+                    tier.stats.record(timeout, None, ok=False)  # 待った時間を下限値として記録
+                    raise _FirstTokenTimeout(f"{tier.name}: no token within {timeout}s")
+                except StopAsyncIteration:
+                    first = None
+                ttft = time.perf_counter() - started
+                route.used = tier
+                route.fallbacks = i
+                if first is not None:
+                    yield first
+                    async for delta in agen:
+                        yield delta
+                tier.stats.record(ttft, time.perf_counter() - started, ok=True)
+                return
+            except Exception as e:
+                if not isinstance(e, _FirstTokenTimeout):
+                    tier.stats.record(ttft, None, ok=False)
+                if ttft is not None or is_last:
+                    raise  # 出力開始後・最後の候補は呼び出し元へ
+                last_error = e
+                print(f"[model_router] fallback from {tier.name}:", repr(e))
+            finally:
+                await agen.aclose()
+        if last_error:
+            raise last_error
+
+    def snapshot(self) -> List[Dict]:
+        """ティアごとの観測値（デバッグ・監視用）"""
+        return [
+            {
+                "tier": t.name,
+                "model": t.model,
+                "ttft_slo": t.ttft_slo,
+                "ttft_ewma": t.stats.ttft,
+                "total_ewma": t.stats.total,
+                "error_rate": round(t.stats.error_rate, 3),
+                "calls": t.stats.calls,
+                "healthy": t.healthy(),
+            }
+            for t in self.tiers
+        ]
+
+
+router = ModelRouter(_parse_tiers(CHAT_MODEL_TIERS))
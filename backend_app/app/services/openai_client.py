@@ -1,30 +1,85 @@
 from __future__ import annotations
-from typing import Iterable, List, Dict
+import asyncio, threading, time
+from typing import AsyncIterator, Iterable, List, Dict, Optional, Sequence
 from openai import OpenAI
-from config import OPENAI_API_KEY, EMBED_MODEL
-
-CHAT_MODEL = "gpt-5-mini"
+from config import (
+    OPENAI_API_KEY,
+    EMBED_MODEL,
+    EMBED_DIMS,
+    CHAT_MODEL,
+    EMBED_BATCH_SIZE,
+    EMBED_CONCURRENCY,
+)
+from services import openai_quota
+from services.openai_quota import BACKGROUND, INTERACTIVE, OPENAI_MAX_RETRIES, RETRYABLE, retry_delay
 
 # OpenAI クライアント（シングルトン的に使う想定）
-oai = OpenAI(api_key=OPENAI_API_KEY)
+# 呼び出しはすべて openai_quota で枠を取ってから行う。応答の x-ratelimit-* ヘッダは httpx のフックで観測する。
+# SDK 自身の再試行は枠を取らずに投げ直すので切り、再試行はここで（枠を取り直して）行う
+oai = OpenAI(api_key=OPENAI_API_KEY, max_retries=0, http_client=openai_quota.http_client())
+
+
+# 次元数の指定。text-embedding-3-* だけが dimensions を受け付ける（ada-002 などは固定次元）
+def _dims_args() -> Dict[str, int]:
+    return {"dimensions": EMBED_DIMS} if EMBED_MODEL.startswith("text-embedding-3") else {}
+
 
+# 枠を取ってから埋め込みを 1 リクエスト投げる（失敗時は枠を取り直して再試行）
+async def _create_embeddings(inputs, priority: int):
+    tokens = openai_quota.estimate_tokens(*([inputs] if isinstance(inputs, str) else inputs))
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        grant = await openai_quota.acquire(EMBED_MODEL, tokens, priority)
+        try:
+            # OpenAI の Embeddings API は同期 I/O のため、イベントループを塞がないようスレッドで実行
+            r = await asyncio.to_thread(
+                oai.embeddings.create, model=EMBED_MODEL, input=inputs, **_dims_args()
+            )
+        except RETRYABLE as e:
+            grant.settle(0)  # 通らなかったリクエストはトークンを消費しない
+            if attempt == OPENAI_MAX_RETRIES:
+                raise
+            print(f"[openai_client] embeddings retry {attempt + 1}: {e!r}"[:200])
+            await asyncio.sleep(retry_delay(e, attempt))
+            continue
+        grant.settle(getattr(r.usage, "total_tokens", None))
+        return r
 
-# テキスト→ベクトルへ（埋め込み）
+
+# テキスト→ベクトルへ（埋め込み。チャットの質問文なので対話の優先度で枠を取る）
 async def embed_text(text: str) -> List[float]:
-    # OpenAI の Embeddings API は同期 I/O だが、
-    # 呼び出し側の整合をとるため async 関数として定義
-    r = oai.embeddings.create(model=EMBED_MODEL, input=text)
+    r = await _create_embeddings(text, INTERACTIVE)
     return r.data[0].embedding
 
 
-# LLM からストリーミング出力を得るジェネレータ
-# Responses API を利用し、差分テキストを yield
+# 複数テキストの埋め込み（取り込み用。バックグラウンドの優先度で枠を取る）
+# batch_size 件ずつ 1 リクエストにまとめ、最大 concurrency 本を並行に投げる。戻り値は入力と同じ順序
+async def embed_texts(
+    texts: Sequence[str],
+    *,
+    batch_size: int = EMBED_BATCH_SIZE,
+    concurrency: int = EMBED_CONCURRENCY,
+    priority: int = BACKGROUND,
+) -> List[List[float]]:
+    if not texts:
+        return []
+    batch_size = max(1, batch_size)
+    sem = asyncio.Semaphore(max(1, concurrency))
 
+    async def _batch(start: int) -> List[List[float]]:
+        async with sem:
+            r = await _create_embeddings(list(texts[start : start + batch_size]), priority)
+        # レスポンスの並びは index で保証されているので、念のため並べ直す
+        return [d.embedding for d in sorted(r.data, key=lambda d: d.index)]
 
-def stream_llm(history: list[dict], question: str, context: str) -> Iterable[str]:
+    batches = await asyncio.gather(
+        *(_batch(i) for i in range(0, len(texts), batch_size))
+    )
+    return [vec for batch in batches for vec in batch]
+
+
+def _messages(history: list[dict], question: str, context: str) -> list[dict]:
     system = "あなたは根拠ベースで回答します。最後に [1],[2],… の参照番号のみ列挙してください。"
-    # メッセージリスト
-    msgs = (
+    return (
         [{"role": "system", "content": system}]  # システムプロンプトの追加
         + history  # 履歴の追加
         + [
@@ -34,13 +89,150 @@ def stream_llm(history: list[dict], question: str, context: str) -> Iterable[str
             }
         ]  # 質問文の追加
     )
-    with oai.responses.stream(
-        model=CHAT_MODEL,
-        input=msgs,  # プロンプト
-        temperature=0,
-    ) as stream:
-        for event in stream:  # モデルがトークンを生成するたびに、差分を呼び出し元に返す
-            if event.type == "response.output_text.delta":
-                yield event.delta
-            elif event.type == "response.error":
-                raise RuntimeError(getattr(event, "error", "response.error"))
+
+
+# 生成 1 回分の枠の見積もり（入力の概算 + 出力の見積もり）
+def _llm_tokens(msgs: list[dict]) -> int:
+    return (
+        openai_quota.estimate_tokens(*(m.get("content") or "" for m in msgs))
+        + openai_quota.OPENAI_OUTPUT_TOKENS_EST
+    )
+
+
+# 生成 1 回分の枠を取る（対話の優先度。取れるまで待つ）
+# model_router は TTFT の計時を始める前にこれで枠を取り、astream_llm に渡す（枠待ちを TTFT に含めない）
+async def acquire_llm(
+    history: list[dict], question: str, context: str, *, model: Optional[str] = None
+) -> openai_quota.Grant:
+    return await openai_quota.acquire(
+        model or CHAT_MODEL, _llm_tokens(_messages(history, question, context)), INTERACTIVE
+    )
+
+
+# LLM からストリーミング出力を得るジェネレータ
+# Responses API を利用し、差分テキストを yield
+# stop がセットされたら上流ストリームを閉じて生成を打ち切る
+# grant（取得済みの枠）が無ければ、ここで枠を取るまで待つ（対話の優先度）。
+# 最初の差分より前の 429 などは、枠を取り直して再試行する
+
+
+def stream_llm(
+    history: list[dict],
+    question: str,
+    context: str,
+    *,
+    model: Optional[str] = None,
+    stop: Optional[threading.Event] = None,
+    on_open=None,  # 開いたストリームを受け取るコールバック（外部から close するため）
+    grant=None,
+) -> Iterable[str]:
+    model = model or CHAT_MODEL
+    # メッセージリスト
+    msgs = _messages(history, question, context)
+    emitted: List[str] = []
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        if grant is None:
+            grant = openai_quota.acquire_blocking(model, _llm_tokens(msgs), INTERACTIVE)
+        try:
+            with oai.responses.stream(
+                model=model,
+                input=msgs,  # プロンプト
+                temperature=0,
+            ) as stream:
+                if on_open:
+                    on_open(stream)
+                for event in stream:  # モデルがトークンを生成するたびに、差分を呼び出し元に返す
+                    if stop is not None and stop.is_set():
+                        break  # with を抜けると HTTP ストリームが閉じられ、上流の生成も止まる
+                    if event.type == "response.output_text.delta":
+                        emitted.append(event.delta)
+                        yield event.delta
+                    elif event.type == "response.completed":
+                        usage = getattr(event.response, "usage", None)
+                        grant.settle(getattr(usage, "total_tokens", None))
+                    elif event.type == "response.error":
+                        raise RuntimeError(getattr(event, "error", "response.error"))
+            return
+        except RETRYABLE as e:
+            if emitted or attempt == OPENAI_MAX_RETRIES or (stop is not None and stop.is_set()):
+                raise
+            grant.settle(0)
+            grant = None
+            print(f"[openai_client] responses retry {attempt + 1}: {e!r}"[:200])
+            time.sleep(retry_delay(e, attempt))
+        finally:
+            # response.completed（usage）が届かなかった場合（打ち切り・エラー・呼び出し元の close）も精算する。
+            # 出力が始まっていれば入力と出力の概算、始まる前なら 0（使わなかった分を戻す）
+            if grant is not None:
+                grant.settle(
+                    openai_quota.estimate_tokens(*(m.get("content") or "" for m in msgs), *emitted)
+                    if emitted
+                    else 0
+                )
+
+
+# stream_llm を別スレッドで回し、差分をイベントループ側へ渡す非同期版
+# 同期ストリームがイベントループを塞がないようにし、
+# 呼び出し側がキャンセル / aclose した時点で上流ストリームを即座に閉じる
+async def astream_llm(
+    history: list[dict],
+    question: str,
+    context: str,
+    *,
+    model: Optional[str] = None,
+    grant: Optional[openai_quota.Grant] = None,
+) -> AsyncIterator[str]:
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+    opened: dict = {}
+
+    def _put(kind: str, value=None):
+        # ループ終了後に届いた通知は捨てる
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+        except RuntimeError:
+            pass
+
+    def _worker():
+        try:
+            for delta in stream_llm(
+                history,
+                question,
+                context,
+                model=model,
+                stop=stop,
+                on_open=lambda s: opened.setdefault("stream", s),
+                grant=grant,
+            ):
+                _put("delta", delta)
+        except Exception as e:
+            # 打ち切りで閉じたソケットの読み込みエラーは無視
+            if not stop.is_set():
+                _put("error", e)
+        finally:
+            _put("end")
+
+    # 枠はイベントループ側で待つ（待っている間の切断・キャンセルでスレッドを塞がない）
+    if grant is None:
+        grant = await acquire_llm(history, question, context, model=model)
+    worker = loop.run_in_executor(None, _worker)
+    try:
+        while True:
+            kind, value = await queue.get()
+            if kind == "delta":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                break
+    finally:
+        if not worker.done():
+            # 切断・キャンセル時: 次のトークンを待たずにストリームを閉じる
+            stop.set()
+            s = opened.get("stream")
+            if s is not None:
+                try:
+                    s.close()
+                except Exception:
+                    pass
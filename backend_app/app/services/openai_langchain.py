@@ -0,0 +1,159 @@
+from __future__ import annotations
+import asyncio, time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from services import openai_quota
+from services.openai_quota import INTERACTIVE, OPENAI_MAX_RETRIES, RETRYABLE, retry_delay
+
+# LangChain 経由の OpenAI 呼び出し（chat_system/chatbot.py・chatagent.py・create_documents/create_DB.py）を
+# services/openai_quota のスケジューラに通すためのラッパ。
+# - ChatOpenAI は rate_limiter で呼び出しごとに枠を取る（入力の長さは分からないので見積もりは固定値。
+#   実際の消費は応答ヘッダの残量で補正される）
+# - OpenAIEmbeddings は chunk_size 件ずつ枠を取ってから投げる
+# どちらも応答ヘッダを観測する httpx クライアントを使う。
+# SDK の再試行は枠を取らずに投げ直すので切り（max_retries=0）、ここで枠を取り直して再試行する
+# （ストリームは最初のチャンクより前の失敗だけ）
+
+
+class QuotaRateLimiter(BaseRateLimiter):
+    def __init__(self, model: str, priority: int = INTERACTIVE, tokens: Optional[int] = None):
+        self.model = model
+        self.priority = priority
+        self.tokens = tokens or 2 * openai_quota.OPENAI_OUTPUT_TOKENS_EST
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        openai_quota.acquire_blocking(self.model, self.tokens, self.priority)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        await openai_quota.acquire(self.model, self.tokens, self.priority)
+        return True
+
+
+def _log_retry(kind: str, attempt: int, e: Exception):
+    print(f"[openai_langchain] {kind} retry {attempt + 1}: {e!r}"[:200])
+
+
+class QuotaChatOpenAI(ChatOpenAI):
+    """失敗した呼び出しを、rate_limiter で枠を取り直してから再試行する ChatOpenAI"""
+
+    def _generate(self, *args: Any, **kwargs: Any):
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            try:
+                return super()._generate(*args, **kwargs)
+            except RETRYABLE as e:
+                if attempt == OPENAI_MAX_RETRIES:
+                    raise
+                _log_retry("chat", attempt, e)
+                time.sleep(retry_delay(e, attempt))
+                self.rate_limiter.acquire()
+
+    async def _agenerate(self, *args: Any, **kwargs: Any):
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            try:
+                return await super()._agenerate(*args, **kwargs)
+            except RETRYABLE as e:
+                if attempt == OPENAI_MAX_RETRIES:
+                    raise
+                _log_retry("chat", attempt, e)
+                await asyncio.sleep(retry_delay(e, attempt))
+                await self.rate_limiter.aacquire()
+
+    def _stream(self, *args: Any, **kwargs: Any) -> Iterator[Any]:
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            started = False
+            try:
+                for chunk in super()._stream(*args, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except RETRYABLE as e:
+                if started or attempt == OPENAI_MAX_RETRIES:
+                    raise
+                _log_retry("chat stream", attempt, e)
+                time.sleep(retry_delay(e, attempt))
+                self.rate_limiter.acquire()
+
+    async def _astream(self, *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            started = False
+            try:
+                async for chunk in super()._astream(*args, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except RETRYABLE as e:
+                if started or attempt == OPENAI_MAX_RETRIES:
+                    raise
+                _log_retry("chat stream", attempt, e)
+                await asyncio.sleep(retry_delay(e, attempt))
+                await self.rate_limiter.aacquire()
+
+
+def chat_model(model: str, *, priority: int = INTERACTIVE, **kwargs: Any) -> ChatOpenAI:
+    return QuotaChatOpenAI(
+        model=model,
+        rate_limiter=QuotaRateLimiter(model, priority),
+        max_retries=0,
+        http_client=openai_quota.http_client(),
+        http_async_client=openai_quota.async_http_client(),
+        **kwargs,
+    )
+
+
+class QuotaEmbeddings(OpenAIEmbeddings):
+    priority: int = INTERACTIVE
+
+    def embed_documents(
+        self, texts: List[str], chunk_size: Optional[int] = None, **kwargs: Any
+    ) -> List[List[float]]:
+        step = chunk_size or self.chunk_size
+        out: List[List[float]] = []
+        for i in range(0, len(texts), step):
+            part = texts[i : i + step]
+            tokens = openai_quota.estimate_tokens(*part)
+            for attempt in range(OPENAI_MAX_RETRIES + 1):
+                openai_quota.acquire_blocking(self.model, tokens, self.priority)
+                try:
+                    out.extend(super().embed_documents(part, chunk_size=step, **kwargs))
+                    break
+                except RETRYABLE as e:
+                    if attempt == OPENAI_MAX_RETRIES:
+                        raise
+                    _log_retry("embeddings", attempt, e)
+                    time.sleep(retry_delay(e, attempt))
+        return out
+
+    async def aembed_documents(
+        self, texts: List[str], chunk_size: Optional[int] = None, **kwargs: Any
+    ) -> List[List[float]]:
+        step = chunk_size or self.chunk_size
+        out: List[List[float]] = []
+        for i in range(0, len(texts), step):
+            part = texts[i : i + step]
+            tokens = openai_quota.estimate_tokens(*part)
+            for attempt in range(OPENAI_MAX_RETRIES + 1):
+                await openai_quota.acquire(self.model, tokens, self.priority)
+                try:
+                    out.extend(await super().aembed_documents(part, chunk_size=step, **kwargs))
+                    break
+                except RETRYABLE as e:
+                    if attempt == OPENAI_MAX_RETRIES:
+                        raise
+                    _log_retry("embeddings", attempt, e)
+                    await asyncio.sleep(retry_delay(e, attempt))
+        return out
+
+
+def embeddings(model: str, *, priority: int = INTERACTIVE, **kwargs: Any) -> QuotaEmbeddings:
+    return QuotaEmbeddings(
+        model=model,
+        priority=priority,
+        max_retries=0,
+        http_client=openai_quota.http_client(),
+        http_async_client=openai_quota.async_http_client(),
+        **kwargs,
+    )
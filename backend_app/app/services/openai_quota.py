@@ -0,0 +1,373 @@
+from __future__ import annotations
+import asyncio, heapq, itertools, json, os, re, threading, time
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import openai
+
+# OpenAI のレート制限（RPM / TPM）をプロセス内で分け合うスケジューラ
+# チャットの生成・質問文の埋め込み（対話）と、取り込みの一括埋め込み・Chroma の構築（バックグラウンド）が
+# 同じ組織の上限を使うので、呼び出し前に必ずここで枠を取る（services/openai_client.py / openai_langchain.py）
+# - モデルごとに 2 つのトークンバケット（リクエスト数・トークン数。1 分で満杯まで回復）
+# - 対話は厳密に優先: 対話の待ちがある間はバックグラウンドに枠を渡さない。
+#   さらにバックグラウンドは上限の OPENAI_INTERACTIVE_RESERVE 分を残して使う（別プロセスの対話のため）
+# - 応答の x-ratelimit-* ヘッダで上限・残量を補正し、429 なら retry-after まで全員を止める。
+#   残量は組織全体の値なので、別プロセス（API ワーカー・ジョブワーカー・create_DB）の消費もここに反映される
+# - トークン数は呼び出し前に見積もり、応答の usage で実際の値に差し替える
+
+OPENAI_QUOTA_ENABLED = os.getenv("OPENAI_QUOTA_ENABLED", "1") == "1"
+# ヘッダを見るまでの既定の上限（組織のティアに合わせる）
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+# モデルごとの上限（"<モデル名>:<RPM>:<TPM>" をカンマ区切り。例: "text-embedding-3-small:3000:1000000"）
+OPENAI_MODEL_LIMITS = os.getenv("OPENAI_MODEL_LIMITS", "")
+# バックグラウンドが使わずに残す割合（対話用）
+OPENAI_INTERACTIVE_RESERVE = float(os.getenv("OPENAI_INTERACTIVE_RESERVE", "0.2"))
+# 生成の出力トークンの見積もり（入力に足して枠を取る。完了時に実際の値で精算する）
+OPENAI_OUTPUT_TOKENS_EST = int(os.getenv("OPENAI_OUTPUT_TOKENS_EST", "1000"))
+# 429 で retry-after が無いときに止める秒数
+OPENAI_RATE_LIMIT_PAUSE_SEC = float(os.getenv("OPENAI_RATE_LIMIT_PAUSE_SEC", "1.0"))
+# 429・接続エラー・5xx の再試行回数。SDK 自身の再試行は枠を取らずに投げ直すので切り（max_retries=0）、
+# 呼び出し側（openai_client / openai_langchain）が枠を取り直して再試行する
+# （429 はスケジューラが retry-after まで止めるので、枠を取り直すだけで待たされる）
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+RETRYABLE = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+_PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# 待ちの再確認の最大間隔（秒）。枠の回復はタイマーではなく、待っている側が起きて確かめる
+_MAX_WAIT_SEC = 1.0
+# 文字数→トークン数の概算（日本語は 1 文字 ≒ 1 トークン寄りなので控えめに）
+_CHARS_PER_TOKEN = 2.0
+# x-ratelimit-reset-* の形式（"1s" / "6m0s" / "20ms" / "1h2m3.5s"）
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def estimate_tokens(*texts: str) -> int:
+    return int(sum(len(t or "") for t in texts) / _CHARS_PER_TOKEN) + 1
+
+
+def retry_delay(e: Exception, attempt: int) -> float:
+    """再試行までに待つ秒数（429 はスケジューラ側で止まるので待たない）"""
+    if isinstance(e, openai.RateLimitError) and OPENAI_QUOTA_ENABLED:
+        return 0.0
+    return min(8.0, 0.5 * 2**attempt)
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total, found = 0.0, False
+    for num, unit in _DURATION_RE.findall(value):
+        total += float(num) * {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}[unit]
+        found = True
+    return total if found else None
+
+
+def _parse_model_limits(spec: str) -> Dict[str, tuple]:
+    out: Dict[str, tuple] = {}
+    for part in spec.split(","):
+        fields = [f.strip() for f in part.split(":")]
+        if len(fields) == 3 and fields[0]:
+            out[fields[0]] = (int(fields[1]), int(fields[2]))
+    return out
+
+
+_MODEL_LIMITS = _parse_model_limits(OPENAI_MODEL_LIMITS)
+
+
+class _Bucket:
+    """1 分で capacity まで回復するトークンバケット（level は精算の結果、負になることもある）"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.level = self.capacity
+        self._at = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._at) * self.capacity / 60.0)
+        self._at = now
+
+    def wait_for(self, amount: float) -> float:
+        """amount 以上になるまでの秒数"""
+        return max(0.0, (amount - self.level) * 60.0 / self.capacity)
+
+    def sync(self, limit: Optional[int], remaining: Optional[int]):
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            # 残量は組織全体の値。自分の見積もりより少なければ、他のプロセスが使った分を差し引く
+            self.level = min(self.level, float(remaining))
+
+
+class _Waiter:
+    __slots__ = ("priority", "tokens", "wake", "granted", "cancelled")
+
+    def __init__(self, priority: int, tokens: int, wake: Callable[[], None]):
+        self.priority = priority
+        self.tokens = tokens
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+
+class Grant:
+    """取った枠。settle で実際のトークン数に精算する（多く取りすぎた分は戻し、足りない分は差し引く）"""
+
+    def __init__(self, scheduler: "QuotaScheduler", tokens: int):
+        self._scheduler = scheduler
+        self.tokens = tokens
+        self._settled = False
+
+    def settle(self, used_tokens: Optional[int]):
+        if self._settled or used_tokens is None:
+            return
+        self._settled = True
+        self._scheduler._adjust(self.tokens - used_tokens)
+
+
+class QuotaScheduler:
+    """1 モデル分の RPM / TPM。同期（スレッド）・非同期のどちらからも枠を取れる"""
+
+    def __init__(self, model: str, rpm: int, tpm: int):
+        self.model = model
+        self._lock = threading.Lock()
+        self._requests = _Bucket(rpm)
+        self._tokens = _Bucket(tpm)
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._stats = {
+            "granted": {name: 0 for name in _PRIORITY_NAMES.values()},
+            "waited_sec": {name: 0.0 for name in _PRIORITY_NAMES.values()},
+            "rate_limited": 0,
+        }
+
+    # ==================================================
+    ## 枠の割り当て（ロックの中で呼ぶ）
+    # ==================================================
+    def _cost(self, w: _Waiter) -> float:
+        # 上限より大きい要求でも、いつかは通るように頭打ちにする
+        reserve = OPENAI_INTERACTIVE_RESERVE if w.priority == BACKGROUND else 0.0
+        return min(float(w.tokens), self._tokens.capacity * (1.0 - reserve))
+
+    def _pump(self) -> float:
+        """先頭から順に、枠が足りる限り割り当てる。戻り値は先頭が通れるまでの見込み秒数"""
+        now = time.monotonic()
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        while self._heap:
+            w: _Waiter = self._heap[0][2]
+            if w.cancelled:
+                heapq.heappop(self._heap)
+                continue
+            if now < self._paused_until:
+                return self._paused_until - now
+            # バックグラウンドは上限の一部を対話用に残す
+            reserve = OPENAI_INTERACTIVE_RESERVE if w.priority == BACKGROUND else 0.0
+            need_req = 1.0 + reserve * self._requests.capacity
+            need_tok = self._cost(w) + reserve * self._tokens.capacity
+            if self._requests.level < need_req or self._tokens.level < need_tok:
+                return max(self._requests.wait_for(need_req), self._tokens.wait_for(need_tok))
+            heapq.heappop(self._heap)
+            self._requests.level -= 1.0
+            self._tokens.level -= self._cost(w)
+            w.granted = True
+            w.wake()
+        return _MAX_WAIT_SEC
+
+    def _enqueue(self, priority: int, tokens: int, wake: Callable[[], None]) -> _Waiter:
+        w = _Waiter(priority, max(1, int(tokens)), wake)
+        heapq.heappush(self._heap, (priority, next(self._seq), w))
+        return w
+
+    def _granted(self, w: _Waiter, started: float) -> Grant:
+        name = _PRIORITY_NAMES[w.priority]
+        with self._lock:
+            self._stats["granted"][name] += 1
+            self._stats["waited_sec"][name] += time.monotonic() - started
+        return Grant(self, int(self._cost(w)))
+
+    def _abandon(self, w: _Waiter):
+        # 待ちを取り消す。入れ違いで割り当て済みなら枠を戻す
+        with self._lock:
+            if w.granted:
+                self._requests.level += 1.0
+                self._tokens.level += self._cost(w)
+            w.cancelled = True
+            self._pump()
+
+    def _adjust(self, tokens: float):
+        with self._lock:
+            self._tokens.level = min(self._tokens.capacity, self._tokens.level + tokens)
+            self._pump()
+
+    # ==================================================
+    ## 公開
+    # ==================================================
+    async def acquire(self, tokens: int, priority: int = INTERACTIVE) -> Grant:
+        loop = asyncio.get_running_loop()
+        ev = asyncio.Event()
+        started = time.monotonic()
+        with self._lock:
+            w = self._enqueue(priority, tokens, lambda: loop.call_soon_threadsafe(ev.set))
+        try:
+            while True:
+                with self._lock:
+                    wait = self._pump()
+                if w.granted:
+                    return self._granted(w, started)
+                try:
+                    await asyncio.wait_for(ev.wait(), min(max(wait, 0.01), _MAX_WAIT_SEC))
+                except asyncio.TimeoutError:
+                    pass
+                ev.clear()
+        except BaseException:
+            self._abandon(w)
+            raise
+
+    def acquire_blocking(self, tokens: int, priority: int = INTERACTIVE) -> Grant:
+        """同期版（スレッドで動く呼び出し・LangChain の同期 API 用）"""
+        ev = threading.Event()
+        started = time.monotonic()
+        with self._lock:
+            w = self._enqueue(priority, tokens, ev.set)
+        try:
+            while True:
+                with self._lock:
+                    wait = self._pump()
+                if w.granted:
+                    return self._granted(w, started)
+                ev.wait(min(max(wait, 0.01), _MAX_WAIT_SEC))
+                ev.clear()
+        except BaseException:
+            self._abandon(w)
+            raise
+
+    def observe(self, headers: httpx.Headers, status_code: int):
+        """応答ヘッダで上限・残量を補正する。429 なら指定の時間だけ全員を止める"""
+
+        def _int(name: str) -> Optional[int]:
+            v = headers.get(name)
+            try:
+                return int(v) if v is not None else None
+            except ValueError:
+                return None
+
+        with self._lock:
+            self._requests.sync(
+                _int("x-ratelimit-limit-requests"), _int("x-ratelimit-remaining-requests")
+            )
+            self._tokens.sync(
+                _int("x-ratelimit-limit-tokens"), _int("x-ratelimit-remaining-tokens")
+            )
+            if status_code == 429:
+                self._stats["rate_limited"] += 1
+                retry = _parse_duration(headers.get("retry-after-ms"))
+                retry = retry / 1000.0 if retry is not None else None
+                if retry is None:
+                    retry = _parse_duration(headers.get("retry-after"))
+                if retry is None:
+                    exhausted = (
+                        "x-ratelimit-reset-tokens"
+                        if _int("x-ratelimit-remaining-tokens") == 0
+                        else "x-ratelimit-reset-requests"
+                    )
+                    retry = _parse_duration(headers.get(exhausted))
+                pause = retry if retry is not None else OPENAI_RATE_LIMIT_PAUSE_SEC
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+                self._requests.level = min(self._requests.level, 0.0)
+            self._pump()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            waiting = [w for _, _, w in self._heap if not w.cancelled]
+            return {
+                "model": self.model,
+                "rpm": int(self._requests.capacity),
+                "tpm": int(self._tokens.capacity),
+                "requests_available": round(self._requests.level, 1),
+                "tokens_available": round(self._tokens.level),
+                "paused_sec": round(max(0.0, self._paused_until - now), 3),
+                "waiting": {
+                    name: sum(1 for w in waiting if w.priority == p)
+                    for p, name in _PRIORITY_NAMES.items()
+                },
+                "granted": dict(self._stats["granted"]),
+                "waited_sec": {k: round(v, 3) for k, v in self._stats["waited_sec"].items()},
+                "rate_limited": self._stats["rate_limited"],
+            }
+
+
+_schedulers: Dict[str, QuotaScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler(model: str) -> QuotaScheduler:
+    with _schedulers_lock:
+        s = _schedulers.get(model)
+        if s is None:
+            rpm, tpm = _MODEL_LIMITS.get(model, (OPENAI_RPM, OPENAI_TPM))
+            s = _schedulers[model] = QuotaScheduler(model, rpm, tpm)
+        return s
+
+
+class _NoQuota:
+    # OPENAI_QUOTA_ENABLED=0 のときの、何もしない枠
+    def settle(self, used_tokens: Optional[int]):
+        pass
+
+
+async def acquire(model: str, tokens: int, priority: int = INTERACTIVE):
+    if not OPENAI_QUOTA_ENABLED:
+        return _NoQuota()
+    return await scheduler(model).acquire(tokens, priority)
+
+
+def acquire_blocking(model: str, tokens: int, priority: int = INTERACTIVE):
+    if not OPENAI_QUOTA_ENABLED:
+        return _NoQuota()
+    return scheduler(model).acquire_blocking(tokens, priority)
+
+
+def observe_response(response: httpx.Response):
+    """OpenAI クライアント（httpx）の response フック。本文のモデル名でバケットを選ぶ"""
+    if not OPENAI_QUOTA_ENABLED:
+        return
+    try:
+        model = json.loads(response.request.content or b"{}").get("model")
+    except (ValueError, AttributeError, httpx.RequestNotRead):
+        return
+    if model:
+        scheduler(str(model)).observe(response.headers, response.status_code)
+
+
+def http_client() -> httpx.Client:
+    """ヘッダを観測する httpx クライアント（OpenAI / LangChain のクライアントに渡す）"""
+    return httpx.Client(timeout=600.0, event_hooks={"response": [observe_response]})
+
+
+def async_http_client() -> httpx.AsyncClient:
+    async def _hook(response: httpx.Response):
+        observe_response(response)
+
+    return httpx.AsyncClient(timeout=600.0, event_hooks={"response": [_hook]})
+
+
+def snapshot() -> Dict:
+    with _schedulers_lock:
+        items = list(_schedulers.values())
+    return {
+        "enabled": OPENAI_QUOTA_ENABLED,
+        "reserve": OPENAI_INTERACTIVE_RESERVE,
+        "models": [s.snapshot() for s in items],
+    }
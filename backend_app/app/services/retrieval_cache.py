@@ -0,0 +1,86 @@
+from __future__ import annotations
+import asyncio, os, re, time, unicodedata
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+# 先読み結果の保持時間（秒）と件数上限
+PREFETCH_TTL_SEC = float(os.getenv("PREFETCH_TTL_SEC", "120"))
+PREFETCH_MAX_ENTRIES = int(os.getenv("PREFETCH_MAX_ENTRIES", "2048"))
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """入力途中と送信時の表記ゆれ（全角半角・空白）を吸収してキーにする"""
+    return _WS_RE.sub(" ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+class TTLCache:
+    """
+    TTL 付き LRU キャッシュ。値の代わりに計算中のタスクも保持し、
+    同じキーへの同時要求（先読みと本送信など）は 1 回の計算を共有する。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+
+    def _get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        stored_at, value = item
+        if time.monotonic() - stored_at > self._ttl:
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def drop(self, predicate: Callable[[Hashable], bool]) -> int:
+        """predicate に当てはまるキーを捨てる（計算中のものは結果を保存しない）。戻り値は捨てた数"""
+        keys = [k for k in self._data if predicate(k)]
+        for k in keys:
+            self._data.pop(k, None)
+        return len(keys)
+
+    def peek(self, key: Hashable) -> bool:
+        """計算済み（または計算中）の値があるか"""
+        return self._get(key) is not None
+
+    async def get_or_compute(
+        self, key: Hashable, factory: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        value = self._get(key)
+        if value is None:
+            value = asyncio.ensure_future(factory())
+            self._set(key, value)
+        if not isinstance(value, asyncio.Future):
+            return value
+        try:
+            # 呼び出し元が切断しても共有中の計算は止めない
+            result = await asyncio.shield(value)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if self._data.get(key, (0, None))[1] is value:
+                self._data.pop(key, None)  # 失敗は保持しない
+            raise
+        if self._data.get(key, (0, None))[1] is value:
+            self._data[key] = (self._data[key][0], result)
+        return result
+
+
+# 質問文 → 埋め込みベクトル
+embedding_cache = TTLCache(PREFETCH_MAX_ENTRIES, PREFETCH_TTL_SEC)
+# (所有者, スレッド, プロジェクト, 質問文) → スコープ付きベクトル検索の結果
+# （スレッド・プロジェクトへの取り込みが終わると chat_system/retrieval.py が捨てる）
+retrieval_cache = TTLCache(PREFETCH_MAX_ENTRIES, PREFETCH_TTL_SEC)
+# (所有者, スレッド) → プロジェクトID
+thread_project_cache = TTLCache(PREFETCH_MAX_ENTRIES, PREFETCH_TTL_SEC)
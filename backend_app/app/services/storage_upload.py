@@ -0,0 +1,342 @@
+from __future__ import annotations
+import asyncio, base64, hashlib, hmac, json, os, time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, quote, urlparse
+
+import httpx
+
+# Storage へのストリーミング・アップロード
+# UploadFile を一定サイズずつ読みながら送り、ファイル全体をメモリに載せない。
+# - 大きなファイル（サイズが分かっていて STORAGE_TUS_MIN_BYTES 以上）は TUS（再開可能アップロード）で
+#   STORAGE_TUS_CHUNK_BYTES ずつ送る。途中で失敗したらサーバの受信済み位置から、その塊だけを送り直す
+# - それ以外は 1 回の POST に本文を逐次流す
+# - 読み込み中・送信中の塊はプロセス全体のバイト予算（UPLOAD_INFLIGHT_BYTES）で数え、
+#   同時アップロードが多くてもワーカーのメモリを使い切らないようにする
+# 送りながら sha256 とサイズを計算して返す
+# 直接アップロード（ブラウザ → Storage。API プロセスはバイト列に触れない）用に、
+# 署名つきアップロード URL の発行・オブジェクトの確認・登録用の控え（チケット）もここで扱う
+# 閲覧用の署名 URL の一括発行（まとめてアップロードした添付用）もここにある
+
+SUPABASE_URL = os.environ["SUPABASE_URL"].rstrip("/")
+SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+
+UPLOAD_READ_BYTES = int(os.getenv("UPLOAD_READ_BYTES", str(1024 * 1024)))
+# Supabase の TUS エンドポイントは 6MB 固定の塊を要求する
+STORAGE_TUS_CHUNK_BYTES = int(os.getenv("STORAGE_TUS_CHUNK_BYTES", str(6 * 1024 * 1024)))
+STORAGE_TUS_MIN_BYTES = int(os.getenv("STORAGE_TUS_MIN_BYTES", str(20 * 1024 * 1024)))
+STORAGE_UPLOAD_RETRIES = int(os.getenv("STORAGE_UPLOAD_RETRIES", "3"))
+UPLOAD_INFLIGHT_BYTES = int(os.getenv("UPLOAD_INFLIGHT_BYTES", str(256 * 1024 * 1024)))
+# 直接アップロードのチケットの有効期限（Storage の署名つきアップロード URL は 2 時間で切れる）
+UPLOAD_TICKET_TTL_SEC = int(os.getenv("UPLOAD_TICKET_TTL_SEC", "7200"))
+UPLOAD_TICKET_SECRET = os.getenv("UPLOAD_TICKET_SECRET") or SUPABASE_SERVICE_ROLE_KEY
+
+
+class StorageUploadError(RuntimeError):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"storage upload failed ({status}): {message}")
+        self.status = status
+        self.message = message
+
+
+class ByteBudget:
+    """バイト数で数えるセマフォ。acquire(n) は予算に n バイトの空きができるまで待つ"""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.in_use = 0
+        self.waiting = 0
+        self._cond: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self, n: int) -> int:
+        # 予算より大きい要求は予算全体として扱う（永久に待たない）
+        n = min(n, self.capacity)
+        cond = self._condition()
+        async with cond:
+            self.waiting += 1
+            try:
+                await cond.wait_for(lambda: self.in_use + n <= self.capacity)
+            finally:
+                self.waiting -= 1
+            self.in_use += n
+        return n
+
+    async def release(self, n: int):
+        cond = self._condition()
+        async with cond:
+            self.in_use -= n
+            cond.notify_all()
+
+    def snapshot(self) -> dict:
+        return {"capacity": self.capacity, "in_use": self.in_use, "waiting": self.waiting}
+
+
+budget = ByteBudget(UPLOAD_INFLIGHT_BYTES)
+
+# 読み込んだ塊ごとに呼ぶ処理（ローカルの控えへの書き出しなど）
+OnChunk = Callable[[bytes], Awaitable[None]]
+
+
+class UploadResult:
+    def __init__(self):
+        self._sha = hashlib.sha256()
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        self._sha.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._sha.hexdigest()
+
+
+def _headers(extra: Optional[dict] = None) -> dict:
+    h = {
+        "apikey": SUPABASE_SERVICE_ROLE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    }
+    h.update(extra or {})
+    return h
+
+
+def _error(r: httpx.Response) -> StorageUploadError:
+    try:
+        body = r.json()
+        msg = body.get("message") or body.get("error") or r.text
+        status = int(body.get("statusCode") or r.status_code)
+    except Exception:
+        msg, status = r.text, r.status_code
+    return StorageUploadError(status, str(msg)[:200])
+
+
+async def upload_stream(
+    read: Callable[[int], Awaitable[bytes]],
+    bucket: str,
+    object_path: str,
+    *,
+    content_type: str,
+    size: Optional[int] = None,
+    upsert: bool = False,
+    on_chunk: Optional[OnChunk] = None,
+) -> UploadResult:
+    """
+    read(n) で読める本文を Storage の bucket/object_path へ送る。
+    size が分かっていて十分大きければ TUS、そうでなければ 1 回の POST（本文は逐次送信）
+    """
+    result = UploadResult()
+    if size is not None and size >= STORAGE_TUS_MIN_BYTES:
+        await _upload_tus(read, bucket, object_path, content_type, size, upsert, result, on_chunk)
+    else:
+        await _upload_single(read, bucket, object_path, content_type, upsert, result, on_chunk)
+    return result
+
+
+async def _upload_single(read, bucket, object_path, content_type, upsert, result, on_chunk):
+    async def body() -> AsyncIterator[bytes]:
+        while True:
+            held = await budget.acquire(UPLOAD_READ_BYTES)
+            try:
+                chunk = await read(UPLOAD_READ_BYTES)
+                if not chunk:
+                    return
+                result.update(chunk)
+                if on_chunk:
+                    await on_chunk(chunk)
+                yield chunk  # 送信が済むまで（次の読み込みまで）予算を持ち続ける
+            finally:
+                await budget.release(held)
+
+    url = f"{SUPABASE_URL}/storage/v1/object/{bucket}/{quote(object_path)}"
+    headers = _headers({"content-type": content_type, "x-upsert": "true" if upsert else "false"})
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, read=300.0)) as client:
+        r = await client.post(url, headers=headers, content=body())
+    if r.status_code >= 400:
+        raise _error(r)
+
+
+async def _upload_tus(read, bucket, object_path, content_type, size, upsert, result, on_chunk):
+    def _meta(**kv: str) -> str:
+        return ",".join(f"{k} {base64.b64encode(v.encode()).decode()}" for k, v in kv.items())
+
+    tus = {"Tus-Resumable": "1.0.0"}
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, read=300.0)) as client:
+        r = await client.post(
+            f"{SUPABASE_URL}/storage/v1/upload/resumable",
+            headers=_headers(
+                {
+                    **tus,
+                    "Upload-Length": str(size),
+                    "Upload-Metadata": _meta(
+                        bucketName=bucket,
+                        objectName=object_path,
+                        contentType=content_type,
+                        cacheControl="3600",
+                    ),
+                    "x-upsert": "true" if upsert else "false",
+                }
+            ),
+        )
+        if r.status_code >= 400:
+            raise _error(r)
+        location = r.headers["location"]
+        if location.startswith("/"):
+            location = f"{SUPABASE_URL}{location}"
+
+        offset = 0
+        while offset < size:
+            held = await budget.acquire(STORAGE_TUS_CHUNK_BYTES)
+            try:
+                chunk = await _read_exact(read, STORAGE_TUS_CHUNK_BYTES)
+                if not chunk:
+                    raise StorageUploadError(400, f"upload ended early at {offset}/{size} bytes")
+                result.update(chunk)
+                if on_chunk:
+                    await on_chunk(chunk)
+                offset = await _send_chunk(client, location, tus, chunk, offset)
+            finally:
+                await budget.release(held)
+
+
+async def _read_exact(read, n: int) -> bytes:
+    # UploadFile.read は要求より短く返すことがあるので、塊の大きさまで読み足す
+    parts, got = [], 0
+    while got < n:
+        part = await read(min(UPLOAD_READ_BYTES, n - got))
+        if not part:
+            break
+        parts.append(part)
+        got += len(part)
+    return b"".join(parts)
+
+
+async def _send_chunk(client: httpx.AsyncClient, location: str, tus: dict, chunk: bytes, offset: int) -> int:
+    """1 塊を送り、新しい受信済み位置を返す。失敗したらサーバの位置を確かめて残りだけ送り直す"""
+    end = offset + len(chunk)
+    sent = offset
+    for attempt in range(STORAGE_UPLOAD_RETRIES + 1):
+        try:
+            r = await client.patch(
+                location,
+                headers=_headers(
+                    {
+                        **tus,
+                        "Upload-Offset": str(sent),
+                        "Content-Type": "application/offset+octet-stream",
+                    }
+                ),
+                content=chunk[sent - offset :],
+            )
+            if r.status_code < 400:
+                return int(r.headers.get("upload-offset", end))
+            if r.status_code < 500 and r.status_code != 409:
+                raise _error(r)  # 409 は位置のずれ。それ以外の 4xx は送り直しても無駄
+        except httpx.TransportError as e:
+            if attempt == STORAGE_UPLOAD_RETRIES:
+                raise StorageUploadError(502, repr(e))
+        if attempt == STORAGE_UPLOAD_RETRIES:
+            raise _error(r)
+        await asyncio.sleep(0.5 * (2**attempt))
+        head = await client.head(location, headers=_headers(tus))
+        if head.status_code >= 400:
+            raise _error(head)
+        sent = int(head.headers.get("upload-offset", offset))
+        if not offset <= sent <= end:
+            raise StorageUploadError(409, f"unexpected upload offset {sent} (chunk {offset}-{end})")
+        if sent == end:
+            return end
+    return end
+
+
+# ==================================================
+## 直接アップロード
+# ==================================================
+async def create_upload_url(bucket: str, object_path: str, *, upsert: bool = False) -> Dict[str, str]:
+    """
+    署名つきアップロード URL を発行する。クライアントはここへ本文を PUT する
+    （認証ヘッダ不要。URL の token が bucket/object_path への 1 回分の書き込み権になる）
+    """
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        r = await client.post(
+            f"{SUPABASE_URL}/storage/v1/object/upload/sign/{bucket}/{quote(object_path)}",
+            headers=_headers({"x-upsert": "true" if upsert else "false"}),
+        )
+    if r.status_code >= 400:
+        raise _error(r)
+    url = r.json()["url"]  # "/object/upload/sign/<bucket>/<path>?token=..."
+    return {
+        "url": f"{SUPABASE_URL}/storage/v1{url}",
+        "token": parse_qs(urlparse(url).query).get("token", [""])[0],
+    }
+
+
+async def create_signed_urls(
+    bucket: str, object_paths: List[str], expires_in: int = 600
+) -> Dict[str, Optional[str]]:
+    """閲覧用の署名 URL をまとめて発行する（1 リクエスト）。object_path → URL（失敗したものは None）"""
+    if not object_paths:
+        return {}
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        r = await client.post(
+            f"{SUPABASE_URL}/storage/v1/object/sign/{bucket}",
+            headers=_headers({"content-type": "application/json"}),
+            json={"expiresIn": expires_in, "paths": object_paths},
+        )
+    if r.status_code >= 400:
+        raise _error(r)
+    out: Dict[str, Optional[str]] = {p: None for p in object_paths}
+    for item in r.json():
+        url = item.get("signedURL") or item.get("signedUrl")
+        if item.get("path") in out and url and not item.get("error"):
+            out[item["path"]] = f"{SUPABASE_URL}/storage/v1{url}"
+    return out
+
+
+async def object_info(bucket: str, object_path: str) -> Optional[Dict[str, Any]]:
+    """Storage 上のオブジェクトのサイズと Content-Type。無ければ None"""
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        r = await client.head(
+            f"{SUPABASE_URL}/storage/v1/object/authenticated/{bucket}/{quote(object_path)}",
+            headers=_headers(),
+        )
+    if r.status_code in (400, 404):  # 版によっては無いオブジェクトを 400 で返す
+        return None
+    if r.status_code >= 400:
+        raise _error(r)
+    return {
+        "size": int(r.headers.get("content-length") or 0),
+        "content_type": r.headers.get("content-type"),
+    }
+
+
+def issue_ticket(claims: Dict[str, Any]) -> str:
+    """
+    アップロード URL と一緒に返すチケット。登録時に受け取り、発行した内容（保存先・スレッドなど）を
+    そのまま使う（クライアントが保存先を差し替えて他人のオブジェクトを登録できないようにする）
+    """
+    body = dict(claims, exp=int(time.time()) + UPLOAD_TICKET_TTL_SEC)
+    raw = base64.urlsafe_b64encode(json.dumps(body, separators=(",", ":")).encode()).decode().rstrip("=")
+    return f"{raw}.{_sign(raw)}"
+
+
+def read_ticket(ticket: str) -> Optional[Dict[str, Any]]:
+    """署名と期限を確かめてチケットの中身を返す。不正・期限切れは None"""
+    raw, _, sig = (ticket or "").partition(".")
+    if not raw or not hmac.compare_digest(sig, _sign(raw)):
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4)))
+    except ValueError:
+        return None
+    if int(claims.get("exp") or 0) < time.time():
+        return None
+    return claims
+
+
+def _sign(raw: str) -> str:
+    mac = hmac.new(UPLOAD_TICKET_SECRET.encode(), raw.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).decode().rstrip("=")
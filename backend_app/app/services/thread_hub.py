@@ -0,0 +1,218 @@
+from __future__ import annotations
+import asyncio, json, os
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+from uuid import uuid4
+
+from utils.see import sse
+
+# 購読者ごとのバッファ上限（溢れたら古いフレームから捨てる）
+SUBSCRIBER_BUFFER = int(os.getenv("THREAD_STREAM_BUFFER", "512"))
+# 無通信時に送るコメント行の間隔（秒）。プロキシによる切断を防ぐ
+KEEPALIVE_SEC = float(os.getenv("THREAD_STREAM_KEEPALIVE_SEC", "15"))
+
+# ワーカー間中継（Postgres LISTEN/NOTIFY）。DSN 未設定ならプロセス内のみで配信
+PUBSUB_DSN = os.getenv("STREAM_PUBSUB_DSN") or os.getenv("DATABASE_URL") or ""
+PUBSUB_CHANNEL = os.getenv("STREAM_PUBSUB_CHANNEL", "app_thread_stream")
+# NOTIFY のペイロード上限は 8000 バイト。超えるフレームは中継しない
+_NOTIFY_MAX_BYTES = 7900
+# 送信待ちの上限と、1 回の NOTIFY でまとめて送る件数
+_RELAY_QUEUE_MAX = 4096
+_RELAY_BATCH = 64
+
+
+def _has_asyncpg() -> bool:
+    # asyncpg が利用可能かどうかを返す
+    try:
+        import asyncpg  # type: ignore  # noqa: F401
+
+        return True
+    except Exception:
+        return False
+
+
+class _Subscriber:
+    """1 接続分の受信キュー（有界。溢れた分は数だけ覚えておく）"""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER)
+        self.dropped = 0
+
+    def offer(self, frame: bytes):
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(frame)
+
+
+class ThreadHub:
+    """
+    スレッド単位の SSE 配信ハブ。
+    - 生成側はフレームを 1 回 publish するだけで、同じスレッドを開いている全接続に届く
+    - 購読者ごとに有界バッファを持ち、遅い接続が生成側を止めないようにする
+    - PUBSUB_DSN が設定されていれば Postgres NOTIFY で他ワーカーの購読者にも中継する
+    channel を変えれば、スレッド以外のキー（添付 ID など）の配信にも使える。
+    keep_last > 0 なら、キーごとに最後のフレームを（新しい順に keep_last キー分）覚えておく。
+    watch() で、購読者とは別にすべてのフレームを受け取るコールバックを登録できる
+    """
+
+    def __init__(self, channel: str = PUBSUB_CHANNEL, keep_last: int = 0):
+        self._subs: Dict[str, Set[_Subscriber]] = {}
+        self._channel = channel
+        self._keep_last = keep_last
+        self._last: "OrderedDict[str, bytes]" = OrderedDict()
+        self._watchers: List[Callable[[str, bytes], None]] = []
+        self._origin = str(uuid4())  # 自ワーカーが送った NOTIFY を識別する
+        self._outbox: Optional[asyncio.Queue] = None
+        self._listen_conn = None
+        self._pool = None
+        self._sender: Optional[asyncio.Task] = None
+
+    # ==================================================
+    ## プロセス内配信
+    # ==================================================
+    def _deliver(self, thread_id: str, frame: bytes):
+        if self._keep_last:
+            self._last[thread_id] = frame
+            self._last.move_to_end(thread_id)
+            while len(self._last) > self._keep_last:
+                self._last.popitem(last=False)
+        for sub in list(self._subs.get(thread_id, ())):
+            sub.offer(frame)
+        for watcher in self._watchers:
+            try:
+                watcher(thread_id, frame)
+            except Exception as e:
+                print("[thread_hub] watcher error:", repr(e))
+
+    def watch(self, callback: Callable[[str, bytes], None]):
+        """配信されるすべてのフレーム（他ワーカーからの中継分も含む）で callback(キー, フレーム) を呼ぶ"""
+        self._watchers.append(callback)
+
+    def last(self, key: str) -> Optional[bytes]:
+        """キーに最後に配信されたフレーム（keep_last 指定時のみ。他ワーカーからの中継分も含む）"""
+        return self._last.get(key)
+
+    def publish(self, thread_id: str, frame: bytes):
+        """フレームを配信する（待たない。中継は送信タスクに任せる）"""
+        self._deliver(thread_id, frame)
+        if self._outbox is None:
+            return
+        payload = json.dumps(
+            {"o": self._origin, "t": thread_id, "f": frame.decode("utf-8")},
+            ensure_ascii=False,
+        )
+        if len(payload.encode("utf-8")) > _NOTIFY_MAX_BYTES:
+            print("[thread_hub] frame too large to relay:", len(payload))
+            return
+        try:
+            self._outbox.put_nowait(payload)
+        except asyncio.QueueFull:
+            print("[thread_hub] relay queue full, dropping frame")
+
+    async def subscribe(
+        self,
+        *keys: str,
+        initial: Optional[Callable[[], Awaitable[List[bytes]]]] = None,
+    ) -> AsyncIterator[bytes]:
+        """
+        キー（スレッド ID など。複数可）のフレームを受け取り続ける（無通信時はコメント行で keep-alive）。
+        initial を渡すと、購読を登録した後に呼んで、その戻り値を先に流す
+        （現在の状態を読む間に配信されたフレームも取りこぼさない）
+        """
+        sub = _Subscriber()
+        for key in keys:
+            self._subs.setdefault(key, set()).add(sub)
+        try:
+            if initial is not None:
+                for frame in await initial():
+                    yield frame
+            while True:
+                try:
+                    frame = await asyncio.wait_for(sub.queue.get(), KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if sub.dropped:
+                    # 取りこぼしを通知（続きは list_messages で補完してもらう）
+                    yield sse({"type": "lagged", "dropped": sub.dropped})
+                    sub.dropped = 0
+                yield frame
+        finally:
+            for key in keys:
+                subs = self._subs.get(key)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        self._subs.pop(key, None)
+
+    # ==================================================
+    ## ワーカー間中継（Postgres LISTEN/NOTIFY）
+    # ==================================================
+    def _on_notify(self, _conn, _pid, _channel, payload: str):
+        try:
+            msg = json.loads(payload)
+        except ValueError:
+            return
+        if msg.get("o") == self._origin:
+            return  # 自分が送ったものは配信済み
+        self._deliver(str(msg.get("t")), str(msg.get("f", "")).encode("utf-8"))
+
+    async def _send_loop(self):
+        while True:
+            batch = [await self._outbox.get()]
+            while len(batch) < _RELAY_BATCH and not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            try:
+                # 1 文で送れば同一トランザクション内の NOTIFY として順序が保たれる
+                await self._pool.execute(
+                    "select pg_notify($1, p) from unnest($2::text[]) as p",
+                    self._channel,
+                    batch,
+                )
+            except Exception as e:
+                print("[thread_hub] notify failed:", repr(e))
+
+    async def start(self):
+        """アプリ起動時に呼ぶ。DSN / asyncpg が無ければプロセス内配信のみ"""
+        if not PUBSUB_DSN or self._listen_conn is not None:
+            return
+        if not _has_asyncpg():
+            print("[thread_hub] asyncpg not installed; cross-worker relay disabled")
+            return
+        import asyncpg  # type: ignore
+
+        try:
+            self._pool = await asyncpg.create_pool(PUBSUB_DSN, min_size=1, max_size=2)
+            self._listen_conn = await asyncpg.connect(PUBSUB_DSN)
+            await self._listen_conn.add_listener(self._channel, self._on_notify)
+        except Exception as e:
+            print("[thread_hub] relay start failed:", repr(e))
+            await self.stop()
+            return
+        self._outbox = asyncio.Queue(maxsize=_RELAY_QUEUE_MAX)
+        self._sender = asyncio.ensure_future(self._send_loop())
+
+    async def stop(self):
+        if self._sender is not None:
+            self._sender.cancel()
+            self._sender = None
+        self._outbox = None
+        if self._listen_conn is not None:
+            try:
+                await self._listen_conn.close()
+            except Exception:
+                pass
+            self._listen_conn = None
+        if self._pool is not None:
+            try:
+                await self._pool.close()
+            except Exception:
+                pass
+            self._pool = None
+
+
+hub = ThreadHub()
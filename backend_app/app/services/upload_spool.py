@@ -0,0 +1,218 @@
+from __future__ import annotations
+import asyncio, glob, os, tempfile, threading, time, uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+# アップロードされたファイルのローカル控え（スプール）
+# upload_attachment が Storage へ送るのと同じバイト列を（送りながら）ここにも書き、取り込み側は先にここを見る。
+# 見つかれば Storage からのダウンロードを省く（同じホストで動くジョブワーカー・チャット時の取り込み）。
+# 見つからない・期限切れ・別ホストの場合は従来どおり Storage から取得する
+# - キーは添付 ID。拡張子は抽出器の判定に使われることがあるので残す
+# - 合計サイズ（UPLOAD_SPOOL_MAX_BYTES）と保持期間（UPLOAD_SPOOL_TTL_SEC）を超えた分は古い順に消す
+
+UPLOAD_SPOOL_ENABLED = os.getenv("UPLOAD_SPOOL_ENABLED", "1") == "1"
+UPLOAD_SPOOL_DIR = os.getenv(
+    "UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "upload_spool")
+)
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES", str(2 * 1024**3)))
+UPLOAD_SPOOL_TTL_SEC = int(os.getenv("UPLOAD_SPOOL_TTL_SEC", "3600"))
+
+# 読み出し中のファイルの目印（ハードリンク）。容量超過の掃除では消さない
+_READING = ".reading"
+
+
+class SpoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def record(self, **counts: int):
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def snapshot(self) -> Dict:
+        entries, size = _usage()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": UPLOAD_SPOOL_ENABLED,
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": UPLOAD_SPOOL_MAX_BYTES,
+                "ttl_sec": UPLOAD_SPOOL_TTL_SEC,
+                "stored": self.stored,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+stats = SpoolStats()
+_lock = threading.Lock()
+
+
+def _entries():
+    # (パス, サイズ, 更新時刻) の一覧。読み出し中の目印と書きかけの一時ファイルは除く
+    try:
+        names = os.listdir(UPLOAD_SPOOL_DIR)
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in names:
+        if name.startswith("."):
+            continue
+        path = os.path.join(UPLOAD_SPOOL_DIR, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        out.append((path, st.st_size, st.st_mtime))
+    return out
+
+
+def _usage():
+    entries = _entries()
+    return len(entries), sum(size for _, size, _ in entries)
+
+
+def _find(attachment_id: str) -> Optional[str]:
+    # 控えの名前は「添付 ID + 拡張子」なので、ディレクトリ全体は見ずにその名前だけを引く
+    pattern = os.path.join(UPLOAD_SPOOL_DIR, glob.escape(attachment_id) + "*")
+    for path in glob.glob(pattern):
+        if os.path.basename(path).split(".", 1)[0] != attachment_id:
+            continue  # 添付 ID が前方一致しただけの別の控え
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+        if time.time() - mtime > UPLOAD_SPOOL_TTL_SEC:
+            return None
+        return path
+    return None
+
+
+def _evict(reserve: int = 0):
+    """期限切れを消し、reserve バイトを足しても上限に収まるまで古い順に消す"""
+    now = time.time()
+    entries = sorted(_entries(), key=lambda e: e[2])
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for path, size, mtime in entries:
+        if now - mtime <= UPLOAD_SPOOL_TTL_SEC and total + reserve <= UPLOAD_SPOOL_MAX_BYTES:
+            continue
+        try:
+            os.unlink(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    if removed:
+        stats.record(evicted=removed)
+    # 異常終了で残った読み出し用リンク・書きかけの一時ファイル
+    for name in os.listdir(UPLOAD_SPOOL_DIR):
+        path = os.path.join(UPLOAD_SPOOL_DIR, name)
+        try:
+            if name.startswith(".") and now - os.stat(path).st_mtime > UPLOAD_SPOOL_TTL_SEC:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class SpoolWriter:
+    """
+    アップロードを受け取りながら控えを書き出す（同期。スレッドから呼ぶ）。
+    上限を超えたら黙って控えをやめる（アップロード自体は続ける）。commit で添付 ID の名前を付ける
+    """
+
+    def __init__(self, ext: str = "", expected_size: Optional[int] = None):
+        self.ext = ext
+        self.size = 0
+        self._f = None
+        self._tmp = None
+        self.active = UPLOAD_SPOOL_ENABLED and (expected_size or 0) <= UPLOAD_SPOOL_MAX_BYTES
+        if not self.active:
+            return
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        with _lock:
+            _evict(reserve=expected_size or 0)
+        # 書き終わってから名前を付ける（読み手に書きかけを見せない）
+        self._tmp = os.path.join(UPLOAD_SPOOL_DIR, f".{uuid.uuid4().hex}.tmp")
+        self._f = open(self._tmp, "wb")
+
+    def write(self, chunk: bytes):
+        if not self.active:
+            return
+        if self.size + len(chunk) > UPLOAD_SPOOL_MAX_BYTES:
+            self.abort()
+            return
+        self._f.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self, attachment_id: str) -> bool:
+        if not self.active:
+            return False
+        self._f.close()
+        os.replace(self._tmp, os.path.join(UPLOAD_SPOOL_DIR, f"{attachment_id}{self.ext}"))
+        self.active = False
+        stats.record(stored=1)
+        return True
+
+    def abort(self):
+        if not self.active:
+            return
+        if self._f is not None:
+            self._f.close()
+            try:
+                os.unlink(self._tmp)
+            except FileNotFoundError:
+                pass
+        self.active = False
+
+
+def _link(attachment_id: str) -> Optional[str]:
+    path = _find(attachment_id) if UPLOAD_SPOOL_ENABLED else None
+    link = None
+    if path:
+        base = os.path.basename(path)
+        ext = base[len(attachment_id):]
+        link = os.path.join(UPLOAD_SPOOL_DIR, f".{uuid.uuid4().hex}{_READING}{ext}")
+        try:
+            os.link(path, link)
+        except OSError:
+            link = None  # 直前に消された・リンク不可のファイルシステムなど
+    stats.record(**({"hits": 1} if link else {"misses": 1}))
+    return link
+
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+@asynccontextmanager
+async def claim(attachment_id: str) -> AsyncIterator[Optional[str]]:
+    """
+    控えがあれば、そのファイルのパスを返す（無ければ None）。
+    読んでいる間に掃除されないよう、ハードリンクを作ってそちらを渡す（抜けるときに消す）。
+    ファイル操作はイベントループを止めないようスレッドで行う
+    """
+    link = await asyncio.to_thread(_link, attachment_id)
+    try:
+        yield link
+    finally:
+        if link:
+            await asyncio.to_thread(_unlink, link)
+
+
+def discard(attachment_id: str):
+    """取り込みが済んだ控えを消す（同期。イベントループからは asyncio.to_thread で呼ぶ）"""
+    path = _find(attachment_id)
+    if path:
+        _unlink(path)
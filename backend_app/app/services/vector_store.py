@@ -1,5 +1,7 @@
 from __future__ import annotations
+import os
 from typing import Any, Dict
+from config import EMBED_DIMS, EMBED_STORAGE
 from crud import SupaRest
 
 
@@ -15,3 +17,22 @@ async def rpc_match_by_doc_ids(client: SupaRest, args: Dict[str, Any]):
     return await client.post(
         "rpc/match_by_document_ids", json=args, content_profile="app"
     )
+
+
+# chunks.embedding の型（DB 側の app.embed_dims / app.embed_storage）が EMBED_DIMS / EMBED_STORAGE と
+# 揃っているかを確かめる（起動時に 1 回。ずれていると取り込みの INSERT と検索が次元の不一致で失敗する）
+async def check_embedding_config() -> bool:
+    client = SupaRest(service_key=os.environ["SUPABASE_SERVICE_ROLE_KEY"])
+    try:
+        rows = await client.rpc("embedding_config", accept_profile="app")
+    except Exception as e:
+        print("[vector_store] embedding_config unavailable:", repr(e))
+        return False
+    row = (rows or [{}])[0] if isinstance(rows, list) else rows
+    if row.get("dims") != EMBED_DIMS or row.get("storage") != EMBED_STORAGE:
+        print(
+            f"[vector_store] WARNING chunks.embedding is {row.get('storage')}({row.get('dims')}) "
+            f"but EMBED_STORAGE/EMBED_DIMS is {EMBED_STORAGE}({EMBED_DIMS})"
+        )
+        return False
+    return True
@@ -0,0 +1,56 @@
+from __future__ import annotations
+import asyncio
+from contextlib import suppress
+
+from fastapi import Request
+
+# SSE の StreamingResponse 用の共通部品（routers/chat.py・routers/attachments.py）
+
+# 切断検知のポーリング間隔（秒）
+DISCONNECT_POLL_SEC = 0.5
+
+
+# クライアントが切断するまで待つ
+async def wait_disconnect(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_SEC)
+
+
+async def safe_stream(gen, request: Request):
+    # 切断を検知したら、次のチャンクを待っている購読をキャンセルして閉じる
+    # 購読者が 0 になった生成は打ち切られ、上流（OpenAI ストリーム / DB 書き込み）も止まる
+    watcher = asyncio.ensure_future(wait_disconnect(request))
+    step = None
+    try:
+        while True:
+            step = asyncio.ensure_future(gen.__anext__())
+            await asyncio.wait({step, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not step.done():  # ← 切断
+                step.cancel()
+                with suppress(asyncio.CancelledError, StopAsyncIteration):
+                    await step
+                break
+            try:
+                chunk = step.result()
+            except StopAsyncIteration:
+                break
+            if chunk is None:  # ← None は捨てる
+                continue
+            if isinstance(chunk, str):  # ← 念のため文字列は bytes に
+                chunk = chunk.encode("utf-8")
+            yield chunk
+    finally:
+        watcher.cancel()
+        if step is not None and not step.done():
+            # 外側（StreamingResponse）ごとキャンセルされた場合は生成側にも伝える
+            step.cancel()
+        else:
+            await gen.aclose()
+
+
+SSE_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache, no-transform",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
@@ -0,0 +1,330 @@
+# 文書抽出（PyMuPDF / python-docx / python-pptx / BeautifulSoup）専用のプロセスプール
+# CPU を使う抽出を API プロセスの外で動かし、大きな PDF 1 つで他のストリームが止まらないようにする。
+# - ワーカー数は EXTRACT_POOL_SIZE で固定。空きが無ければ呼び出し側（抽出スレッド）が待つ
+# - ワーカーが制限時間のあいだ何も返さなければ kill して作り直す
+#   （数えるのは結果を待っている時間だけ。呼び出し側が背圧で止まっている間は数えない）
+# - EXTRACT_WORKER_MAX_JOBS 件処理したワーカーは入れ替える（ライブラリのメモリ断片化・リーク対策）
+# 抽出結果は (テキスト, ページ) ごとにパイプで逐次返すので、ストリーミング取り込みの背圧もそのまま効く
+# 大きな PDF（PDF_PARALLEL_MIN_PAGES 以上）はページ範囲に分けて複数のワーカーで同時に抽出し、
+# ページ順に並べ直して返す。各ワーカーは同じ一時ファイルを自分で開く（バイト列は送らない）
+from __future__ import annotations
+import atexit
+import multiprocessing as mp
+import os
+import queue
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+Item = Tuple[str, Optional[int]]
+_END = object()  # 分担ジョブの終端の目印
+
+EXTRACT_POOL_SIZE = int(os.getenv("EXTRACT_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+EXTRACT_TIMEOUT_SEC = float(os.getenv("EXTRACT_TIMEOUT_SEC", "300"))
+EXTRACT_WORKER_MAX_JOBS = int(os.getenv("EXTRACT_WORKER_MAX_JOBS", "50"))
+# ワーカーの起動方式（スレッドを持つ API プロセスからの fork は避け、既定は spawn）
+EXTRACT_POOL_START_METHOD = os.getenv("EXTRACT_POOL_START_METHOD", "spawn")
+# 0 にするとプールを使わず、呼び出し元のスレッドでそのまま抽出する
+EXTRACT_POOL_ENABLED = os.getenv("EXTRACT_POOL_ENABLED", "1") == "1"
+# 起動時にワーカーを立ち上げておく（子プロセスの import に数秒かかるため）
+EXTRACT_POOL_PREWARM = os.getenv("EXTRACT_POOL_PREWARM", "1") == "1"
+# ページ並列抽出: この枚数未満の PDF は 1 ワーカーで順に読む
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "200"))
+# 1 ワーカーに割り当てる最小ページ数（細かく分けすぎると起動・転送のコストが勝つ）
+PDF_PARALLEL_PAGES_PER_PART = int(os.getenv("PDF_PARALLEL_PAGES_PER_PART", "100"))
+# 後続の範囲が順番待ちの間に溜めておくページ数の上限（超えたらワーカー側を待たせる）
+PDF_PARALLEL_BUFFER_PAGES = int(os.getenv("PDF_PARALLEL_BUFFER_PAGES", "16"))
+
+
+class ExtractTimeout(RuntimeError):
+    pass
+
+
+# ==================================================
+## ワーカープロセス側
+# ==================================================
+def _worker_main(conn):
+    # 子プロセスでは抽出器を 1 度だけ import して使い回す
+    from workers.extractors import iter_extracted
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        path, object_path, mime, pages = job
+        try:
+            for item in iter_extracted(path, object_path, mime, pages):
+                conn.send(("item", item))
+            conn.send(("done", None))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+# ==================================================
+## 親プロセス側
+# ==================================================
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker_main, args=(child,), daemon=True)
+        self.proc.start()
+        child.close()
+        self.jobs = 0
+
+    def alive(self) -> bool:
+        return self.proc.is_alive()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.proc.join(timeout=1)
+        self.kill()
+
+    def kill(self):
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join(timeout=5)
+        self.conn.close()
+
+
+class ExtractPool:
+    def __init__(
+        self,
+        size: int = EXTRACT_POOL_SIZE,
+        *,
+        timeout: float = EXTRACT_TIMEOUT_SEC,
+        max_jobs: int = EXTRACT_WORKER_MAX_JOBS,
+        start_method: str = EXTRACT_POOL_START_METHOD,
+    ):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.max_jobs = max(1, max_jobs)
+        self._ctx = mp.get_context(start_method)
+        # 空きワーカー（None はまだ起動していない枠）
+        self._idle: "queue.Queue[Optional[_Worker]]" = queue.Queue()
+        for _ in range(self.size):
+            self._idle.put(None)
+        self._all: List[_Worker] = []
+        self._lock = threading.Lock()
+        self.stats = {
+            "jobs": 0,
+            "parallel_jobs": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "recycled": 0,
+        }
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _acquire(self) -> _Worker:
+        w = self._idle.get()  # 空きが出るまで待つ（プールの大きさで同時実行数を抑える）
+        if w is None or not w.alive():
+            w = _Worker(self._ctx)
+            with self._lock:
+                self._all.append(w)
+        return w
+
+    def _release(self, w: _Worker, *, broken: bool):
+        if broken or w.jobs >= self.max_jobs:
+            if not broken:
+                self._count("recycled")
+            with self._lock:
+                if w in self._all:
+                    self._all.remove(w)
+            if broken:
+                w.kill()
+            else:
+                w.close()
+            self._idle.put(None)  # 枠だけ返し、次の利用時に作り直す
+        else:
+            self._idle.put(w)
+
+    def iter_extract(
+        self,
+        path: str,
+        object_path: str,
+        mime: Optional[str],
+        pages: Optional[Tuple[int, int]] = None,
+    ) -> Iterator[Item]:
+        """ワーカープロセスで iter_extracted を実行し、結果を逐次返す（同期。スレッドから呼ぶ）"""
+        w = self._acquire()
+        broken = True  # 最後まで受け取れなかったワーカーは状態が不明なので作り直す
+        self._count("jobs")
+        try:
+            w.jobs += 1
+            w.conn.send((path, object_path, mime, pages))
+            while True:
+                # 制限時間は次の結果を待つ時間に掛ける。yield で止まっている間（下流の背圧）は数えない
+                if not w.conn.poll(self.timeout):
+                    self._count("timeouts")
+                    raise ExtractTimeout(
+                        f"extraction timed out after {self.timeout:g}s without output: {object_path}"
+                    )
+                try:
+                    kind, value = w.conn.recv()
+                except (EOFError, OSError):
+                    self._count("errors")
+                    raise RuntimeError(
+                        f"extract worker died (exitcode={w.proc.exitcode}): {object_path}"
+                    )
+                if kind == "item":
+                    yield value
+                elif kind == "error":
+                    broken = False
+                    self._count("errors")
+                    raise RuntimeError(f"extraction failed: {value}")
+                else:
+                    broken = False
+                    return
+        finally:
+            self._release(w, broken=broken)
+
+    def iter_extract_pdf_parallel(
+        self,
+        path: str,
+        object_path: str,
+        mime: Optional[str],
+        n_pages: int,
+        parts: int,
+    ) -> Iterator[Item]:
+        """
+        ページ範囲を parts 個に分けて別々のワーカーで抽出し、ページ順に返す。
+        先頭の範囲はそのまま流し、後続の範囲は順番が来るまでスレッド側で溜めておく。
+        溜める量は PDF_PARALLEL_BUFFER_PAGES までで、それ以上は下流が読むまで待つ
+        """
+        step = -(-n_pages // parts)  # 切り上げ
+        ranges = [(i, min(i + step, n_pages)) for i in range(0, n_pages, step)]
+        queues: List[queue.Queue] = [
+            queue.Queue(maxsize=max(1, PDF_PARALLEL_BUFFER_PAGES)) for _ in ranges
+        ]
+        stop = threading.Event()
+
+        def _put(q: queue.Queue, item) -> bool:
+            # 満杯の間も stop を見て、消費側が止めたらすぐ抜ける
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _run(pages: Tuple[int, int], q: queue.Queue):
+            it = self.iter_extract(path, object_path, mime, pages)
+            try:
+                for item in it:
+                    if not _put(q, item):
+                        return
+                _put(q, _END)
+            except BaseException as e:
+                _put(q, e)
+            finally:
+                it.close()
+
+        threads = [
+            threading.Thread(target=_run, args=(r, q), daemon=True)
+            for r, q in zip(ranges, queues)
+        ]
+        for t in threads:
+            t.start()
+        with self._lock:
+            self.stats["parallel_jobs"] += 1
+        try:
+            for q in queues:
+                while True:
+                    item = q.get()
+                    if item is _END:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    yield item
+        finally:
+            stop.set()  # 途中で止めた場合、各ワーカーを解放させる
+
+    def warm(self):
+        """未起動の枠にワーカーを立ち上げておく"""
+        slots = []
+        while True:
+            try:
+                slots.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for w in slots:
+            if w is None or not w.alive():
+                w = _Worker(self._ctx)
+                with self._lock:
+                    self._all.append(w)
+            self._idle.put(w)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "running": sum(1 for w in self._all if w.alive()),
+                "idle": self._idle.qsize(),
+                **self.stats,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._all = self._all, []
+        for w in workers:
+            w.close()
+
+
+_pool: Optional[ExtractPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ExtractPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExtractPool()
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def shutdown_pool():
+    """起動済みのプールだけを止める（未使用なら何もしない。停止のためにワーカーを起こさない）"""
+    with _pool_lock:
+        pool = _pool
+    if pool is not None:
+        pool.shutdown()
+
+
+def _pdf_parts(path: str, object_path: str, mime: Optional[str], pool: ExtractPool):
+    """ページ並列にする場合は (ページ数, 分割数) を返す。閾値未満や PDF 以外は None"""
+    from workers.extractors import is_pdf, pdf_page_count
+
+    if pool.size < 2 or not is_pdf(object_path, mime):
+        return None
+    try:
+        n_pages = pdf_page_count(path)  # xref を読むだけなので API プロセス側でも軽い
+    except Exception:
+        return None  # 壊れた PDF などはワーカー側の通常経路でエラーにする
+    if n_pages < PDF_PARALLEL_MIN_PAGES:
+        return None
+    parts = min(pool.size, n_pages // max(1, PDF_PARALLEL_PAGES_PER_PART))
+    return (n_pages, parts) if parts >= 2 else None
+
+
+def iter_extracted_pooled(
+    path: str, object_path: str, mime: Optional[str]
+) -> Iterator[Item]:
+    """両取り込み経路の抽出入口。プールが無効なら呼び出し元のスレッドで抽出する"""
+    if not EXTRACT_POOL_ENABLED:
+        from workers.extractors import iter_extracted
+
+        return iter_extracted(path, object_path, mime)
+    pool = get_pool()
+    split = _pdf_parts(path, object_path, mime, pool)
+    if split:
+        return pool.iter_extract_pdf_parallel(path, object_path, mime, *split)
+    return pool.iter_extract(path, object_path, mime)
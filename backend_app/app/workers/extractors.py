@@ -0,0 +1,337 @@
+# 文書抽出器のレジストリ
+# 形式ごとの抽出器は「ローカルファイルのパス → (テキスト, ページ番号 or None) を逐次 yield するジェネレータ」。
+# バイト列を丸ごとメモリに載せず、ファイルパス（PDF / docx / pptx）かメモリマップ（テキスト系）から読む。
+# - PDF / pptx はページ（スライド）単位
+# - テキスト / Markdown / CSV は TEXT_BLOCK_BYTES 程度のブロック単位（行の途中では切らない）
+# - HTML / JSON / docx は構造を解釈する必要があるので、1 ファイルを 1 件として返す
+# 新しい形式は @register(...) で追加する。判定は登録順に MIME か拡張子が一致したもの、無ければプレーンテキスト
+# API プロセスに加えて抽出プール（workers/extract_pool.py）の子プロセスからも import されるため、
+# ここでは LangChain / Supabase / OpenAI などの重いモジュールは import しない
+from __future__ import annotations
+import codecs
+import json
+import mimetypes
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+Item = Tuple[str, Optional[int]]
+Pages = Optional[Tuple[int, int]]
+Extractor = Callable[[str, Pages], Iterator[Item]]
+
+# テキスト系の形式を区切って返す単位
+TEXT_BLOCK_BYTES = int(os.getenv("EXTRACT_TEXT_BLOCK_BYTES", str(256 * 1024)))
+# 文字コードの推定に使う先頭のバイト数
+_SNIFF_BYTES = 64 * 1024
+
+# 拡張子 -> MIME の対応を拡張（マークダウンとかはmimetypesに登録されていない）
+mimetypes.add_type("text/markdown", ".md")
+mimetypes.add_type("text/markdown", ".markdown")
+mimetypes.add_type("text/tab-separated-values", ".tsv")
+
+
+# MIMEタイプの識別
+def _guess_mime(object_path: str, provided: Optional[str]) -> str:
+    # MIME を推定する（提供されていればそれを優先）
+    if provided:
+        return provided
+    mime, _ = mimetypes.guess_type(object_path)
+    return mime or "application/octet-stream"
+
+
+# ファイル内のPostgreSQLで使用できない文字を省くための正規表現
+_CTRL_RE = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F]")
+
+
+def _clean_text(s: str) -> str:
+    """
+    Postgres/JSON が嫌う NUL(\x00) を含む制御文字を空白に置換。
+    22P05 (\u0000 cannot be converted to text) 対策。
+    """
+    if not s:
+        return s
+    return _CTRL_RE.sub(" ", s)
+
+
+# ==================================================
+## ファイルの読み方
+# ==================================================
+@contextmanager
+def _mapped(path: str):
+    # ファイルを読み取り専用でメモリマップする（OS がページ単位で読み込む）。空ファイルは mmap できない
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def _detect_encoding(head: bytes) -> str:
+    # 先頭が UTF-8 として読めれば UTF-8。末尾で多バイト文字が切れていても失敗にしない
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    # 任意: chardet があれば使用してエンコーディングを推定
+    try:
+        import chardet  # type: ignore
+
+        enc = chardet.detect(head).get("encoding") or "utf-8"
+        codecs.lookup(enc)
+        return enc
+    except Exception:
+        return "utf-8"
+
+
+def _iter_text_blocks(path: str) -> Iterator[str]:
+    """テキストファイルを TEXT_BLOCK_BYTES 前後のブロックに分けて、デコード済みの文字列で返す"""
+    with _mapped(path) as mm:
+        size = len(mm)
+        decoder = codecs.getincrementaldecoder(_detect_encoding(mm[:_SNIFF_BYTES]))(
+            errors="replace"
+        )
+        pos = 0
+        while pos < size:
+            end = min(pos + TEXT_BLOCK_BYTES, size)
+            if end < size:
+                # 行の途中で切らない（改行が無い巨大な行だけはそのまま切る。文字の途中はデコーダが繋ぐ）
+                nl = mm.rfind(b"\n", pos, end)
+                if nl > pos:
+                    end = nl + 1
+            text = decoder.decode(mm[pos:end], final=end >= size)
+            pos = end
+            if text:
+                yield _clean_text(text)
+
+
+def _read_text(path: str) -> str:
+    # 全体を解釈する必要がある形式（HTML / JSON）用
+    return "".join(_iter_text_blocks(path))
+
+
+# ==================================================
+## レジストリ
+# ==================================================
+class _Entry(NamedTuple):
+    name: str
+    mimes: frozenset
+    exts: Tuple[str, ...]
+    fn: Extractor
+
+
+_REGISTRY: List[_Entry] = []
+
+
+def register(name: str, *, mimes=(), exts=()):
+    """抽出器を登録するデコレータ。判定は登録順なので、具体的な形式ほど先に登録する"""
+
+    def deco(fn: Extractor) -> Extractor:
+        _REGISTRY.append(_Entry(name, frozenset(mimes), tuple(exts), fn))
+        return fn
+
+    return deco
+
+
+def find_extractor(object_path: str, mime: Optional[str]) -> _Entry:
+    mime = _guess_mime(object_path, mime).split(";")[0].strip().lower()
+    lower = object_path.lower()
+    for entry in _REGISTRY:
+        if mime in entry.mimes or (entry.exts and lower.endswith(entry.exts)):
+            return entry
+    # 未知形式はプレーンテキストとしてフォールバック（完全に捨てない方針）
+    return _PLAIN
+
+
+def iter_extracted(
+    path: str,
+    object_path: str,
+    mime: Optional[str],
+    pages: Pages = None,
+) -> Iterator[Item]:
+    """
+    ローカルファイルを形式に応じて抽出し、(テキスト, ページ番号 or None) を順に返す。
+    pages は PDF のページ範囲（並列抽出で分担するとき。他の形式では無視される）
+    """
+    return find_extractor(object_path, mime).fn(path, pages)
+
+
+# ==================================================
+## 各形式の抽出器（抽出後のデータは（”<テキスト>”, "<ページ番号> or <None>"）となる
+# ==================================================
+
+
+# PDF をファイルから 1 ページずつ抽出する（全ページ分のテキストを溜めない）
+# pages=(start, stop) を渡すとその範囲（0 始まり・stop は含まない）だけを読む
+@register("pdf", mimes={"application/pdf"}, exts=(".pdf",))
+def _iter_pdf(path: str, pages: Pages = None) -> Iterator[Item]:
+    import fitz  # PyMuPDF
+
+    with fitz.open(path) as doc:
+        start, stop = pages or (0, doc.page_count)
+        for i in range(start, min(stop, doc.page_count)):
+            text = _clean_text(doc.load_page(i).get_text("text") or "")
+            if text.strip():
+                yield (text, i + 1)
+
+
+def pdf_page_count(path: str) -> int:
+    import fitz  # PyMuPDF
+
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+def is_pdf(object_path: str, mime: Optional[str]) -> bool:
+    return find_extractor(object_path, mime).name == "pdf"
+
+
+# docx（ワードファイル）の抽出
+@register(
+    "docx",
+    mimes={"application/vnd.openxmlformats-officedocument.wordprocessingml.document"},
+    exts=(".docx",),
+)
+def _iter_docx(path: str, pages: Pages = None) -> Iterator[Item]:
+    # docx から本文と表を抽出して結合
+    try:
+        from docx import Document as DocxDocument  # python-docx
+
+        doc = DocxDocument(path)
+        texts: List[str] = []
+        # word内の段落で分割
+        for p in doc.paragraphs:
+            if p.text and p.text.strip():
+                texts.append(p.text)
+        # Word内のすべての表を走査し、各行をタブ区切り文字列として抽出
+        for tbl in doc.tables:
+            for row in tbl.rows:
+                row_text = "\t".join(
+                    cell.text.strip() for cell in row.cells
+                )  # タブでつなげる
+                if row_text.strip():
+                    texts.append(row_text)
+        joined = "\n".join(texts)  # 段落の境目を残す（分割器が段落単位で切れるように）
+    except Exception:
+        # 失敗した場合はプレーンテキストとしてフォールバック
+        yield from _iter_plain(path)
+        return
+    yield (_clean_text(joined), None)
+
+
+# pptx（パワポファイル）の抽出（出力は (スライドのテキスト, スライド番号)となる）
+def _shape_texts(shape) -> list[str]:
+    texts = []
+    # 1) テキストフレームを持つ通常の図形（テキストボックスやプレースホルダ）
+    if getattr(shape, "has_text_frame", False) and shape.text_frame:
+        # 段落単位で抽出（runsまで細かくやるなら p.runs も可）
+        for p in shape.text_frame.paragraphs:
+            if p.text and p.text.strip():
+                texts.append(p.text)
+    # 2) 表（table）内のセルテキスト
+    if getattr(shape, "has_table", False) and shape.table:
+        for row in shape.table.rows:
+            row_text = "\t".join((cell.text or "").strip() for cell in row.cells)
+            if row_text.strip():
+                texts.append(row_text)
+    # 3) グループ化された図形の中身を再帰的に辿る
+    if shape.shape_type == 6 and hasattr(shape, "shapes"):  # MSO_SHAPE_TYPE.GROUP = 6
+        for s in shape.shapes:
+            texts.extend(_shape_texts(s))
+
+    return texts
+
+
+# スライド 1 枚のテキスト
+def _extract_pptx(slide) -> str:
+    texts = []
+    for shape in slide.shapes:
+        texts.extend(_shape_texts(shape))
+    return "".join(texts)  # 必要なら " ".join(...) に変更
+
+
+# pptx をファイルから 1 スライドずつ抽出する
+@register(
+    "pptx",
+    mimes={"application/vnd.openxmlformats-officedocument.presentationml.presentation"},
+    exts=(".pptx",),
+)
+def _iter_pptx(path: str, pages: Pages = None) -> Iterator[Item]:
+    from pptx import Presentation
+
+    prs = Presentation(path)
+    for i, slide in enumerate(prs.slides, 1):
+        text = _clean_text(_extract_pptx(slide))
+        if text.strip():
+            yield (text, i)
+
+
+# Markdownファイルの先頭にあるYAMLフロントマター（メタデータ部）を削除
+def _strip_frontmatter(md: str) -> str:
+    return re.sub(r"^---.*?---", "", md, flags=re.DOTALL)
+
+
+# Markdown ファイルのデータ抽出（フロントマターは先頭ブロックにだけ現れる）
+@register("markdown", mimes={"text/markdown", "text/x-markdown"}, exts=(".md", ".markdown"))
+def _iter_markdown(path: str, pages: Pages = None) -> Iterator[Item]:
+    for i, block in enumerate(_iter_text_blocks(path)):
+        yield (_strip_frontmatter(block) if i == 0 else block, None)
+
+
+# HTMLの解析
+def _has_lxml() -> bool:
+    # lxml が利用可能かどうかを返す
+    try:
+        import lxml  # type: ignore  # noqa: F401
+
+        return True
+    except Exception:
+        return False
+
+
+# HTMLの抽出（不要なタグを削除したテキスト）
+@register("html", mimes={"text/html"}, exts=(".html", ".htm"))
+def _iter_html(path: str, pages: Pages = None) -> Iterator[Item]:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(_read_text(path), "lxml" if _has_lxml() else "html.parser")
+    # script/style/noscript を除去
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
+    text = soup.get_text("")
+    text = re.sub(r"\n{2,}", "\n\n", text)  # タグ除去で残った連続する空行を詰める
+    yield (text.strip(), None)
+
+
+# JSONの抽出
+@register("json", mimes={"application/json"}, exts=(".json",))
+def _iter_json(path: str, pages: Pages = None) -> Iterator[Item]:
+    # JSON を整形文字列化。失敗時はプレーンテキストとして扱う
+    raw = _read_text(path)
+    try:
+        yield (json.dumps(json.loads(raw), ensure_ascii=False, indent=2), None)
+    except ValueError:
+        yield (raw, None)
+
+
+# CSV/TSV・平文の抽出
+# CSV/TSV は区切りテキストとしてそのまま扱う（RAG では行単位が有用なことが多い）
+@register(
+    "plain",
+    mimes={
+        "text/plain",
+        "text/csv",
+        "text/tab-separated-values",
+        "application/vnd.ms-excel",
+    },
+    exts=(".txt", ".csv", ".tsv"),
+)
+def _iter_plain(path: str, pages: Pages = None) -> Iterator[Item]:
+    for block in _iter_text_blocks(path):
+        yield (block, None)
+
+
+_PLAIN = find_extractor("x.txt", "text/plain")
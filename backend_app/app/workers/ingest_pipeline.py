@@ -0,0 +1,282 @@
+# 取り込みのストリーミング・パイプライン
+#   ダウンロード → ページ単位の抽出 → チャンク分割 → 埋め込み（バッチ） → INSERT（バッチ）
+# 各段は上限つきの asyncio.Queue でつなぐ。下流が詰まれば上流は put で待たされる（背圧）ので、
+# メモリに載るのは「キューに入っている分」だけになり、抽出・埋め込み・INSERT が重なって進む。
+# 取り込み本体（workers/ingest_sync.py）から使う
+# progress（services/ingest_progress.Reporter）を渡すと、各段が進捗（ページ数・チャンク数・件数）を足し込む
+from __future__ import annotations
+import asyncio
+import os
+import tempfile
+import threading
+from typing import Awaitable, Callable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+
+from config import EMBED_BATCH_SIZE, EMBED_CONCURRENCY
+from services.embedding_cache import embed_texts_cached
+from services.ingest_progress import Reporter
+
+SUPABASE_URL = os.environ["SUPABASE_URL"].rstrip("/")
+SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+
+# キューの上限（ページ数 / チャンク数 / 埋め込み済み行数）
+INGEST_QUEUE_PAGES = int(os.getenv("INGEST_QUEUE_PAGES", "8"))
+INGEST_QUEUE_CHUNKS = int(os.getenv("INGEST_QUEUE_CHUNKS", str(EMBED_BATCH_SIZE * 2)))
+INGEST_QUEUE_ROWS = int(os.getenv("INGEST_QUEUE_ROWS", "200"))
+# 1 回の INSERT に載せる行数
+INGEST_INSERT_BATCH = int(os.getenv("INGEST_INSERT_BATCH", "100"))
+# ダウンロード時の読み込み単位
+_DOWNLOAD_CHUNK = 1024 * 1024
+
+# (チャンク番号, 本文, ページ番号)
+Chunk = Tuple[int, str, Optional[int]]
+# (チャンク番号, 本文, ページ番号, 埋め込み)
+Row = Tuple[int, str, Optional[int], List[float]]
+
+_DONE = object()  # 終端の目印
+
+
+# ==================================================
+## ダウンロード（一時ファイルへ逐次書き出し。全体をメモリに載せない）
+# ==================================================
+async def download_to_file(bucket: str, object_path: str, dest) -> int:
+    """Storage のオブジェクトを service_role で取得し、dest（書き込み可能なファイル）に書き出す"""
+    url = f"{SUPABASE_URL}/storage/v1/object/{bucket}/{quote(object_path)}"
+    headers = {
+        "apikey": SUPABASE_SERVICE_ROLE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    }
+    size = 0
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        async with client.stream("GET", url, headers=headers) as r:
+            if r.status_code >= 400:
+                await r.aread()
+                raise RuntimeError(
+                    f"storage download failed ({r.status_code}): {r.text[:200]}"
+                )
+            async for block in r.aiter_bytes(_DOWNLOAD_CHUNK):
+                # 書き込みはディスク I/O なのでスレッドへ
+                await asyncio.to_thread(dest.write, block)
+                size += len(block)
+    await asyncio.to_thread(dest.flush)
+    return size
+
+
+# ==================================================
+## 各段
+# ==================================================
+async def _extract_stage(
+    iter_factory: Callable[[], Iterator[Tuple[str, Optional[int]]]],
+    out_q: asyncio.Queue,
+    stop: threading.Event,
+):
+    # 抽出器は同期のジェネレータなのでスレッドで回し、1 ページずつキューへ渡す。
+    # キューが満杯ならスレッド側が待つ（背圧）
+    loop = asyncio.get_running_loop()
+
+    def _run():
+        it = iter_factory()
+        try:
+            _feed(it)
+        finally:
+            # 途中で止めた場合も抽出器（プールのワーカーなど）を確実に解放する
+            close = getattr(it, "close", None)
+            if close:
+                close()
+
+    def _feed(it):
+        for item in it:
+            # 中断時に満杯のキューで待ち続けないよう、put は時間を区切って再試行する
+            while True:
+                if stop.is_set():
+                    return
+                fut = asyncio.run_coroutine_threadsafe(
+                    asyncio.wait_for(out_q.put(item), 1.0), loop
+                )
+                try:
+                    fut.result()
+                    break
+                except asyncio.TimeoutError:
+                    continue
+
+    try:
+        await asyncio.to_thread(_run)
+    finally:
+        await out_q.put(_DONE)
+
+
+async def _split_stage(
+    in_q: asyncio.Queue,
+    out_q: asyncio.Queue,
+    n_embedders: int,
+    progress: Optional[Reporter] = None,
+):
+    from workers.extractors import _clean_text
+    from workers.text_splitter import make_splitter
+
+    # 初回はトークナイザの読み込みがあるのでスレッドで作る
+    splitter = await asyncio.to_thread(make_splitter)
+    idx = 0
+    try:
+        while True:
+            item = await in_q.get()
+            if item is _DONE:
+                break
+            text, page = item
+            if not (text and text.strip()):
+                if progress:
+                    progress.add("extracted", pages=1)
+                continue
+            pieces = await asyncio.to_thread(splitter.split_text, _clean_text(text))
+            if progress:
+                progress.add("extracted", pages=1, chunks=len(pieces))
+            for piece in pieces:
+                await out_q.put((idx, _clean_text(piece), page))
+                idx += 1
+        # 全ページを分割し終えたので、チャンクの総数が決まる
+        if progress:
+            progress.update("extracted", force=True, total=idx)
+    finally:
+        for _ in range(n_embedders):
+            await out_q.put(_DONE)
+
+
+async def _embed_stage(
+    in_q: asyncio.Queue,
+    out_q: asyncio.Queue,
+    batch_size: int,
+    reuse: Optional[Callable[[Chunk], bool]] = None,
+    progress: Optional[Reporter] = None,
+):
+    # バッチが埋まるか、上流が終わるまで溜めてから 1 リクエストで埋め込む
+    # reuse が True を返したチャンク（既存の行をそのまま使うもの）は埋め込みも INSERT もしない
+    done = False
+    try:
+        while not done:
+            batch: List[Chunk] = []
+            while len(batch) < batch_size:
+                item = await in_q.get()
+                if item is _DONE:
+                    done = True
+                    break
+                if reuse is not None and reuse(item):
+                    if progress:
+                        progress.add("embedded", reused=1)
+                    continue
+                batch.append(item)
+            if not batch:
+                continue
+            vectors = await embed_texts_cached([text for _, text, _ in batch])
+            if progress:
+                progress.add("embedded", embedded=len(batch))
+            for (idx, text, page), vec in zip(batch, vectors):
+                await out_q.put((idx, text, page, vec))
+    finally:
+        await out_q.put(_DONE)
+
+
+async def _insert_stage(
+    in_q: asyncio.Queue,
+    sink: Callable[[List[Row]], Awaitable[None]],
+    n_embedders: int,
+    batch_size: int,
+    progress: Optional[Reporter] = None,
+) -> int:
+    remaining = n_embedders  # 埋め込み側のワーカーがすべて終わるまで読む
+    batch: List[Row] = []
+    inserted = 0
+    while remaining:
+        item = await in_q.get()
+        if item is _DONE:
+            remaining -= 1
+            continue
+        batch.append(item)
+        if len(batch) >= batch_size:
+            await sink(batch)
+            inserted += len(batch)
+            if progress:
+                progress.add("inserted", inserted=len(batch))
+            batch = []
+    if batch:
+        await sink(batch)
+        inserted += len(batch)
+        if progress:
+            progress.add("inserted", inserted=len(batch))
+    return inserted
+
+
+# ==================================================
+## 公開エントリポイント
+# ==================================================
+async def run_pipeline(
+    iter_factory: Callable[[], Iterator[Tuple[str, Optional[int]]]],
+    sink: Callable[[List[Row]], Awaitable[None]],
+    *,
+    embed_batch: int = EMBED_BATCH_SIZE,
+    embed_workers: int = EMBED_CONCURRENCY,
+    insert_batch: int = INGEST_INSERT_BATCH,
+    reuse: Optional[Callable[[Chunk], bool]] = None,
+    progress: Optional[Reporter] = None,
+) -> int:
+    """
+    iter_factory が返す (テキスト, ページ) を順に分割・埋め込みし、INSERT 用の行を sink に渡す。
+    sink には最大 insert_batch 行ずつ (チャンク番号, 本文, ページ, 埋め込み) が渡る
+    （埋め込みが並行に進むので、バッチ内の順序はチャンク番号順とは限らない）。
+    reuse を渡すと、分割後の各チャンクについて埋め込み前に呼び、True なら以降の段に流さない
+    （差分再取り込みで、本文が変わっていないチャンクを呼び出し側が引き取る）。
+    progress を渡すと、抽出ページ数・チャンク数・埋め込み / 流用 / INSERT の件数を足し込む。
+    戻り値: sink に渡した行数。どこかの段で失敗したら残りの段を止めて例外を送出する
+    """
+    n_embedders = max(1, embed_workers)
+    pages_q: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_PAGES)
+    chunks_q: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_CHUNKS)
+    rows_q: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_ROWS)
+    stop = threading.Event()
+
+    tasks = [
+        asyncio.ensure_future(_extract_stage(iter_factory, pages_q, stop)),
+        asyncio.ensure_future(_split_stage(pages_q, chunks_q, n_embedders, progress)),
+        *(
+            asyncio.ensure_future(
+                _embed_stage(chunks_q, rows_q, max(1, embed_batch), reuse, progress)
+            )
+            for _ in range(n_embedders)
+        ),
+    ]
+    insert_task = asyncio.ensure_future(
+        _insert_stage(rows_q, sink, n_embedders, max(1, insert_batch), progress)
+    )
+    try:
+        await asyncio.gather(*tasks, insert_task)
+        return insert_task.result()
+    finally:
+        stop.set()
+        for t in (*tasks, insert_task):
+            t.cancel()
+        # 取り消された段が終端の目印を置けるよう、キューを空けておく
+        for q in (pages_q, chunks_q, rows_q):
+            while not q.empty():
+                q.get_nowait()
+        await asyncio.gather(*tasks, insert_task, return_exceptions=True)
+
+
+async def run_from_storage(
+    bucket: str,
+    object_path: str,
+    open_iter: Callable[[str], Iterator[Tuple[str, Optional[int]]]],
+    sink: Callable[[List[Row]], Awaitable[None]],
+    *,
+    reuse: Optional[Callable[[Chunk], bool]] = None,
+    progress: Optional[Reporter] = None,
+) -> int:
+    """Storage のオブジェクトを一時ファイルに落としてから run_pipeline を回す（終了後に削除）"""
+    suffix = os.path.splitext(object_path)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        size = await download_to_file(bucket, object_path, tmp)
+        if progress:
+            progress.update("downloaded", force=True, bytes=size, source="storage")
+        return await run_pipeline(
+            lambda: open_iter(tmp.name), sink, reuse=reuse, progress=progress
+        )
@@ -1,37 +1,49 @@
 # backend/services/ingest_sync.py
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
-from typing import Optional
+import socket
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
 
-from supabase import create_client, Client
+from config import EMBED_DIMS, EMBED_MODEL
 from crud import SupaRest
+from services import ingest_progress, upload_spool
+from workers.ingest_pipeline import run_from_storage, run_pipeline
+from workers.extract_pool import iter_extracted_pooled
+from workers import text_splitter
 
-# あなたが既に作成済みの汎用インジェスト関数（Storage → 抽出 → チャンク化 → 埋め込み → INSERT）
-# 例: workers/ingest_any.py にある ingest_from_storage を利用
-
-# RAG関連のインポート
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-
-EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
-CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))
-CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "100"))
-emb = OpenAIEmbeddings(model=EMBED_MODEL, api_key=os.environ["OPENAI_API_KEY"])
+# 添付ファイルの取り込み（Storage → 抽出 → チャンク化 → 埋め込み → documents / chunks へ INSERT）
+# アップロード後のジョブ（workers/job_worker.py）とチャット時の取り込みの両方がここを通る
 
 
 # ======== 環境変数（server-side only）========
-SUPABASE_URL = os.environ["SUPABASE_URL"]
-SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
 DEFAULT_STORAGE_BUCKET = os.getenv("STORAGE_PRIVATE_BUCKET", "private")
+SUPABASE_SERVICE_ROLE_KEY = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+# 差分再取り込み: 文書を取り込み直すとき、本文が変わっていないチャンクは埋め込みを流用する
+# （0 にすると旧チャンクをすべて消して埋め込み直す）
+INGEST_INCREMENTAL = os.getenv("INGEST_INCREMENTAL", "1") == "1"
+# 取り込みのリース（別プロセスの同時取り込みを防ぐ）。取り込み中は 1/3 ごとに延長する
+INGEST_LOCK_LEASE_SEC = int(os.getenv("INGEST_LOCK_LEASE_SEC", "600"))
+# 別のワーカーが取り込み中のとき、完了を待つ上限と確認間隔
+# チャット時の取り込みは応答を止めないよう、結果を待つのを CHAT の秒数で切り上げる
+# （取り込み自体は続け、切り上げた後はチャット側の READY 待ち（RAGchat の 3.1）に任せる）
+INGEST_LOCK_WAIT_SEC = float(os.getenv("INGEST_LOCK_WAIT_SEC", "300"))
+INGEST_LOCK_WAIT_CHAT_SEC = float(os.getenv("INGEST_LOCK_WAIT_CHAT_SEC", "8"))
+INGEST_LOCK_POLL_SEC = float(os.getenv("INGEST_LOCK_POLL_SEC", "1.0"))
+INGEST_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+# 既存チャンクを読み出すときの 1 ページの行数（PostgREST の max-rows 以下にする）
+_CHUNK_PAGE = 1000
 
 
-def _admin_sb() -> Client:
-    """サービスロールで Supabase クライアントを作成（DB/Storage 挿入用）"""
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+class IngestBusy(TimeoutError):
+    """別のワーカーが取り込み中で、待ち時間の上限までに終わらなかった（取り込み自体の失敗ではない）"""
 
 
-def _split_storage_path(storage_path: str) -> tuple[str, str]:
+def split_storage_path(storage_path: str) -> tuple[str, str]:
     """
     storage_path から (bucket, object_path) を返す。
     例: "private/thread-123/123-abc.pdf" -> ("private", "thread-123/123-abc.pdf")
@@ -47,7 +59,7 @@ def _split_storage_path(storage_path: str) -> tuple[str, str]:
     return (DEFAULT_STORAGE_BUCKET, storage_path)
 
 
-def _is_image(mime: Optional[str], object_path: str) -> bool:
+def is_image(mime: Optional[str], object_path: str) -> bool:
     """
     画像はスキップ対象（RAGのテキスト抽出対象外）
     画像はテキストではないため個別に処理
@@ -72,11 +84,161 @@ def _is_image(mime: Optional[str], object_path: str) -> bool:
     )
 
 
+def text_sha256(text: str) -> str:
+    """app.chunks.text_sha256 と同じ値（正規化しない本文そのものの sha256）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+async def _existing_chunks(
+    client: SupaRest, document_id: str
+) -> Dict[str, List[Dict[str, Any]]]:
+    """文書の既存チャンクを本文ハッシュごとに chunk_index 順でまとめる（本文と埋め込みは読まない）"""
+    by_hash: Dict[str, List[Dict[str, Any]]] = {}
+    last_id: Any = 0
+    while True:
+        rows = await client.get(
+            "chunks",
+            params={
+                "select": "id,chunk_index,text_sha256,meta",
+                "document_id": f"eq.{document_id}",
+                "id": f"gt.{last_id}",
+                "order": "id.asc",
+                "limit": _CHUNK_PAGE,
+            },
+            accept_profile="app",
+        )
+        for r in rows:
+            by_hash.setdefault(r.get("text_sha256") or "", []).append(r)
+        if len(rows) < _CHUNK_PAGE:
+            break
+        last_id = rows[-1]["id"]
+    for group in by_hash.values():
+        group.sort(key=lambda r: r["chunk_index"])
+    return by_hash
+
+
+def ingest_key() -> str:
+    """取り込み設定の識別子。これが同じで status='ready' の文書があれば取り込み済みとみなす"""
+    return f"{EMBED_MODEL}:{EMBED_DIMS}:{text_splitter.signature()}"
+
+
+def _same_embedding(prev_key: Optional[str]) -> bool:
+    # 旧チャンクの埋め込みを流用してよいか（モデル・次元が同じ）。
+    # 設定を記録する前の文書（prev_key なし）は現在の設定で作られたものとして扱う
+    if not prev_key:
+        return True
+    return prev_key.split(":")[:2] == [EMBED_MODEL, str(EMBED_DIMS)]
+
+
+# 同じプロセス内の同時呼び出しは 1 回の取り込みを共有する（添付 ID, 取り込み設定）→ 実行中のタスク
+_inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+async def ingest_attachment(attachment_id: str, wait: Optional[float] = None) -> int:
+    """
+    添付 1 件を documents / chunks に取り込む（唯一の取り込み経路。service_role で実行する）。
+    (添付, 埋め込みモデル, チャンク分割設定) ごとに冪等で、取り込み済みなら何もせず 0 を返す。
+    - 同じプロセス内の同時呼び出しは、実行中の取り込みの完了を待って結果を共有する
+    - 別プロセス（ジョブワーカー / 他の API ワーカー）との排他は begin_ingest のリースで行う
+    wait: 結果を待つ上限（秒）。超えたら IngestBusy（取り込みは止めずに続ける）
+    戻り値: 新しく埋め込んで INSERT したチャンク数
+    """
+    # 初回はトークナイザの読み込みがあるのでスレッドで求める
+    key = (attachment_id, await asyncio.to_thread(ingest_key))
+    fut = _inflight.get(key)
+    if fut is None:
+        # 共有する取り込みは呼び出し元によらず同じ条件（service_role・最長の待ち時間）で走らせる
+        client = SupaRest(service_key=SUPABASE_SERVICE_ROLE_KEY)
+        fut = asyncio.ensure_future(
+            _ingest_once(attachment_id, client, key[1], INGEST_LOCK_WAIT_SEC)
+        )
+        _inflight[key] = fut
+        fut.add_done_callback(lambda _: _inflight.pop(key, None))
+    # 呼び出し元（チャットのストリームなど）が切断されても、共有中の取り込みは止めない
+    if wait is None:
+        return await asyncio.shield(fut)
+    try:
+        return await asyncio.wait_for(asyncio.shield(fut), wait)
+    except asyncio.TimeoutError:
+        raise IngestBusy(
+            f"ingest of attachment {attachment_id} did not finish within {wait:g}s"
+        ) from None
+
+
 async def ingest_sync_from_attachment(attachment_id: str, user_token: str) -> int:
-    user_client = SupaRest(user_token)
+    """チャット時の取り込み（ユーザから見える添付に限る。結果を待つのは短く切り上げる）"""
+    # 取り込みは service_role で走るので、添付を読めるかどうかは先にユーザのトークンで確かめる
+    att = await SupaRest(user_token).get_one(
+        "attachments", select="id", id=attachment_id, accept_profile="app"
+    )
+    if not att:
+        raise ValueError(f"attachment not found: {attachment_id}")
+    return await ingest_attachment(attachment_id, wait=INGEST_LOCK_WAIT_CHAT_SEC)
+
+
+async def _begin_once(client: SupaRest, attachment_id: str, key: str) -> Dict[str, Any]:
+    rows = await client.rpc(
+        "begin_ingest",
+        {
+            "in_attachment_id": attachment_id,
+            "in_ingest_key": key,
+            "in_worker": INGEST_WORKER_ID,
+            "in_lease_sec": INGEST_LOCK_LEASE_SEC,
+        },
+    )
+    return rows[0] if isinstance(rows, list) else rows
+
+
+async def _begin(
+    client: SupaRest, attachment_id: str, key: str, lock_wait: float
+) -> Dict[str, Any]:
+    """リースを取るか、取り込み済みになるまで（最大 lock_wait 秒）待つ。戻り値は begin_ingest の 1 行"""
+    deadline = time.monotonic() + lock_wait
+    while True:
+        row = await _begin_once(client, attachment_id, key)
+        if row["state"] != "busy":
+            return row
+        if time.monotonic() >= deadline:
+            raise IngestBusy(
+                f"ingest of attachment {attachment_id} is still running elsewhere"
+            )
+        await asyncio.sleep(INGEST_LOCK_POLL_SEC)
+
+
+async def _keep_lease(client: SupaRest, attachment_id: str, key: str):
+    # 取り込み中はリースを延長し続ける（同じワーカー ID で begin_ingest を呼び直す）
+    while True:
+        await asyncio.sleep(INGEST_LOCK_LEASE_SEC / 3)
+        try:
+            row = await _begin_once(client, attachment_id, key)
+            if row["state"] != "acquired":
+                print(f"[ingest_sync] lease lost attachment={attachment_id} state={row['state']}")
+        except Exception as e:
+            print("[ingest_sync] lease extension failed:", repr(e))
+
 
+async def _ingest_once(attachment_id: str, client: SupaRest, key: str, lock_wait: float) -> int:
+    # 進捗（GET /attachments/ingest-progress で購読できる）。失敗はエラー内容ごと配信する
+    # （IngestBusy は取り込み中の別プロセスが進捗を配信しているので何も送らない）
+    progress = ingest_progress.Reporter(attachment_id)
+    try:
+        return await _ingest_reported(attachment_id, client, key, lock_wait, progress)
+    except IngestBusy:
+        raise
+    except Exception as e:
+        progress.failed(e)
+        raise
+
+
+async def _ingest_reported(
+    attachment_id: str,
+    client: SupaRest,
+    key: str,
+    lock_wait: float,
+    progress: ingest_progress.Reporter,
+) -> int:
     # attachments を取得
-    att = await user_client.get_one(
+    att = await client.get_one(
         "attachments",
         select="id, thread_id, project_id, owner_user_id, storage_path, mime, size, title",
         id=attachment_id,
@@ -87,100 +249,101 @@ async def ingest_sync_from_attachment(attachment_id: str, user_token: str) -> in
 
     thread_id = att["thread_id"]
     project_id = att["project_id"]
+    progress.scope(thread_id, project_id)
     owner_user_id = att["owner_user_id"]
     storage_path: str = att.get("storage_path") or ""
     mime: str | None = att.get("mime")
     title: str = att.get("title") or "Untitled"
 
-    bucket, object_path = _split_storage_path(storage_path)
+    bucket, object_path = split_storage_path(storage_path)
     if not object_path:
         raise ValueError(f"invalid storage_path: {storage_path!r}")
 
-    if _is_image(mime, object_path):
+    if is_image(mime, object_path):
         print(f"Skipping image file: {object_path}")
+        progress.ready(skipped="image")
         return 0  # チャンクは0件（テキスト抽出しない）
 
-    # PDF/テキスト抽出（既存ロジックを簡約）
-    sb = _admin_sb()  # ストレージのRLSは強力でservice_role出ないと使用不可
-    raw: bytes = sb.storage.from_(bucket).download(
-        object_path
-    )  # ストレージからデータ抽出
-    if not isinstance(raw, (bytes, bytearray)):
-        raw = raw["data"]
-
-    from workers.ingest_RAG_document import (
-        _guess_mime,
-        _extract_pdf,
-        _extract_docx,
-        _extract_pptx,
-        _extract_markdown,
-        _extract_html,
-        _extract_json,
-        _extract_plain,
-        _extract_csv_like,
-        _TEXT_MIME,
-        _DOC_MIME,
-        _PPT_MIME,
-        _PDF_MIME,
-        _CSV_MIME,
+    # 取り込み済みならここで終わり（ダウンロードもしない）
+    lease = await _begin(client, attachment_id, key, lock_wait)
+    if lease["state"] == "done":
+        progress.ready(skipped="done")
+        return 0
+    document_id: str = lease["document_id"]
+    progress.update("started", force=True, documentId=document_id)
+    keeper = asyncio.ensure_future(_keep_lease(client, attachment_id, key))
+    try:
+        inserted = await _ingest_into(
+            client,
+            document_id,
+            attachment_id=attachment_id,
+            bucket=bucket,
+            object_path=object_path,
+            mime=mime,
+            title=title,
+            owner_user_id=owner_user_id,
+            project_id=project_id,
+            thread_id=thread_id,
+            reuse_embeddings=INGEST_INCREMENTAL and _same_embedding(lease.get("prev_key")),
+            progress=progress,
+        )
+    except BaseException:
+        keeper.cancel()
+        try:
+            await client.rpc(
+                "end_ingest",
+                {"in_document_id": document_id, "in_worker": INGEST_WORKER_ID},
+            )
+        except Exception as e:
+            print("[ingest_sync] end_ingest (failure) error:", repr(e))
+        raise
+    keeper.cancel()
+    await client.rpc(
+        "end_ingest",
+        {"in_document_id": document_id, "in_worker": INGEST_WORKER_ID, "in_ingest_key": key},
     )
+    await asyncio.to_thread(upload_spool.discard, attachment_id)  # 取り込み済みになったので控えは不要
+    progress.ready()
+    return inserted
 
-    mime = _guess_mime(object_path, mime)
-    if mime in _PDF_MIME or object_path.lower().endswith(".pdf"):
-        extracted = _extract_pdf(raw)  # List[(text, page)]
-    elif mime in _DOC_MIME or object_path.lower().endswith(".docx"):
-        extracted = _extract_docx(raw)
-    elif mime in _PPT_MIME or object_path.lower().endswith(".pptx"):
-        extracted = _extract_pptx(raw)
-    elif mime in _TEXT_MIME or object_path.lower().endswith(
-        (".txt", ".md", ".markdown", ".html", ".htm", ".json")
-    ):
-        if str(mime).startswith("text/markdown") or object_path.lower().endswith(
-            (".md", ".markdown")
-        ):
-            extracted = _extract_markdown(raw)
-        elif str(mime) == "text/html" or object_path.lower().endswith(
-            (".html", ".htm")
-        ):
-            extracted = _extract_html(raw)
-        elif str(mime) == "application/json" or object_path.lower().endswith(".json"):
-            extracted = _extract_json(raw)
-        else:
-            extracted = _extract_plain(raw)
-    elif mime in _CSV_MIME or object_path.lower().endswith((".csv", ".tsv")):
-        extracted = _extract_csv_like(raw)
-    else:
-        extracted = _extract_plain(raw)
-
-    # ドキュメント行を作成（status=ready）
-    doc_row = await user_client.post(
-        "documents",
-        json={
-            "attachment_id": attachment_id,
-            "owner_user_id": owner_user_id,
-            "project_id": project_id,
-            "thread_id": thread_id,
-            "title": title,
-            "status": "ready",
-            "meta": {"source": f"{bucket}/{object_path}"},
-        },
-        content_profile="app",
-        prefer="return=representation",
-    )
-    document_id = doc_row[0]["id"]
 
-    # チャンク化
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
-    )
-    chunks_to_insert: list[dict] = []
-    chunk_idx = 0
-    for text, page in extracted:
-        if not (text and text.strip()):
-            continue
-        for piece in splitter.split_text(text):
-            vec = emb.embed_query(piece)
-            chunks_to_insert.append(
+async def _ingest_into(
+    client: SupaRest,
+    document_id: str,
+    *,
+    attachment_id: str,
+    bucket: str,
+    object_path: str,
+    mime: Optional[str],
+    title: str,
+    owner_user_id: str,
+    project_id: Optional[str],
+    thread_id: Optional[str],
+    reuse_embeddings: bool,
+    progress: Optional[ingest_progress.Reporter] = None,
+) -> int:
+    source = f"{bucket}/{object_path}"
+
+    # 差分再取り込みの準備: 文書の既存チャンク（本文ハッシュ → 行）を読む
+    # 埋め込みを流用できない場合（モデル変更など）も、最後に旧チャンクを消すために読む
+    existing = await _existing_chunks(client, document_id)
+    kept: List[Tuple[Dict[str, Any], int, Optional[int]]] = []  # (旧行, 新しい番号, ページ)
+
+    # 本文が同じ旧チャンクが残っていれば引き取る（埋め込み・INSERT をしない）
+    # 同じ本文が複数回出てくる場合は、旧チャンクを前から順に 1 つずつ割り当てる
+    def _reuse(chunk) -> bool:
+        idx, text, page = chunk
+        olds = existing.get(text_sha256(text))
+        if not olds:
+            return False
+        kept.append((olds.pop(0), idx, page))
+        return True
+
+    # 埋め込み済みの行をまとめて INSERT
+    async def _sink(rows) -> None:
+        await client.post(
+            "chunks",
+            json=[
                 {
                     # app.chunks スキーマに合わせる
                     "document_id": document_id,
@@ -189,29 +352,77 @@ async def ingest_sync_from_attachment(attachment_id: str, user_token: str) -> in
                     "thread_id": thread_id,
                     "chunk_index": chunk_idx,
                     "text": piece,
+                    "text_sha256": text_sha256(piece),
                     "embedding": vec,
-                    "meta": {
-                        "page": page,
-                        "title": title,
-                        "source": f"{bucket}/{object_path}",
-                    },
+                    "meta": {"page": page, "title": title, "source": source},
                 }
-            )
-            chunk_idx += 1
-
-    # 一括INSERT（大きければ分割）
-    inserted = 0
-    BATCH = 100
-    for i in range(0, len(chunks_to_insert), BATCH):
-        batch = chunks_to_insert[i : i + BATCH]
-        if not batch:
-            continue
-        await user_client.post(
-            "chunks",
-            json=batch,
+                for chunk_idx, piece, page, vec in rows
+            ],
             content_profile="app",
             prefer="return=minimal",
         )
-        inserted += len(batch)
 
+    # ダウンロード → ページ単位の抽出 → 分割 → 埋め込み → INSERT を重ねて実行する
+    # （抽出は専用プロセスプール、分割はスレッド、各段は上限つきキューでつながる）
+    # アップロード時の控え（同じホスト）があれば、Storage からのダウンロードを省く
+    open_iter = lambda path: iter_extracted_pooled(path, object_path, mime)
+    reuse = _reuse if existing and reuse_embeddings else None
+    async with upload_spool.claim(attachment_id) as spooled:
+        if spooled:
+            if progress:
+                progress.update(
+                    "downloaded", force=True, bytes=os.path.getsize(spooled), source="spool"
+                )
+            inserted = await run_pipeline(
+                lambda: open_iter(spooled), _sink, reuse=reuse, progress=progress
+            )
+        else:
+            inserted = await run_from_storage(
+                bucket, object_path, open_iter, _sink, reuse=reuse, progress=progress
+            )
+    if existing:
+        await _reconcile(client, document_id, existing, kept, title, source)
+    print(
+        f"[ingest_sync] document={document_id} inserted={inserted} reused={len(kept)}"
+    )
     return inserted
+
+
+async def _reconcile(
+    client: SupaRest,
+    document_id: str,
+    leftover: Dict[str, List[Dict[str, Any]]],
+    kept: List[Tuple[Dict[str, Any], int, Optional[int]]],
+    title: str,
+    source: str,
+) -> None:
+    """
+    差分再取り込みの後始末。引き取った旧チャンクの番号・ページ・出典を新しい並びに合わせ、
+    どの新チャンクにも割り当てられなかった旧チャンクを削除する（1 回の RPC でまとめて行う）
+    """
+    changed = [
+        (old, idx, page)
+        for old, idx, page in kept
+        if old["chunk_index"] != idx
+        or (old.get("meta") or {}).get("page") != page
+        or (old.get("meta") or {}).get("title") != title
+        or (old.get("meta") or {}).get("source") != source
+    ]
+    removed = [r["id"] for group in leftover.values() for r in group]
+    if not changed and not removed:
+        return
+    await client.rpc(
+        "reconcile_chunks",
+        {
+            "in_document_id": document_id,
+            "in_keep_ids": [old["id"] for old, _, _ in changed],
+            "in_keep_index": [idx for _, idx, _ in changed],
+            "in_keep_page": [page for _, _, page in changed],
+            "in_delete_ids": removed,
+            "in_title": title,
+            "in_source": source,
+        },
+    )
+    print(
+        f"[ingest_sync] reconciled document={document_id} renumbered={len(changed)} deleted={len(removed)}"
+    )
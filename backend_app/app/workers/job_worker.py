@@ -0,0 +1,165 @@
+# app.jobs のジョブを実行するワーカー
+# API プロセス内で起動する（main.py の startup）ほか、単独のプロセスとしても動かせる:
+#   cd backend_app/app && python -m workers.job_worker
+# - claim_jobs でリースを取ってから実行し、実行中は JOB_LEASE_SEC の 1/3 ごとにリースを延長する
+# - プロセスが落ちてリースが切れたジョブは、別のワーカーが取り直して再実行する
+# - 失敗したジョブは指数バックオフで再試行し、JOB_MAX_ATTEMPTS 回で failed にする
+from __future__ import annotations
+import asyncio, os, socket, traceback, uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from services import job_queue
+
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+# 全ワーカー合計の同時実行数の上限（0 なら無制限）
+JOB_MAX_RUNNING = int(os.getenv("JOB_MAX_RUNNING", "0"))
+JOB_LEASE_SEC = int(os.getenv("JOB_LEASE_SEC", "60"))
+JOB_POLL_SEC = float(os.getenv("JOB_POLL_SEC", "2.0"))
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]
+
+
+# ==================================================
+## ジョブ種別ごとの処理
+# ==================================================
+async def _ingest_attachment(payload: Dict[str, Any]) -> Dict[str, Any]:
+    from workers.ingest_sync import ingest_attachment
+
+    # service_role で取り込む（チャット時の取り込みと同じ経路・同じ冪等性）
+    inserted = await ingest_attachment(payload["attachment_id"])
+    return {"inserted": inserted}
+
+
+HANDLERS: Dict[str, Handler] = {
+    "ingest_attachment": _ingest_attachment,
+}
+
+
+class JobWorker:
+    def __init__(
+        self,
+        handlers: Dict[str, Handler] = HANDLERS,
+        *,
+        concurrency: int = JOB_WORKER_CONCURRENCY,
+        lease_sec: int = JOB_LEASE_SEC,
+        poll_sec: float = JOB_POLL_SEC,
+        max_running: int = JOB_MAX_RUNNING,
+    ):
+        self.handlers = handlers
+        self.concurrency = max(1, concurrency)
+        self.lease_sec = max(5, lease_sec)
+        self.poll_sec = poll_sec
+        self.max_running = max_running or None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._running: Set[asyncio.Task] = set()
+        self._loop_task: Optional[asyncio.Task] = None
+
+    # ==================================================
+    ## 1 ジョブの実行（リース延長つき）
+    # ==================================================
+    async def _run_job(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        handler = self.handlers.get(job["kind"])
+        work = asyncio.ensure_future(
+            handler(job.get("payload") or {})
+            if handler
+            else _unknown_kind(job["kind"])
+        )
+        try:
+            # 実行中はリースを延長し続ける。取り上げられたら（別ワーカーが再取得）中断する
+            while True:
+                done, _ = await asyncio.wait({work}, timeout=self.lease_sec / 3)
+                if done:
+                    break
+                if not await job_queue.heartbeat(job_id, self.worker_id, self.lease_sec):
+                    print(f"[job_worker] lease lost, abort job={job_id}")
+                    work.cancel()
+                    return
+            result = work.result()
+            if await job_queue.finish(job_id, self.worker_id, result):
+                print(f"[job_worker] done job={job_id} kind={job['kind']} result={result}")
+            else:
+                # リースが切れて別のワーカーに取られていた（結果は記録されない。取った側がやり直す）
+                print(
+                    f"[job_worker] finished but lease was lost, result not recorded "
+                    f"job={job_id} kind={job['kind']} result={result}"
+                )
+        except asyncio.CancelledError:
+            work.cancel()
+            raise  # 停止時はリースを残す（切れたら別ワーカーが取り直す）
+        except Exception as e:
+            print(f"[job_worker] failed job={job_id} kind={job['kind']} err={e!r}")
+            traceback.print_exc()
+            try:
+                status = await job_queue.fail(
+                    job_id, self.worker_id, repr(e), int(job.get("attempts") or 1)
+                )
+                print(f"[job_worker] job={job_id} -> {status}")
+            except Exception as fe:
+                print("[job_worker] fail_job error:", repr(fe))
+
+    # ==================================================
+    ## ポーリングループ
+    # ==================================================
+    async def _loop(self):
+        wakeup = job_queue.wakeup_event()
+        kinds = list(self.handlers)
+        while True:
+            free = self.concurrency - len(self._running)
+            if free > 0:
+                try:
+                    jobs = await job_queue.claim(
+                        self.worker_id, kinds, free, self.lease_sec, self.max_running
+                    )
+                except Exception as e:
+                    print("[job_worker] claim error:", repr(e))
+                    jobs = []
+                for job in jobs:
+                    t = asyncio.ensure_future(self._run_job(job))
+                    self._running.add(t)
+                    t.add_done_callback(self._running.discard)
+                if len(jobs) == free:
+                    continue  # まだ残っているかもしれないので、枠が空き次第すぐ取りに行く
+            # 次のポーリング・新規登録・実行中ジョブの完了のいずれかまで待つ
+            wakeup.clear()
+            waiters = {asyncio.ensure_future(wakeup.wait()), *self._running}
+            done, pending = await asyncio.wait(
+                waiters, timeout=self.poll_sec, return_when=asyncio.FIRST_COMPLETED
+            )
+            for w in waiters - self._running:
+                w.cancel()
+
+    def start(self):
+        if self._loop_task is None:
+            print(f"[job_worker] start id={self.worker_id} concurrency={self.concurrency}")
+            self._loop_task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        for t in list(self._running):
+            t.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+
+async def _unknown_kind(kind: str):
+    raise RuntimeError(f"no handler for job kind: {kind}")
+
+
+async def _main():
+    from services.ingest_progress import progress_hub
+
+    # 取り込みの進捗を API ワーカーの購読者へ中継する（LISTEN/NOTIFY。DSN 未設定なら何もしない）
+    await progress_hub.start()
+    worker = JobWorker()
+    worker.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await worker.stop()
+        await progress_hub.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,177 @@
+from __future__ import annotations
+import os, re
+from collections import deque
+from functools import lru_cache
+from typing import Callable, List, Tuple
+
+# 取り込み用のチャンク分割（トークン数基準・文境界優先）
+# LangChain の RecursiveCharacterTextSplitter の代わりに使う（split_text(text) -> List[str] が同じ）
+# - 長さは文字数ではなく埋め込みモデルのトークン数で数える（日本語は 1 文字 ≒ 1 トークン前後で、文字数とずれる）
+# - 文（。！？!? と閉じ括弧・改行・英文のピリオド）の区切りでまとめ、文の途中では切らない。
+#   1 文が上限を超えるときだけ読点（、，,;）→ 文字数の順で分ける
+# - 半分以上埋まったチャンクは段落の終わり（空行）で切る（編集後も境界がずれにくい）
+# - 入力を 1 回なめるだけ（正規表現の finditer + 貪欲な詰め込み + 重なり用の deque）なので、
+#   数 MB のテキストでも線形時間で終わる。ただし文ごとにトークン化するぶん、文字数で切る recursive より
+#   英文・混在文で 3〜6 倍ほど遅い（分割の速さが効く一括取り込みでは CHUNK_SPLITTER=recursive も選べる）
+# トークナイザ（tiktoken のエンコーディング）はプロセス内で 1 度だけ読み込む。読み込めなければ例外にする
+# （黙って見積もりに切り替えると signature() が変わり、取り込み済みの文書がすべて再取り込みになるため）。
+# オフライン環境などでは CHUNK_TOKENIZER=estimate で、文字種からの見積もりを明示的に選ぶ
+
+# token: このモジュールの分割 / recursive: 従来の RecursiveCharacterTextSplitter（CHUNK_SIZE / CHUNK_OVERLAP 文字）
+CHUNK_SPLITTER = os.getenv("CHUNK_SPLITTER", "token")
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "100"))
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "80"))
+# text-embedding-3-* / ada-002 のエンコーディング（"estimate" なら tiktoken を使わず見積もる）
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "cl100k_base")
+ESTIMATE = "estimate"
+
+# 文の区切り: 終端記号・改行（続く閉じ括弧・引用符・空白ごと）。
+# 先頭が 1 つの文字クラスの単純な形にして、正規表現エンジンの高速な走査に乗せる。
+# 英文のピリオドは、直後が ASCII の文字（3.14 や e.g など）なら区切らない（sentences() で判定）
+_BOUNDARY = re.compile(r"[。．！？!?.\n][」』）)】〕\"'’”。．！？!?\n]*\s*")
+# 1 文が長すぎるときの区切り（読点・カンマ・セミコロン・空白）
+_CLAUSE = re.compile(r"[^、，,;；:：\s]*(?:[、，,;；:：]+|\s+)|[^、，,;；:：\s]+$")
+
+Counter = Callable[[str], int]
+
+
+@lru_cache(maxsize=4)
+def _load_encoding(name: str):
+    # 失敗は lru_cache に残らないので、一時的な失敗なら次の呼び出しで読み込み直す
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        raise RuntimeError(
+            f"tokenizer {name} could not be loaded ({e!r}); "
+            f"set CHUNK_TOKENIZER={ESTIMATE} to split with estimated token counts"
+        ) from e
+
+
+def _estimate_tokens(s: str) -> int:
+    # ASCII は 4 文字で 1 トークン、それ以外（かな・漢字など）は 1 文字 1 トークンと見積もる
+    n_ascii = len(s.encode("ascii", "ignore"))
+    return (len(s) - n_ascii) + (n_ascii + 3) // 4
+
+
+def get_counter(name: str = CHUNK_TOKENIZER) -> Tuple[str, Counter]:
+    """(トークナイザ名, 文字列 → トークン数) を返す"""
+    if name == ESTIMATE:
+        return ESTIMATE, _estimate_tokens
+    enc = _load_encoding(name)
+    encode = enc.encode_ordinary
+    return name, lambda s: len(encode(s))
+
+
+def sentences(text: str) -> List[str]:
+    """文（区切り記号と続く空白を含む）の並び。連結すると元の text に戻る"""
+    out: List[str] = []
+    start = 0
+    n = len(text)
+    for m in _BOUNDARY.finditer(text):
+        end = m.end()
+        if end == m.start() + 1 and end < n and text[end - 1] == "." and text[end] < "\x80":
+            continue
+        out.append(text[start:end])
+        start = end
+    if start < n:
+        out.append(text[start:])
+    return out
+
+
+class TokenTextSplitter:
+    """トークン数で chunk_size 以下にまとめ、前のチャンク末尾の文を chunk_overlap トークンまで重ねる"""
+
+    def __init__(
+        self,
+        chunk_size: int = CHUNK_TOKENS,
+        chunk_overlap: int = CHUNK_OVERLAP_TOKENS,
+        tokenizer: str = CHUNK_TOKENIZER,
+    ):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokenizer, self.count = get_counter(tokenizer)
+
+    # 上限を超える 1 文を、読点などの区切り → 文字数の順で分ける
+    def _pieces(self, sent: str) -> List[Tuple[str, int]]:
+        out: List[Tuple[str, int]] = []
+        for m in _CLAUSE.finditer(sent):
+            part = m.group(0)
+            if not part:
+                continue
+            k = self.count(part)
+            if k <= self.chunk_size:
+                out.append((part, k))
+                continue
+            # 区切りが無い長い塊は、トークン密度から決めた文字数で切る
+            width = max(1, len(part) * self.chunk_size // k)
+            for i in range(0, len(part), width):
+                seg = part[i : i + width]
+                out.append((seg, self.count(seg)))
+        return out
+
+    def split_text(self, text: str) -> List[str]:
+        chunks: List[str] = []
+        window: deque = deque()  # 今のチャンクに入っている (文, トークン数)
+        total = 0
+        fresh = False  # 重なり以外の新しい文が window にあるか
+
+        def flush():
+            nonlocal total, fresh
+            body = "".join(s for s, _ in window).strip()
+            if body:
+                chunks.append(body)
+            # 末尾から重なり分だけ残して、次のチャンクの先頭にする
+            keep, kept = [], 0
+            for s, k in reversed(window):
+                if kept + k > self.chunk_overlap:
+                    break
+                keep.append((s, k))
+                kept += k
+            window.clear()
+            window.extend(reversed(keep))
+            total, fresh = kept, False
+
+        limit = self.chunk_size
+        count = self.count
+        for sent in sentences(text):
+            n = count(sent)
+            for s, k in ((sent, n),) if n <= limit else self._pieces(sent):
+                if total + k > limit:
+                    if fresh:
+                        flush()
+                    # 重なりを入れると収まらない場合は、重なりを古い順に捨てる
+                    while window and total + k > limit:
+                        total -= window.popleft()[1]
+                window.append((s, k))
+                total += k
+                fresh = True
+            # 段落の終わり（空行）で半分以上埋まっていれば、そこで切る。
+            # 境界が段落に揃うので、途中に段落を足しても後ろのチャンクは前回と同じになる（差分の取り込みで再利用できる）
+            if fresh and total >= limit // 2 and sent.rstrip(" \t\r\u3000").endswith("\n\n"):
+                flush()
+        if fresh:
+            flush()
+        return chunks
+
+
+def make_splitter():
+    """設定（CHUNK_SPLITTER）に応じた分割器。どちらも split_text(text) -> List[str]"""
+    if CHUNK_SPLITTER == "recursive":
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+        return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return TokenTextSplitter()
+
+
+def signature() -> str:
+    """分割の設定を表す文字列（取り込みキーに含め、変われば再取り込みされるようにする）"""
+    if CHUNK_SPLITTER == "recursive":
+        return f"chars:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+    name, _ = get_counter()
+    return f"tokens:{name}:{CHUNK_TOKENS}:{CHUNK_OVERLAP_TOKENS}"
@@ -0,0 +1,21 @@
+export const runtime = "nodejs";
+export const dynamic = "force-dynamic";
+
+// 回答生成を止める（接続を切るだけだと再接続の猶予ぶん生成が続くため）
+export async function POST(req: Request) {
+  const backend = process.env.BACKEND_INTERNAL_URL;
+  const cookie = req.headers.get("cookie") || ""; // Cookieの取得
+  const { generationId } = await req.json();
+  const url = `${backend}/api/v1/chatbot/generations/${encodeURIComponent(generationId)}/cancel`;
+
+  const res = await fetch(url, {
+    method: "POST",
+    headers: { Cookie: cookie },
+    cache: "no-store",
+  });
+
+  return new Response(await res.text(), {
+    status: res.status,
+    headers: { "Content-Type": "application/json", "Cache-Control": "no-store" },
+  });
+}
@@ -0,0 +1,25 @@
+export const runtime = "nodejs";
+export const dynamic = "force-dynamic";
+
+// 入力途中の下書きをバックエンドに渡し、検索を先読みしてもらう
+export async function POST(req: Request) {
+  const backend = process.env.BACKEND_INTERNAL_URL;
+  const url = `${backend}/api/v1/chatbot/prefetch`;
+  const cookie = req.headers.get("cookie") || ""; // Cookieの取得
+  const payload = await req.json();
+
+  const res = await fetch(url, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      Cookie: cookie,
+    },
+    body: JSON.stringify(payload),
+    cache: "no-store",
+  });
+
+  return new Response(await res.text(), {
+    status: res.status,
+    headers: { "Content-Type": "application/json", "Cache-Control": "no-store" },
+  });
+}
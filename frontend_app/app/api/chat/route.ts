@@ -12,6 +12,12 @@ export async function POST(req: Request) {
   const cookie = req.headers.get("cookie") || "";// Cookieの取得
   // JSON データを JS のオブジェクトにする
   const payload = await req.json();
+  // 再接続用のヘッダ（途中から再送してもらうため）をそのまま転送
+  const resume: Record<string, string> = {};
+  const lastEventId = req.headers.get("last-event-id");
+  if (lastEventId) resume["Last-Event-ID"] = lastEventId;
+  const idemKey = req.headers.get("idempotency-key");
+  if (idemKey) resume["Idempotency-Key"] = idemKey;
 
   // クライアントのリクエストボディをそのままバックエンドへ
   const res = await fetch(url, {
@@ -22,6 +28,7 @@ export async function POST(req: Request) {
       Connection: "keep-alive",
       Cookie: cookie,
       "Cache-Control": "no-cache",
+      ...resume,
     },
     body: JSON.stringify(payload),
      // @ts-expect-error: Undici 拡張。Nodeの fetch でストリーム送信時は必須
@@ -35,6 +42,10 @@ export async function POST(req: Request) {
       "Content-Type": "text/event-stream",
       "Cache-Control": "no-cache",
       Connection: "keep-alive",
+      // 停止（/api/chat/cancel）で使う生成ID
+      ...(res.headers.get("x-generation-id")
+        ? { "X-Generation-Id": res.headers.get("x-generation-id")! }
+        : {}),
     },
   });
 }
@@ -104,6 +104,21 @@ export default function ChatPage({ threadId }: { threadId: string }) {
     if (threadId) selectThread(threadId);
   }, [threadId, selectThread]);
 
+  // 入力が止まったら下書きを送り、埋め込みと検索をサーバ側で先読みしてもらう（送信時の待ち時間短縮）
+  useEffect(() => {
+    const draft = input.trim();
+    if (!threadId || draft.length < 4) return;
+    const t = setTimeout(() => {
+      fetch("/api/chat/prefetch", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        credentials: "include",
+        body: JSON.stringify({ threadId, text: draft }),
+      }).catch(() => { });                                       // 先読みの失敗は無視
+    }, 600);
+    return () => clearTimeout(t);
+  }, [input, threadId]);
+
   // 新規メッセージ追加後に最下部へスクロール
   useEffect(() => {
     endRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -112,6 +127,25 @@ export default function ChatPage({ threadId }: { threadId: string }) {
   const draftIdRef = useRef<string | null>(null);                 // 下書き
   const serverAssistantIdRef = useRef<string | null>(null);       // サーバが発行した assistant_msg_id を保持
   const controllerRef = useRef<AbortController | null>(null);     // 強制終了ハンドラー
+  const generationIdRef = useRef<string | null>(null);            // 進行中の生成ID（停止用）
+
+  // 回答生成を止める：接続を切り、サーバ側の生成も猶予なしで打ち切ってもらう
+  const stopGeneration = () => {
+    const generationId = generationIdRef.current;
+    generationIdRef.current = null;
+    controllerRef.current?.abort();
+    if (!generationId) return;
+    fetch("/api/chat/cancel", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      credentials: "include",
+      body: JSON.stringify({ generationId }),
+      keepalive: true,                                           // ページ遷移中でも送り切る
+    }).catch(() => { });
+  };
+
+  // 画面を離れたら生成中の回答は止める
+  useEffect(() => () => stopGeneration(), []);
 
   // チャットを送信する関数
   const handleSend = async () => {
@@ -177,115 +211,137 @@ export default function ChatPage({ threadId }: { threadId: string }) {
           ? `${process.env.BACKEND_EXTERNAL_URL.replace(/\/$/, "")}/api/chat`
           : "/api/chat";
       console.log("[SSE] POST", CHAT_ENDPOINT, "開始");
-      const res = await fetch(CHAT_ENDPOINT, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-          "Accept": "text/event-stream",
-        },
-        credentials: "include",
-        body: JSON.stringify({
-          threadId,
-          messages: history,      // 既存の履歴
-          attachmentIds           // ファイルの保存先ID
-        }),
-        signal: controller.signal,
-        cache: "no-store",
-      });
-
-      // サーバからSSEが送られてきているかを検査
-      const ct = res.headers.get("content-type") ?? "";
-      if (!ct.includes("text/event-stream")) {
-        const body = await res.text().catch(() => "(no body)");
-        throw new Error(`unexpected content-type: ${ct} body=${body.slice(0, 200)}`);
-      }
-
-      console.log("[SSE] status:", res.status, "ct:", res.headers.get("content-type"));
+      const idemKey = crypto.randomUUID();                 // 同じ質問の再送で生成を共有するためのキー
+      let lastEventId: string | null = null;               // 最後に受信したフレームID（"<生成ID>:<連番>"）
+      let draft = "";                                      // 受信テキストを溜める（再接続をまたいで保持）
+      let retries = 0;
+      // 通信が途中で切れた場合は、同じ生成に再接続して取りこぼし分だけ受け取る
+      while (true) {
+        try {
+          const res = await fetch(CHAT_ENDPOINT, {
+            method: "POST",
+            headers: {
+              "Content-Type": "application/json",
+              "Accept": "text/event-stream",
+              "Idempotency-Key": idemKey,                            // 再送時に同じ生成へ再接続させる
+              ...(lastEventId ? { "Last-Event-ID": lastEventId } : {}), // 受信済みフレームの続きから再送
+            },
+            credentials: "include",
+            body: JSON.stringify({
+              threadId,
+              messages: history,      // 既存の履歴
+              attachmentIds           // ファイルの保存先ID
+            }),
+            signal: controller.signal,
+            cache: "no-store",
+          });
+
+          // サーバからSSEが送られてきているかを検査
+          const ct = res.headers.get("content-type") ?? "";
+          if (!ct.includes("text/event-stream")) {
+            const body = await res.text().catch(() => "(no body)");
+            throw new Error(`unexpected content-type: ${ct} body=${body.slice(0, 200)}`);
+          }
 
-      // ================================================================================================
-      // // 通信エラーハンドリング
-      // ================================================================================================
-      if (!res.ok) {
-        const errText = await res.text().catch(() => "(no body)");
-        console.error("[SSE] 非200応答:", res.status, errText);
-        throw new Error(`stream start failed: ${res.status} ${errText}`);
-      }
-      if (!res.body) {
-        console.error("[SSE] Response.body が null");
-        throw new Error("stream start failed: no body");
-      }
+          console.log("[SSE] status:", res.status, "ct:", res.headers.get("content-type"));
+          generationIdRef.current = res.headers.get("x-generation-id");
 
-      const reader = res.body.getReader();                // リーダを取得
-      const decoder = new TextDecoder("utf-8");           // utf-8デコーダ
-      let draft = "";                                     // 受信テキストを溜める
-      let buffer = "";                                    // 区切り対策のバッファ
+          // ================================================================================================
+          // // 通信エラーハンドリング
+          // ================================================================================================
+          if (!res.ok) {
+            const errText = await res.text().catch(() => "(no body)");
+            console.error("[SSE] 非200応答:", res.status, errText);
+            throw new Error(`stream start failed: ${res.status} ${errText}`);
+          }
+          if (!res.body) {
+            console.error("[SSE] Response.body が null");
+            throw new Error("stream start failed: no body");
+          }
 
-      // 回答が終わるまでstream通信を受け取る
-      while (true) {
-        const { value, done } = await reader.read();
-        if (done) break;
-
-        const chunk = decoder.decode(value, { stream: true });
-
-        // SSEで送られてくるデータは断片的
-        // SSEのeventの区切りは空行なので、空行が来るまではバッファにためておく（未完成の場合は次回のSSEに持ち越し）
-        buffer += chunk;
-        const events = buffer.split("\n\n");  // 空行で区切る
-        buffer = events.pop() ?? "";
-
-        // 完成したイベントごとの処理
-        for (const event of events) {
-          if (!event || event.startsWith(":")) continue;        // コメントは無視
-          const lines = event.split("\n");
-          // 各イベントの分解
-          for (const line of lines) {
-            if (!line.startsWith("data:")) continue;
-            const payload = line.slice(5).trim(); // 先頭5文字(data:)を削除
-            if (!payload) continue;
-
-            try {
-              const msg = JSON.parse(payload);
-
-              // --- 変更後：最初に "ready" を受け取ったら assistant_msg_id を控える ---
-              if (msg.type === "ready" && typeof msg.assistant_msg_id === "string") {
-                serverAssistantIdRef.current = msg.assistant_msg_id;   // サーバ側から送られてきた正式なIDを保存
-                continue;
-              }
+          const reader = res.body.getReader();                // リーダを取得
+          const decoder = new TextDecoder("utf-8");           // utf-8デコーダ
+          let buffer = "";                                    // 区切り対策のバッファ
+
+          // 回答が終わるまでstream通信を受け取る
+          while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+
+            const chunk = decoder.decode(value, { stream: true });
+
+            // SSEで送られてくるデータは断片的
+            // SSEのeventの区切りは空行なので、空行が来るまではバッファにためておく（未完成の場合は次回のSSEに持ち越し）
+            buffer += chunk;
+            const events = buffer.split("\n\n");  // 空行で区切る
+            buffer = events.pop() ?? "";
+
+            // 完成したイベントごとの処理
+            for (const event of events) {
+              if (!event || event.startsWith(":")) continue;        // コメントは無視
+              const lines = event.split("\n");
+              // 各イベントの分解
+              for (const line of lines) {
+                if (line.startsWith("id:")) {
+                  lastEventId = line.slice(3).trim();                // 再接続用に最後のフレームIDを控える
+                  continue;
+                }
+                if (!line.startsWith("data:")) continue;
+                const payload = line.slice(5).trim(); // 先頭5文字(data:)を削除
+                if (!payload) continue;
 
-              // メッセージタイプがチャンクかつメッセージの差分が文字列である場合
-              if (msg.type === "chunk" && typeof msg.delta === "string") {
-                draft += msg.delta;
-                const id = draftIdRef.current;
-                if (id) useStore.getState().updateMessage(id, draft);  // 既存ドラフトを更新
-                // 受信終了（完了）
-              } else if (msg.type === "end") {
-                console.log("[SSE] end 受信");
-
-                // --- 変更後：サーバDBに保存された最終状態と整合させるため refetch する ---
-                //   - ローカルのドラフトIDとサーバの assistant_msg_id は不一致のため、
-                //     完了後にDBの真実で上書きするのが安全
                 try {
-                  await refetch();                                     // DBとローカルストアを同期
-                } catch (e) {
-                  console.warn("[refetch after end] failed:", e);
+                  const msg = JSON.parse(payload);
+
+                  // --- 変更後：最初に "ready" を受け取ったら assistant_msg_id を控える ---
+                  if (msg.type === "ready" && typeof msg.assistant_msg_id === "string") {
+                    serverAssistantIdRef.current = msg.assistant_msg_id;   // サーバ側から送られてきた正式なIDを保存
+                    continue;
+                  }
+
+                  // メッセージタイプがチャンクかつメッセージの差分が文字列である場合
+                  if (msg.type === "chunk" && typeof msg.delta === "string") {
+                    draft += msg.delta;
+                    const id = draftIdRef.current;
+                    if (id) useStore.getState().updateMessage(id, draft);  // 既存ドラフトを更新
+                    // 受信終了（完了）
+                  } else if (msg.type === "end") {
+                    console.log("[SSE] end 受信");
+
+                    // --- 変更後：サーバDBに保存された最終状態と整合させるため refetch する ---
+                    //   - ローカルのドラフトIDとサーバの assistant_msg_id は不一致のため、
+                    //     完了後にDBの真実で上書きするのが安全
+                    try {
+                      await refetch();                                     // DBとローカルストアを同期
+                    } catch (e) {
+                      console.warn("[refetch after end] failed:", e);
+                    }
+                    // エラーハンドリング（下に継続）
+                  } else if (msg.type === "error") {
+                    console.error("[SSE] server error:", msg.message);
+                    throw new Error(String(msg.message || "server error"));
+                  }
+                } catch {
+                  // 終了を表すデータを受け取った場合終了する
+                  if (isTerminalToken(payload)) {
+                    // 終了トークンは無視して本文に追加しない
+                    continue;
+                  }
+                  // data行がJSON形式ではないデータだった場合(文字列が来たときなど)平文としてdraftに追加、保存
+                  draft += payload;
+                  const id = draftIdRef.current;
+                  if (id) useStore.getState().updateMessage(id, draft);
                 }
-                // エラーハンドリング（下に継続）
-              } else if (msg.type === "error") {
-                console.error("[SSE] server error:", msg.message);
-                throw new Error(String(msg.message || "server error"));
-              }
-            } catch {
-              // 終了を表すデータを受け取った場合終了する
-              if (isTerminalToken(payload)) {
-                // 終了トークンは無視して本文に追加しない
-                continue;
               }
-              // data行がJSON形式ではないデータだった場合(文字列が来たときなど)平文としてdraftに追加、保存
-              draft += payload;
-              const id = draftIdRef.current;
-              if (id) useStore.getState().updateMessage(id, draft);
             }
           }
+          break;                                           // 正常に読み切った
+        } catch (e) {
+          // ネットワーク断（TypeError）のみ再接続。中断・サーバエラーはそのまま投げる
+          if (controller.signal.aborted || !(e instanceof TypeError) || retries >= 3) throw e;
+          retries += 1;
+          console.warn("[SSE] 再接続します:", retries, lastEventId);
+          await new Promise((r) => setTimeout(r, 500 * retries));
         }
       }
     } catch (e) {
@@ -301,6 +357,7 @@ export default function ChatPage({ threadId }: { threadId: string }) {
       useAttachmentStore.getState().clearAll();   // 一時ファイルのバッファを初期化
       try { controller.abort(); } catch { }       // 通信を即座に終了させる
       controllerRef.current = null;               // 強制終了機能は通信ごとに用意するので、古いものは削除
+      generationIdRef.current = null;             // 生成は終わっているので停止の対象から外す
       draftIdRef.current = null;                  // ストリーミング用ドラフトIDをクリア
       serverAssistantIdRef.current = null;        // サーバIDもクリア
       setLoading(false);                          // 通信終了
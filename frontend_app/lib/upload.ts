@@ -12,12 +12,7 @@ export async function uploadPendingAttachments(threadId: string): Promise<Attach
     for (const p of pending) {
         try {
             markUploading(p.id);                // 送信状態を"uploading"に変更
-            const fd = new FormData();          // フォームデータを作成(入れ物を作成 -> データを追加すると「フォームの送信データ」という扱いになる)
-            fd.append("file", p.file, p.name);  // フォームデータを追加
-            fd.append("thread_id", threadId);   // 紐づけ先のスレッドIDを追加
-
-            // 指定したエンドポイントへPOSTメソッドを送りレスポンス(添付データの情報を含むデータ)を取得
-            const res = await fetch("/api/upload", { method: "POST", body: fd, credentials: "include" });
+            const res = await uploadOne(p.file, p.name, p.mime, threadId);
             if (!res.ok) throw new Error(await res.text());
 
             // サーバからのデータをJSON形式に変換し、ファイルの保存先URLを取得
@@ -35,4 +30,41 @@ export async function uploadPendingAttachments(threadId: string): Promise<Attach
     }
     // 呼び出し元に添付データの情報を返す
     return results;
-}
\ No newline at end of file
+}
+
+// 1ファイルを送信し、登録結果(POST /attachments と同じ形)のレスポンスを返す
+// 本文は署名つきURLで Storage へ直接送り(API を経由しない)、登録だけを API に依頼する
+// 署名つきURLに届かない環境では、従来どおり /api/upload 経由で送る
+async function uploadOne(file: File, name: string, mime: string, threadId: string): Promise<Response> {
+    const api = (path: string, body: unknown) =>
+        fetch(`/api/file?path=${encodeURIComponent(path)}`, {
+            method: "POST",
+            headers: { "content-type": "application/json" },
+            body: JSON.stringify(body),
+            credentials: "include",
+        });
+
+    // 1) 署名つきアップロードURLとチケットを取得
+    const urlRes = await api("attachments/upload-url", { threadId, filename: name, mime, size: file.size });
+    if (!urlRes.ok) return urlRes;
+    const { uploadUrl, ticket } = await urlRes.json();
+
+    // 2) Storage へ直接 PUT
+    let put: Response;
+    try {
+        put = await fetch(uploadUrl, {
+            method: "PUT",
+            headers: { "content-type": mime || "application/octet-stream", "x-upsert": "false" },
+            body: file,
+        });
+    } catch {
+        const fd = new FormData();
+        fd.append("file", file, name);
+        fd.append("thread_id", threadId);
+        return fetch("/api/upload", { method: "POST", body: fd, credentials: "include" });
+    }
+    if (!put.ok) return put;
+
+    // 3) 登録(ここで取り込みジョブも積まれる)
+    return api("attachments/complete", { ticket });
+}
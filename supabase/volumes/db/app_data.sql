@@ -712,6 +712,12 @@ create table if not exists app.documents (
   created_at    timestamptz not null default now(),
   updated_at    timestamptz not null default now()
 );
+-- 取り込みの冪等化: どの設定（埋め込みモデル・次元・チャンク分割）で取り込み済みかと、取り込み中のリース
+alter table app.documents add column if not exists ingest_key          text;
+alter table app.documents add column if not exists ingest_locked_by    text;
+alter table app.documents add column if not exists ingest_locked_until timestamptz;
+create index if not exists idx_documents_attachment on app.documents(attachment_id, created_at desc);
+
 drop trigger if exists trg_documents_touch_updated_at on app.documents;
 create trigger trg_documents_touch_updated_at
 before update on app.documents
@@ -735,124 +741,217 @@ create index if not exists idx_chunks_project on app.chunks(project_id);
 create index if not exists idx_chunks_thread  on app.chunks(thread_id);
 create index if not exists idx_chunks_meta    on app.chunks using gin (meta);
 
-drop index if exists app.idx_chunks_hnsw_cos;
-create index idx_chunks_hnsw_cos on app.chunks using hnsw (embedding vector_cosine_ops);
+-- 差分再取り込み用: チャンク本文の sha256（16 進）。同じ文書の旧チャンクと本文で突き合わせる
+alter table app.chunks add column if not exists text_sha256 text;
+update app.chunks
+   set text_sha256 = encode(sha256(convert_to(text, 'UTF8')), 'hex')
+ where text_sha256 is null;
+create index if not exists idx_chunks_doc_hash on app.chunks(document_id, text_sha256);
 
 -- =========================================
 -- I) ベクトル検索RPC（スコープ(スレッド内、プロジェクト内など)、一部指定。全探索）
 -- =========================================
+-- 埋め込みの保存形式（次元数・精度）はデータベースの設定で決める（既定: 1536 次元の vector = float32）
+--   alter database postgres set app.embed_dims    = '512';
+--   alter database postgres set app.embed_storage = 'halfvec';   -- vector（float32）/ halfvec（float16）
+-- を設定してからこのファイルを流し直すと、chunks.embedding の型・HNSW 索引・検索 RPC を作り直す。
+-- バックエンドの EMBED_DIMS / EMBED_STORAGE も同じ値にすること（起動時に app.embedding_config() と突き合わせる）。
+-- text-embedding-3-* は先頭の次元ほど情報を持つ（API の dimensions 指定は先頭を切り出して正規化したものと同じ）ので、
+-- 次元を減らすときは既存の埋め込みを切り詰めて正規化し、再埋め込みはしない（documents.ingest_key の次元も書き換える）。
+-- それ以外のモデルの文書と、次元を増やす場合は、チャンクを消して文書を stale にする（次の取り込みで作り直す）
 drop function if exists app.match_documents_scoped(vector,int,uuid,uuid) cascade;
-create or replace function app.match_documents_scoped(
-  query_embedding vector,
-  match_count int,
-  in_thread_id uuid,
-  in_project_id uuid
-)
-returns table(
-  id bigint,
-  document_id uuid,
-  owner_user_id uuid,
-  project_id uuid,
-  thread_id uuid,
-  text text,
-  metadata jsonb,
-  similarity double precision
-)
-language sql
-stable
-as $$
-  select
-    c.id,
-    c.document_id,
-    c.owner_user_id,
-    c.project_id,
-    c.thread_id,
-    c.text,
-    c.meta as metadata,
-    1 - (c.embedding <=> query_embedding) as similarity
-  from app.chunks c
-  where (
-      (in_thread_id  is not null and c.thread_id  = in_thread_id)
-   or (in_project_id is not null and c.project_id = in_project_id)
-   or (c.owner_user_id = auth.uid())
-  )
-  order by c.embedding <=> query_embedding
-  limit greatest(match_count, 1)
-$$;
-grant execute on function app.match_documents_scoped(vector,int,uuid,uuid) to authenticated;
-
 drop function if exists app.match_by_document_ids(vector,int,uuid[]) cascade;
-create or replace function app.match_by_document_ids(
-  query_embedding vector,
-  match_count int,
-  in_document_ids uuid[]
-)
-returns table(
-  id bigint,
-  document_id uuid,
-  owner_user_id uuid,
-  project_id uuid,
-  thread_id uuid,
-  text text,
-  metadata jsonb,
-  similarity double precision
-)
-language sql
-stable
-as $$
-  select
-    c.id,
-    c.document_id,
-    c.owner_user_id,
-    c.project_id,
-    c.thread_id,
-    c.text,
-    c.meta as metadata,
-    1 - (c.embedding <=> query_embedding) as similarity
-  from app.chunks c
-  where c.document_id = any(in_document_ids)
-  order by c.embedding <=> query_embedding
-  limit greatest(match_count, 1)
-$$;
--- ログインユーザがRAG検索関数を使用可能にする
-grant execute on function app.match_by_document_ids(vector,int,uuid[]) to authenticated;
-
--- 既存の検索関数を削除
 drop function if exists app.match_documents(vector,int,jsonb) cascade;
 drop function if exists app.match_documents(vector,int) cascade;
 drop function if exists app.match_documents(vector) cascade;
--- 検索関数
-create or replace function app.match_documents(
-  query_embedding vector,
-  match_count int
-)
-returns table(
-  id            bigint,
-  document_id   uuid,
-  owner_user_id uuid,
-  project_id    uuid,
-  thread_id     uuid,
-  text          text,
-  metadata      jsonb,
-  similarity    double precision
-)
+
+do $do$
+declare
+  dims     int  := coalesce(nullif(current_setting('app.embed_dims', true), ''), '1536')::int;
+  storage  text := coalesce(nullif(current_setting('app.embed_storage', true), ''), 'vector');
+  typ      text;
+  cur_typ  text;
+  cur_dims int;
+begin
+  if storage not in ('vector', 'halfvec') then
+    raise exception 'app.embed_storage must be vector or halfvec (got %)', storage;
+  end if;
+  typ := format('%s(%s)', storage, dims);
+
+  -- pgvector の型修飾子は次元数そのもの
+  select format_type(a.atttypid, a.atttypmod), a.atttypmod
+    into cur_typ, cur_dims
+    from pg_attribute a
+   where a.attrelid = 'app.chunks'::regclass and a.attname = 'embedding';
+
+  if cur_typ is distinct from typ then
+    drop index if exists app.idx_chunks_hnsw_cos;
+    if cur_dims = dims then
+      -- 精度（vector / halfvec）だけの変更: 型を変換するだけ（削除・正規化・再取り込みはしない）
+      execute format('alter table app.chunks alter column embedding type %s using embedding::%s', typ, typ);
+    elsif cur_dims > dims then
+      -- 切り詰めが使えないモデルで作った文書は作り直す。
+      -- ingest_key が無い文書（取り込み設定を記録する前のもの）は、当時の既定の text-embedding-3-small で作られている
+      -- （workers/ingest_sync.py の _same_embedding も ingest_key なしは流用可として扱う）
+      update app.documents d
+         set status = 'stale'
+       where d.ingest_key is not null and d.ingest_key not like 'text-embedding-3%'
+         and exists (select 1 from app.chunks c where c.document_id = d.id);
+      delete from app.chunks c
+       using app.documents d
+       where c.document_id = d.id and d.status = 'stale'
+         and d.ingest_key is not null and d.ingest_key not like 'text-embedding-3%';
+      execute format(
+        'alter table app.chunks alter column embedding type %s
+           using l2_normalize(subvector(embedding::vector, 1, %s))::%s',
+        typ, dims, typ
+      );
+      update app.documents
+         set ingest_key = regexp_replace(ingest_key, '^([^:]+):[0-9]+:', '\1:' || dims || ':')
+       where ingest_key like 'text-embedding-3%';
+    else
+      -- 次元を増やす場合は埋め込み直すしかない
+      update app.documents d
+         set status = 'stale'
+       where exists (select 1 from app.chunks c where c.document_id = d.id);
+      delete from app.chunks;
+      execute format('alter table app.chunks alter column embedding type %s using embedding::%s', typ, typ);
+    end if;
+    raise notice 'app.chunks.embedding: % -> %', cur_typ, typ;
+  end if;
+
+  drop index if exists app.idx_chunks_hnsw_cos;
+  execute format(
+    'create index idx_chunks_hnsw_cos on app.chunks using hnsw (embedding %s_cosine_ops)', storage
+  );
+
+  -- 検索 RPC（問い合わせベクトルは vector で受け取り、列の型に合わせて比べる）
+  execute format($tpl$
+    create or replace function app.match_documents_scoped(
+      query_embedding vector,
+      match_count int,
+      in_thread_id uuid,
+      in_project_id uuid
+    )
+    returns table(
+      id bigint,
+      document_id uuid,
+      owner_user_id uuid,
+      project_id uuid,
+      thread_id uuid,
+      text text,
+      metadata jsonb,
+      similarity double precision
+    )
+    language sql
+    stable
+    as $$
+      select
+        c.id,
+        c.document_id,
+        c.owner_user_id,
+        c.project_id,
+        c.thread_id,
+        c.text,
+        c.meta as metadata,
+        1 - (c.embedding <=> query_embedding::%1$s) as similarity
+      from app.chunks c
+      where (
+          (in_thread_id  is not null and c.thread_id  = in_thread_id)
+       or (in_project_id is not null and c.project_id = in_project_id)
+       or (c.owner_user_id = auth.uid())
+      )
+      order by c.embedding <=> query_embedding::%1$s
+      limit greatest(match_count, 1)
+    $$
+  $tpl$, typ);
+
+  execute format($tpl$
+    create or replace function app.match_by_document_ids(
+      query_embedding vector,
+      match_count int,
+      in_document_ids uuid[]
+    )
+    returns table(
+      id bigint,
+      document_id uuid,
+      owner_user_id uuid,
+      project_id uuid,
+      thread_id uuid,
+      text text,
+      metadata jsonb,
+      similarity double precision
+    )
+    language sql
+    stable
+    as $$
+      select
+        c.id,
+        c.document_id,
+        c.owner_user_id,
+        c.project_id,
+        c.thread_id,
+        c.text,
+        c.meta as metadata,
+        1 - (c.embedding <=> query_embedding::%1$s) as similarity
+      from app.chunks c
+      where c.document_id = any(in_document_ids)
+      order by c.embedding <=> query_embedding::%1$s
+      limit greatest(match_count, 1)
+    $$
+  $tpl$, typ);
+
+  execute format($tpl$
+    create or replace function app.match_documents(
+      query_embedding vector,
+      match_count int
+    )
+    returns table(
+      id            bigint,
+      document_id   uuid,
+      owner_user_id uuid,
+      project_id    uuid,
+      thread_id     uuid,
+      text          text,
+      metadata      jsonb,
+      similarity    double precision
+    )
+    language sql
+    stable
+    as $$
+      select
+        c.id,
+        c.document_id,
+        c.owner_user_id,
+        c.project_id,
+        c.thread_id,
+        c.text,
+        c.meta as metadata,
+        1 - (c.embedding <=> query_embedding::%1$s) as similarity
+      from app.chunks c
+      order by c.embedding <=> query_embedding::%1$s
+      limit greatest(match_count, 1)
+    $$
+  $tpl$, typ);
+end $do$;
+
+-- ログインユーザがRAG検索関数を使用可能にする
+grant execute on function app.match_documents_scoped(vector,int,uuid,uuid) to authenticated;
+grant execute on function app.match_by_document_ids(vector,int,uuid[]) to authenticated;
+grant execute on function app.match_documents(vector,int) to authenticated;
+
+-- 現在の埋め込みの保存形式（バックエンドが起動時に EMBED_DIMS / EMBED_STORAGE と突き合わせる）
+create or replace function app.embedding_config()
+returns table(dims int, storage text)
 language sql
 stable
 as $$
-  select
-    c.id,
-    c.document_id,
-    c.owner_user_id,
-    c.project_id,
-    c.thread_id,
-    c.text,
-    c.meta as metadata,
-    1 - (c.embedding <=> query_embedding) as similarity
-  from app.chunks c
-  order by c.embedding <=> query_embedding
-  limit greatest(match_count, 1)
+  select a.atttypmod, t.typname::text
+    from pg_attribute a
+    join pg_type t on t.oid = a.atttypid
+   where a.attrelid = 'app.chunks'::regclass and a.attname = 'embedding'
 $$;
-grant execute on function app.match_documents(vector,int) to authenticated;
+grant execute on function app.embedding_config() to authenticated;
 
 -- LangChain簡易互換（Langchainの機能の一部をSQLで実装）
 create table if not exists app.lc_documents (
@@ -909,6 +1008,182 @@ grant execute on function app.match_lc_documents(vector,int) to authenticated;
 -- ベクトル検索の高速化（コサイン）
 create index if not exists idx_lc_documents_hnsw_cos on app.lc_documents using hnsw (embedding vector_cosine_ops);
 
+-- チャンク埋め込みのキャッシュ（内容アドレス: 正規化したチャンク本文の sha256 × モデル × 次元数）
+-- 同じ資料を別スレッド・別プロジェクトに取り込むときに再埋め込みしない。
+-- 本文は持たずハッシュだけを保存する。読み書きはサーバ（service_role）のみ
+create table if not exists app.embedding_cache (
+  text_sha256   text not null,
+  model         text not null,
+  dims          int  not null,
+  embedding     vector not null,
+  created_at    timestamptz not null default now(),
+  primary key (text_sha256, model, dims)
+);
+alter table app.embedding_cache enable row level security;
+alter table app.embedding_cache force row level security;
+revoke all on app.embedding_cache from authenticated;
+
+-- 非同期ジョブのキュー（アップロード後の取り込みなど）
+-- ワーカーは claim_jobs でリースを取って実行し、heartbeat_job で延長、finish_job / fail_job で終える。
+-- リースが切れた running のジョブは別のワーカーが取り直す（プロセスが落ちても失われない）
+create table if not exists app.jobs (
+  id            uuid primary key default gen_random_uuid(),
+  kind          text not null,                          -- 例: 'ingest_attachment'
+  payload       jsonb not null default '{}',
+  status        text not null default 'queued'
+                check (status in ('queued','running','succeeded','failed','cancelled')),
+  priority      int  not null default 0,                -- 大きいほど先に実行
+  attempts      int  not null default 0,
+  max_attempts  int  not null default 5,
+  run_at        timestamptz not null default now(),     -- これより前には実行しない（再試行の待ち）
+  locked_by     text,
+  locked_until  timestamptz,
+  last_error    text,
+  result        jsonb,
+  owner_user_id uuid null references auth.users(id) on delete cascade,
+  attachment_id uuid null references app.attachments(id) on delete cascade,
+  created_at    timestamptz not null default now(),
+  updated_at    timestamptz not null default now(),
+  finished_at   timestamptz
+);
+create index if not exists idx_jobs_ready      on app.jobs(priority desc, run_at) where status = 'queued';
+create index if not exists idx_jobs_running    on app.jobs(locked_until) where status = 'running';
+create index if not exists idx_jobs_attachment on app.jobs(attachment_id);
+create index if not exists idx_jobs_owner      on app.jobs(owner_user_id, created_at desc);
+drop trigger if exists trg_jobs_touch_updated_at on app.jobs;
+create trigger trg_jobs_touch_updated_at
+before update on app.jobs
+for each row execute function app.touch_updated_at();
+
+-- 状態の参照は本人のジョブのみ。登録・更新はサーバ（service_role）だけが行う
+alter table app.jobs enable row level security;
+alter table app.jobs force row level security;
+drop policy if exists jobs_sel on app.jobs;
+create policy jobs_sel on app.jobs
+for select using (auth.uid() is not null and owner_user_id = auth.uid());
+grant select on app.jobs to authenticated;
+
+-- 実行可能なジョブを最大 in_limit 件リースする（同時に複数のワーカーが呼んでも同じジョブは渡さない）
+-- in_max_running を渡すと、全ワーカー合計の実行中件数がそれを超えないように取る件数を絞る
+drop function if exists app.claim_jobs(text,text[],int,int,int) cascade;
+create or replace function app.claim_jobs(
+  in_worker      text,
+  in_kinds       text[],
+  in_limit       int,
+  in_lease_sec   int,
+  in_max_running int default null
+)
+returns setof app.jobs
+language plpgsql
+as $$
+declare
+  v_limit int := greatest(in_limit, 0);
+  v_running int;
+begin
+  -- リース切れで再試行回数も尽きたものは失敗にする
+  update app.jobs
+     set status = 'failed', finished_at = now(), locked_by = null, locked_until = null,
+         last_error = coalesce(last_error, 'lease expired')
+   where status = 'running' and locked_until < now() and attempts >= max_attempts;
+
+  if in_max_running is not null then
+    -- 数えてから取るまでの間に別のワーカーも数えると、合わせて上限を超えて取ってしまう。
+    -- 上限つきの取得どうしはここで順番にする（ロックはトランザクションの終わりまで持つので、
+    -- 次のワーカーは前のワーカーが running にした行を数えられる）
+    perform pg_advisory_xact_lock(hashtextextended('app.claim_jobs', 0));
+    select count(*) into v_running
+      from app.jobs
+     where status = 'running' and locked_until >= now();
+    v_limit := least(v_limit, greatest(in_max_running - v_running, 0));
+  end if;
+  if v_limit = 0 then
+    return;
+  end if;
+
+  return query
+  update app.jobs j
+     set status = 'running',
+         attempts = j.attempts + 1,
+         locked_by = in_worker,
+         locked_until = now() + make_interval(secs => in_lease_sec)
+   where j.id in (
+     select c.id
+       from app.jobs c
+      where (in_kinds is null or c.kind = any(in_kinds))
+        and (
+          (c.status = 'queued' and c.run_at <= now())
+          or (c.status = 'running' and c.locked_until < now() and c.attempts < c.max_attempts)
+        )
+      order by c.priority desc, c.run_at
+      limit v_limit
+      for update skip locked
+   )
+  returning j.*;
+end;
+$$;
+
+-- リースの延長。別のワーカーに取られていれば false
+drop function if exists app.heartbeat_job(uuid,text,int) cascade;
+create or replace function app.heartbeat_job(in_id uuid, in_worker text, in_lease_sec int)
+returns boolean
+language sql
+as $$
+  with u as (
+    update app.jobs
+       set locked_until = now() + make_interval(secs => in_lease_sec)
+     where id = in_id and status = 'running' and locked_by = in_worker
+    returning 1
+  )
+  select exists (select 1 from u)
+$$;
+
+drop function if exists app.finish_job(uuid,text,jsonb) cascade;
+create or replace function app.finish_job(in_id uuid, in_worker text, in_result jsonb default null)
+returns boolean
+language sql
+as $$
+  with u as (
+    update app.jobs
+       set status = 'succeeded', result = in_result, last_error = null,
+           finished_at = now(), locked_by = null, locked_until = null
+     where id = in_id and status = 'running' and locked_by = in_worker
+    returning 1
+  )
+  select exists (select 1 from u)
+$$;
+
+-- 失敗の記録。再試行回数が残っていれば in_retry_in_sec 秒後に queued へ戻す。戻り値は新しい状態
+drop function if exists app.fail_job(uuid,text,text,int) cascade;
+create or replace function app.fail_job(in_id uuid, in_worker text, in_error text, in_retry_in_sec int)
+returns text
+language sql
+as $$
+  update app.jobs
+     set status       = case when attempts < max_attempts then 'queued' else 'failed' end,
+         run_at       = case when attempts < max_attempts
+                             then now() + make_interval(secs => in_retry_in_sec) else run_at end,
+         finished_at  = case when attempts < max_attempts then null else now() end,
+         last_error   = left(in_error, 2000),
+         locked_by    = null,
+         locked_until = null
+   where id = in_id and status = 'running' and locked_by = in_worker
+  returning status
+$$;
+
+revoke all on function app.claim_jobs(text,text[],int,int,int) from public;
+revoke all on function app.heartbeat_job(uuid,text,int)        from public;
+revoke all on function app.finish_job(uuid,text,jsonb)         from public;
+revoke all on function app.fail_job(uuid,text,text,int)        from public;
+do $$
+begin
+  if exists (select 1 from pg_roles where rolname = 'service_role') then
+    grant execute on function app.claim_jobs(text,text[],int,int,int) to service_role;
+    grant execute on function app.heartbeat_job(uuid,text,int)        to service_role;
+    grant execute on function app.finish_job(uuid,text,jsonb)         to service_role;
+    grant execute on function app.fail_job(uuid,text,text,int)        to service_role;
+  end if;
+end $$;
+
 -- =========================================
 -- J) RAG 論理層（Datasets と コンテナ/パッケージ設計 追加）
 -- =========================================
@@ -1630,6 +1905,64 @@ begin
 end $$;
 grant execute on function app.add_attachment(text, text, bigint, text, uuid, uuid) to authenticated; -- ログイン済みユーザに関数の権限を付与
 
+-- 添付ファイルの一括登録（まとめてアップロードしたファイルを 1 回の呼び出しで登録する）
+--   in_items: [{"storage_path", "mime", "size", "title"}, ...]。全件が同じプロジェクト / スレッドに入る
+--   所有チェックは add_attachment と同じで、呼び出しごとに 1 回だけ行う。戻り値は登録した行（in_items の順）
+drop function if exists app.add_attachments(jsonb, uuid, uuid) cascade;
+create or replace function app.add_attachments(
+  in_items      jsonb,
+  in_project_id uuid default null,
+  in_thread_id  uuid default null
+)
+returns setof app.attachments
+language plpgsql
+volatile
+set search_path = app, pg_temp
+as $$
+begin
+  if auth.uid() is null then raise exception 'unauthenticated' using errcode = '28000'; end if;
+
+  -- プロジェクト所有（自分）チェック
+  if in_project_id is not null and not exists (
+    select 1 from app.projects p
+     where p.id = in_project_id and p.user_id = auth.uid()
+  ) then
+    raise exception 'forbidden project: %', in_project_id using errcode='42501';
+  end if;
+
+  -- スレッド所有（自分）チェック（thread は自分プロジェクト配下）
+  if in_thread_id is not null and not exists (
+    select 1
+      from app.threads t
+      join app.projects p on p.id = t.project_id
+     where t.id = in_thread_id and p.user_id = auth.uid()
+  ) then
+    raise exception 'forbidden thread: %', in_thread_id using errcode='42501';
+  end if;
+
+  -- 両方指定時の整合性チェック（thread が project 配下か）
+  if in_project_id is not null and in_thread_id is not null and not exists (
+    select 1 from app.threads t
+     where t.id = in_thread_id and t.project_id = in_project_id
+  ) then
+    raise exception 'thread % does not belong to project %', in_thread_id, in_project_id using errcode='22P02';
+  end if;
+
+  return query
+  with ins as (
+    insert into app.attachments(storage_path, mime, size, owner_user_id, project_id, thread_id, title)
+    select i.storage_path, i.mime, i.size, auth.uid(), in_project_id, in_thread_id, i.title
+      from jsonb_to_recordset(in_items) as i(storage_path text, mime text, size bigint, title text)
+    returning *
+  )
+  select ins.*
+    from ins
+    join jsonb_array_elements(in_items) with ordinality as e(item, ord)
+      on e.item->>'storage_path' = ins.storage_path
+   order by e.ord;
+end $$;
+grant execute on function app.add_attachments(jsonb, uuid, uuid) to authenticated;
+
 -- 添付ファイルの再割当（添付ファイルの紐づけ先の変更）
 drop function if exists app.reassign_attachment(uuid, uuid, uuid, text) cascade;
 create or replace function app.reassign_attachment(
@@ -1707,6 +2040,241 @@ begin
 end $$;
 grant execute on function app.delete_attachment(uuid) to authenticated; -- ログイン済みユーザに関数の権限を付与
 
+-- 文書のチャンクの差分反映（差分再取り込みの後始末）
+--   残すチャンクの chunk_index / ページ / タイトル・出典を一括で付け直し、消えたチャンクを削除する
+--   新しいチャンクの INSERT は呼び出し側が先に済ませておく
+drop function if exists app.reconcile_chunks(uuid, bigint[], int[], int[], bigint[], text, text) cascade;
+create or replace function app.reconcile_chunks(
+  in_document_id uuid,
+  in_keep_ids    bigint[],             -- 付け直すチャンクの id
+  in_keep_index  int[],                -- 新しい chunk_index（in_keep_ids と同じ並び）
+  in_keep_page   int[],                -- 新しいページ番号（null 可）
+  in_delete_ids  bigint[],             -- 削除するチャンクの id
+  in_title       text default null,
+  in_source      text default null
+)
+returns int
+language plpgsql
+security definer
+set search_path = app, pg_temp
+as $$
+declare v_deleted int;
+begin
+  if coalesce(auth.role(), '') <> 'service_role' then
+    if auth.uid() is null then raise exception 'unauthenticated' using errcode = '28000'; end if;
+    if not exists(select 1 from app.documents d where d.id = in_document_id and d.owner_user_id = auth.uid()) then
+      raise exception 'forbidden' using errcode = '42501';
+    end if;
+  end if;
+
+  update app.chunks c
+     set chunk_index = k.idx,
+         meta = c.meta
+                || jsonb_build_object('page', k.page)
+                || case when in_title  is null then '{}'::jsonb else jsonb_build_object('title',  in_title)  end
+                || case when in_source is null then '{}'::jsonb else jsonb_build_object('source', in_source) end
+    from unnest(coalesce(in_keep_ids, '{}'), coalesce(in_keep_index, '{}'), coalesce(in_keep_page, '{}'))
+           as k(id, idx, page)
+   where c.id = k.id
+     and c.document_id = in_document_id;
+
+  delete from app.chunks c
+   where c.document_id = in_document_id
+     and c.id = any(coalesce(in_delete_ids, '{}'));
+  get diagnostics v_deleted = row_count;
+
+  update app.documents set updated_at = now() where id = in_document_id;
+  return v_deleted;
+end $$;
+revoke all on function app.reconcile_chunks(uuid, bigint[], int[], int[], bigint[], text, text) from public;
+grant execute on function app.reconcile_chunks(uuid, bigint[], int[], int[], bigint[], text, text) to authenticated;
+do $$
+begin
+  if exists (select 1 from pg_roles where rolname = 'service_role') then
+    grant execute on function app.reconcile_chunks(uuid, bigint[], int[], int[], bigint[], text, text) to service_role; -- ジョブワーカー（サーバ側）からの取り込み
+  end if;
+end $$;
+
+-- 取り込みの開始（添付ごとに 1 つだけ走らせる）
+--   state: 'done'     … 同じ設定（in_ingest_key）で取り込み済み。何もしなくてよい
+--          'busy'     … 別のワーカーがリース中。呼び出し側は待って再度呼ぶ
+--          'acquired' … リースを取得した（文書が無ければ status='ingesting' で作る）。
+--                       同じ in_worker で呼び直すとリースを延長する
+--   prev_key は前回の取り込み設定（差分再取り込みで旧チャンクの埋め込みを流用できるかの判断用）
+drop function if exists app.begin_ingest(uuid, text, text, int) cascade;
+create or replace function app.begin_ingest(
+  in_attachment_id uuid,
+  in_ingest_key    text,
+  in_worker        text,
+  in_lease_sec     int default 600
+)
+returns table(document_id uuid, state text, prev_key text)
+language plpgsql
+security definer
+set search_path = app, pg_temp
+as $$
+declare
+  v_att app.attachments;
+  v_doc app.documents;
+begin
+  select * into v_att from app.attachments a where a.id = in_attachment_id;
+  if v_att.id is null then
+    raise exception 'attachment not found: %', in_attachment_id using errcode = '22P02';
+  end if;
+  if coalesce(auth.role(), '') <> 'service_role' then
+    if auth.uid() is null then raise exception 'unauthenticated' using errcode = '28000'; end if;
+    if v_att.owner_user_id <> auth.uid() then
+      raise exception 'forbidden' using errcode = '42501';
+    end if;
+  end if;
+
+  -- 同じ添付への同時呼び出しを直列化する（文書の二重作成を防ぐ。トランザクション終了で解放）
+  perform pg_advisory_xact_lock(hashtextextended(in_attachment_id::text, 0));
+
+  select * into v_doc from app.documents d
+   where d.attachment_id = in_attachment_id
+   order by d.created_at desc
+   limit 1;
+
+  if v_doc.id is null then
+    insert into app.documents(
+      attachment_id, owner_user_id, project_id, thread_id, title, status, meta,
+      ingest_locked_by, ingest_locked_until
+    )
+    values (
+      v_att.id, v_att.owner_user_id, v_att.project_id, v_att.thread_id,
+      coalesce(v_att.title, 'Untitled'), 'ingesting', jsonb_build_object('source', v_att.storage_path),
+      in_worker, now() + make_interval(secs => in_lease_sec)
+    )
+    returning id into document_id;
+    state := 'acquired';
+    return next;
+    return;
+  end if;
+
+  document_id := v_doc.id;
+  prev_key := v_doc.ingest_key;
+  if v_doc.status = 'ready' and v_doc.ingest_key = in_ingest_key then
+    state := 'done';
+  elsif v_doc.ingest_locked_by is not null
+        and v_doc.ingest_locked_by <> in_worker
+        and v_doc.ingest_locked_until > now() then
+    state := 'busy';
+  else
+    update app.documents d
+       set ingest_locked_by    = in_worker,
+           ingest_locked_until = now() + make_interval(secs => in_lease_sec)
+     where d.id = v_doc.id;
+    state := 'acquired';
+  end if;
+  return next;
+end $$;
+revoke all on function app.begin_ingest(uuid, text, text, int) from public;
+grant execute on function app.begin_ingest(uuid, text, text, int) to authenticated;
+do $$
+begin
+  if exists (select 1 from pg_roles where rolname = 'service_role') then
+    grant execute on function app.begin_ingest(uuid, text, text, int) to service_role; -- ジョブワーカー（サーバ側）からの取り込み
+  end if;
+end $$;
+
+-- 取り込みの終了（リースを手放す）
+--   in_ingest_key を渡すと成功: status='ready' にして取り込み設定を記録する
+--   null なら失敗: 作りかけの文書（'ingesting'）は 'failed' にする。次の begin_ingest でやり直せる
+drop function if exists app.end_ingest(uuid, text, text) cascade;
+create or replace function app.end_ingest(
+  in_document_id uuid,
+  in_worker      text,
+  in_ingest_key  text default null
+)
+returns boolean
+language plpgsql
+security definer
+set search_path = app, pg_temp
+as $$
+begin
+  if coalesce(auth.role(), '') <> 'service_role' then
+    if auth.uid() is null then raise exception 'unauthenticated' using errcode = '28000'; end if;
+    if not exists(select 1 from app.documents d where d.id = in_document_id and d.owner_user_id = auth.uid()) then
+      raise exception 'forbidden' using errcode = '42501';
+    end if;
+  end if;
+
+  update app.documents d
+     set status = case
+                    when in_ingest_key is not null then 'ready'
+                    when d.status = 'ingesting' then 'failed'
+                    else d.status
+                  end,
+         ingest_key          = coalesce(in_ingest_key, d.ingest_key),
+         ingest_locked_by    = null,
+         ingest_locked_until = null
+   where d.id = in_document_id
+     and d.ingest_locked_by = in_worker;
+  return found;
+end $$;
+revoke all on function app.end_ingest(uuid, text, text) from public;
+grant execute on function app.end_ingest(uuid, text, text) to authenticated;
+do $$
+begin
+  if exists (select 1 from pg_roles where rolname = 'service_role') then
+    grant execute on function app.end_ingest(uuid, text, text) to service_role; -- ジョブワーカー（サーバ側）からの取り込み
+  end if;
+end $$;
+
+-- 改訂版の再アップロード: 旧添付の文書（最新）を新しい添付に付け替える
+--   付け替えた文書は次の取り込みで差分だけが埋め込まれる。旧添付に文書が無ければ null を返す
+drop function if exists app.adopt_document(uuid, uuid) cascade;
+create or replace function app.adopt_document(
+  in_from_attachment_id uuid,
+  in_to_attachment_id   uuid
+)
+returns uuid
+language plpgsql
+security definer
+set search_path = app, pg_temp
+as $$
+declare
+  v_doc uuid;
+  v_att app.attachments;
+begin
+  if auth.uid() is null then raise exception 'unauthenticated' using errcode = '28000'; end if;
+
+  select * into v_att from app.attachments a
+   where a.id = in_to_attachment_id and a.owner_user_id = auth.uid();
+  if v_att.id is null
+     or not exists(select 1 from app.attachments a
+                    where a.id = in_from_attachment_id and a.owner_user_id = auth.uid()) then
+    raise exception 'forbidden' using errcode = '42501';
+  end if;
+
+  select d.id into v_doc from app.documents d
+   where d.attachment_id = in_from_attachment_id
+   order by d.created_at desc
+   limit 1;
+  if v_doc is null then
+    return null;
+  end if;
+
+  update app.documents d
+     set attachment_id = v_att.id,
+         project_id    = v_att.project_id,
+         thread_id     = v_att.thread_id,
+         title         = coalesce(v_att.title, d.title),
+         status        = 'stale',  -- 中身が変わったので、次の取り込み（begin_ingest）で差分を反映させる
+         meta          = d.meta || jsonb_build_object('source', v_att.storage_path)
+   where d.id = v_doc;
+  -- 検索の絞り込み（スレッド・プロジェクト）もチャンク側の列で行うので合わせる
+  update app.chunks c
+     set project_id = v_att.project_id,
+         thread_id  = v_att.thread_id
+   where c.document_id = v_doc
+     and (c.project_id is distinct from v_att.project_id or c.thread_id is distinct from v_att.thread_id);
+  return v_doc;
+end $$;
+revoke all on function app.adopt_document(uuid, uuid) from public;
+grant execute on function app.adopt_document(uuid, uuid) to authenticated;
+
 -- 添付ファイル一覧の取得
 drop function if exists app.list_my_attachments(uuid, uuid, text) cascade;
 create or replace function app.list_my_attachments(